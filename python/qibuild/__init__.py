@@ -13,10 +13,12 @@ import logging
 
 from qibuild import archive
 from qibuild import build
+from qibuild import buildlog
 from qibuild import cmake
 from qibuild import cmdparse
 from qibuild import command
 from qibuild import config
+from qibuild import configcache
 from qibuild import configstore
 from qibuild import ctest
 from qibuild import envsetter
@@ -52,7 +52,7 @@ def list_build_folder(path, bdirs, work_tree):
 def do(args):
     """Main entry point"""
     logger   = logging.getLogger(__name__)
-    qiwt     = qibuild.worktree_open(args.work_tree)
+    qiwt     = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
 
     if args.force:
         logger.info("preparing to remove:")
@@ -4,10 +4,16 @@
 
 """Configure a project
 
+With -j, several projects are configured at the same time:
+a project is configured as soon as all its dependencies are.
 """
 
+import sys
 import logging
+import StringIO
+
 import qibuild
+from qibuild.parallel import DagScheduler
 
 def configure_parser(parser):
     """Configure parser for this action"""
@@ -24,7 +30,17 @@ def configure_parser(parser):
     group.add_argument("--no-clean-first", dest="clean_first",
         action="store_false",
         help="do not clean CMake cache")
-    parser.set_defaults(clean_first=True)
+    group.add_argument("--force", dest="force_cmake", action="store_true",
+        help="run cmake even if nothing has changed since the last configure")
+    group = parser.add_argument_group("parallel configure arguments")
+    group.add_argument("--keep-going", dest="keep_going",
+        action="store_true",
+        help="when a project fails to configure, go on with the projects "
+             "that do not depend on it")
+    group.add_argument("--fail-fast", dest="keep_going",
+        action="store_false",
+        help="stop as soon as a project fails to configure (default)")
+    parser.set_defaults(clean_first=True, force_cmake=False, keep_going=False)
 
 def do(args):
     """Main entry point"""
@@ -42,8 +58,59 @@ def do(args):
 
     if toc.active_config:
         logger.info("Active configuration: %s", toc.active_config)
+    if args.num_jobs > 1 and len(projects) > 1:
+        configure_parallel(toc, projects, args)
+        return
     for project in projects:
         logger.info("Configuring %s", project.name)
-        toc.configure_project(project, clean_first=args.clean_first)
+        toc.configure_project(project, clean_first=args.clean_first,
+                              force=args.force_cmake)
+
+
+def configure_parallel(toc, projects, args):
+    """ Configure the projects using args.num_jobs threads.
+
+    The output of cmake is buffered, and displayed project
+    after project, in the same order as when configuring serially
+
+    """
+    logger = logging.getLogger(__name__)
+    names = [p.name for p in projects]
+    projects = dict((p.name, p) for p in projects)
+    graph = toc.get_dependency_graph()
+    # The threads must not fill the caches of the toc object
+    toc.prepare_projects(names)
+    outputs = dict()
+
+    def configure(name):
+        "To be called in a thread"
+        out = StringIO.StringIO()
+        outputs[name] = out
+        toc.configure_project(projects[name], clean_first=args.clean_first,
+                              out=out, force=args.force_cmake)
 
+    def on_done(name, status):
+        "Called when a project is over, in the correct order"
+        if status == "skipped":
+            logger.info("Skipping %s", name)
+            return
+        logger.info("Configuring %s", name)
+        sys.stdout.write(outputs[name].getvalue())
+        sys.stdout.flush()
+        if status == "failed":
+            logger.error(scheduler.errors[name][1])
 
+    scheduler = DagScheduler(names, graph.get_deps,
+        num_jobs=args.num_jobs, keep_going=args.keep_going)
+    if scheduler.run(configure, on_done=on_done):
+        return
+    if len(scheduler.errors) == 1:
+        (exc_type, exc_value, exc_tb) = scheduler.errors.values()[0]
+        raise exc_type, exc_value, exc_tb
+    failed = [x for x in names if x in scheduler.errors]
+    mess  = "The following projects failed to configure:\n"
+    mess += "\n".join("  " + x for x in failed)
+    if scheduler.skipped:
+        mess += "\nThe following projects were not configured:\n"
+        mess += "\n".join("  " + x for x in scheduler.skipped)
+    raise qibuild.toc.TocException(mess)
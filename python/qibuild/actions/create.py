@@ -42,11 +42,11 @@ def do(args):
     # If not, ask the user if he wants to create one:
     qiwt = None
     try:
-        qiwt = qibuild.worktree_open(args.work_tree)
+        qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
     except qibuild.worktree.WorkTreeException:
         if qibuild.interact.ask_yes_no("Warning, no worktree found. Create one"):
             qibuild.run_action("qibuild.actions.init", ["--interactive"])
-            qiwt = qibuild.worktree_open(args.work_tree)
+            qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
 
     project_name = args.project_name
     if qiwt:
@@ -0,0 +1,34 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Display the status of the project index of the worktree
+
+The index is stored in .qi/projects.idx, and is used to avoid
+exploring the whole worktree each time a command is run.
+Use --rescan to rebuild it from scratch.
+"""
+
+import os
+import logging
+import qibuild
+
+LOGGER = logging.getLogger(__name__)
+
+def configure_parser(parser):
+    """Configure parser for this action """
+    qibuild.parsers.work_tree_parser(parser)
+
+def do(args):
+    """Main entry point"""
+    qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
+    index = qiwt.project_index
+    if not index:
+        LOGGER.info("No project index for %s (no .qi directory)", qiwt.work_tree)
+        return
+    LOGGER.info("Project index: %s",
+        os.path.relpath(index.index_path, qiwt.work_tree))
+    print "  buildable projects: %i" % len(qiwt.buildable_projects)
+    print "  git projects:       %i" % len(qiwt.git_projects)
+    print "  index hits:         %i" % index.hits
+    print "  rescans:            %i" % index.rescans
@@ -0,0 +1,75 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" Display the log of the last configure or build of a project
+
+With --errors or --warnings, only display the matching lines,
+using the index written next to the log, without reading the
+whole log.
+"""
+
+import os
+import logging
+import qibuild
+import qibuild.buildlog
+
+def configure_parser(parser):
+    """Configure parser for this action"""
+    qibuild.parsers.toc_parser(parser)
+    qibuild.parsers.build_parser(parser)
+    parser.add_argument("project", nargs="?")
+    parser.add_argument("--step", choices=["configure", "build"],
+        help="only display the log of this step. "
+             "Default: configure, then build")
+    parser.add_argument("--errors", action="store_true",
+        help="only display the errors")
+    parser.add_argument("--warnings", action="store_true",
+        help="only display the warnings")
+    parser.add_argument("-C", "--context", type=int,
+        help="number of lines to display around each error or warning")
+    parser.set_defaults(errors=False, warnings=False, context=0)
+
+def do(args):
+    """Main entry point"""
+    logger = logging.getLogger(__name__)
+    toc = qibuild.toc_open(args.work_tree, args)
+    if not args.project:
+        project_name = qibuild.toc.project_from_cwd()
+    else:
+        project_name = args.project
+    project = toc.get_project(project_name)
+
+    if args.step:
+        steps = [args.step]
+    else:
+        steps = ["configure", "build"]
+    kinds = list()
+    if args.errors:
+        kinds.append("error")
+    if args.warnings:
+        kinds.append("warning")
+
+    found = False
+    for step in steps:
+        log_path = qibuild.buildlog.get_log_path(project.build_directory, step)
+        if not os.path.exists(log_path):
+            continue
+        found = True
+        if not kinds:
+            for line in qibuild.buildlog.read_log(log_path):
+                print line,
+            continue
+        matches = qibuild.buildlog.find_lines(log_path, kinds=kinds,
+                                              context=args.context)
+        logger.info("%s: %i %s", log_path, len(matches),
+                    " and ".join(x + "s" for x in kinds))
+        for (_kind, line_number, lines) in matches:
+            if args.context:
+                print "--"
+            for (number, line) in lines:
+                print "%s:%i: %s" % (step, number, line)
+    if not found:
+        raise Exception("No log found for %s in %s\n"
+            "Try using `qibuild configure` and `qibuild make` first" %
+            (project.name, toc.build_folder_name))
@@ -4,11 +4,20 @@
 
 """Build a project
 
+With -j, independent projects are built at the same time,
+sharing the same number of jobs.
 """
 
+import os
+import sys
+import time
 import logging
+import StringIO
+
 import qibuild
 import qibuild.cmdparse
+from qibuild import parallel
+from qibuild.durations import Durations
 
 def configure_parser(parser):
     """Configure parser for this action"""
@@ -17,6 +26,9 @@ def configure_parser(parser):
     qibuild.parsers.project_parser(parser)
     parser.add_argument("--target", help="Special target to build")
     parser.add_argument("--rebuild", "-r", action="store_true", default=False)
+    parser.add_argument("--critical-path", action="store_true", default=False,
+        help="when building in parallel, start with the projects on the "
+             "longest path, using the durations of the previous builds")
 
 def do(args):
     """Main entry point"""
@@ -29,6 +41,14 @@ def do(args):
     if toc.active_config:
         logger.info("Active configuration: %s (%s)", toc.active_config, toc.build_type)
 
+    durations = Durations(get_durations_path(toc))
+    if args.num_jobs > 1 and len(project_names) > 1 and not use_incredibuild:
+        try:
+            build_parallel(toc, project_names, durations, args)
+        finally:
+            durations.save()
+        return
+
     for project_names in project_names:
         project = toc.get_project(project_names)
         if args.target:
@@ -36,9 +56,84 @@ def do(args):
                 args.target, project.name, toc.build_folder_name, toc.build_type)
         else:
             logger.info("Building %s in %s (%s)", project.name, toc.build_folder_name, toc.build_type)
+        start = time.time()
         toc.build_project(project, target=args.target, num_jobs=args.num_jobs,
             incredibuild=use_incredibuild, rebuild=args.rebuild)
+        durations.record(project.name, time.time() - start)
+        durations.save()
+
+
+def get_durations_path(toc):
+    """ Where to store the durations of the builds """
+    return os.path.join(toc.work_tree, ".qi",
+        "build-durations-%s.json" % toc.build_folder_name)
+
+
+def build_parallel(toc, project_names, durations, args):
+    """ Build the projects using a global budget of args.num_jobs jobs.
 
+    When using Makefiles on POSIX, the jobs are shared using a GNU make
+    jobserver, so make can use any free job whatever the project.
+    Otherwise, each build takes its share of the free jobs before
+    starting, and passes it to the build tool with -j.
 
+    The output of the builds is buffered, and displayed project
+    after project, in the same order as when building serially
 
+    """
+    logger = logging.getLogger(__name__)
+    projects = dict((x, toc.get_project(x)) for x in project_names)
+    graph = toc.get_dependency_graph()
+    # The threads must not fill the caches of the toc object
+    toc.prepare_projects(project_names)
+    if parallel.job_server_supported(toc.cmake_generator):
+        pool = parallel.MakeJobServer(args.num_jobs)
+        makeflags = pool.make_flags()
+    else:
+        pool = parallel.TokenPool(args.num_jobs)
+        makeflags = None
+    scheduler = parallel.DagScheduler(project_names, graph.get_deps,
+        num_jobs=args.num_jobs)
+    if args.critical_path:
+        scheduler.use_critical_path(durations.durations,
+                                    default=durations.get_default())
+    outputs = dict()
+    times = dict()
+
+    def build(name, share):
+        "To be called in a thread"
+        out = StringIO.StringIO()
+        outputs[name] = out
+        num_jobs = pool.acquire(share)
+        try:
+            start = time.time()
+            toc.build_project(projects[name], target=args.target,
+                num_jobs=num_jobs, rebuild=args.rebuild,
+                makeflags=makeflags, out=out)
+            times[name] = time.time() - start
+        finally:
+            pool.release(num_jobs)
+
+    def on_done(name, status):
+        "Called when a project is over, in the correct order"
+        if status == "skipped":
+            return
+        if args.target:
+            logger.info("Building target %s for project %s in %s (%s)",
+                args.target, name, toc.build_folder_name, toc.build_type)
+        else:
+            logger.info("Building %s in %s (%s)", name, toc.build_folder_name,
+                        toc.build_type)
+        sys.stdout.write(outputs[name].getvalue())
+        sys.stdout.flush()
+        if status == "ok":
+            durations.record(name, times[name])
 
+    try:
+        if scheduler.run(build, on_done=on_done, with_share=True):
+            return
+    finally:
+        pool.close()
+    failed = [x for x in project_names if x in scheduler.errors]
+    (exc_type, exc_value, exc_tb) = scheduler.errors[failed[0]]
+    raise exc_type, exc_value, exc_tb
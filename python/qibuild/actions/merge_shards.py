@@ -0,0 +1,39 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" Merge the results of tests run with
+`qibuild test --shard-index i --shard-count n`
+
+The XML files of every test are written in
+<output>/<project>/<test>.xml, and the durations of the tests
+in <output>/durations.json, to be used with
+`qibuild test --shard-durations` for the next runs.
+"""
+
+import os
+import logging
+import qibuild
+import qibuild.ctest
+
+def configure_parser(parser):
+    """Configure parser for this action"""
+    parser.add_argument("shard_results", nargs="+", metavar="SHARD_RESULTS",
+        help="files written by each shard")
+    parser.add_argument("-o", "--output", dest="output_dir",
+        help="where to write the merged results. "
+             "Default: build-tests/merged")
+
+def do(args):
+    """Main entry point"""
+    logger = logging.getLogger(__name__)
+    output_dir = args.output_dir
+    if not output_dir:
+        output_dir = os.path.join(os.getcwd(), "build-tests", "merged")
+    (ok, summary) = qibuild.ctest.merge_shard_results(args.shard_results,
+                                                      output_dir)
+    logger.info("Results written in %s", output_dir)
+    if ok:
+        logger.info(summary)
+    else:
+        raise Exception(summary)
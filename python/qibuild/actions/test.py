@@ -3,29 +3,209 @@
 ## found in the COPYING file.
 
 """ Launch automatic tests
+
+With -j, several tests are run at the same time, honoring
+the RUN_SERIAL, RESOURCE_LOCK and PROCESSORS test properties.
+
+Tests that passed the last time are not run again if their
+executables, their arguments and the shared libraries of the
+project and of its dependencies did not change. Use --no-cache
+to run them anyway.
+
+When no project is given, the project of the current directory
+is tested. Use --all to test every project of the worktree.
+
+With --shard-index and --shard-count, the tests of all the given
+projects are split in balanced shards, so that several machines
+can each run their own shard. Merge the results written by each
+shard with `qibuild merge_shards`
 """
 
+import os
 import logging
 import qibuild
+import qibuild.ctest
+from qibuild.durations import Durations
 
 def configure_parser(parser):
     """Configure parser for this action"""
     qibuild.parsers.toc_parser(parser)
     qibuild.parsers.build_parser(parser)
-    parser.add_argument("project", nargs="?")
+    qibuild.parsers.project_parser(parser)
     parser.add_argument("--test-name")
+    parser.add_argument("--list", action="store_true",
+        help="list the tests instead of running them")
+    parser.add_argument("--timings", action="store_true",
+        help="with --list, display the expected durations, and the "
+             "tests on the critical path when running with -j")
+    parser.add_argument("--gtest-shards", type=int,
+        help="split each gtest test in this number of shards, "
+             "run in parallel (implies -j with the same number, "
+             "if -j is lower)")
+    group = parser.add_argument_group("sharding arguments",
+        "(the dependencies of the projects are never tested)")
+    group.add_argument("--shard-index", type=int,
+        help="index of the shard to run, from 0 to shard count - 1")
+    group.add_argument("--shard-count", type=int,
+        help="number of shards")
+    group.add_argument("--shard-durations",
+        help="durations of the tests, used to balance the shards. "
+             "(written by qibuild merge_shards). Every shard must use "
+             "the same file. When not given, the tests are spread "
+             "using a hash of their names")
+    group.add_argument("--shard-results",
+        help="where to write the results of the shard. "
+             "Default: <worktree>/build-tests/shard-<index>.json")
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache",
+        help="run all the tests, even the ones that passed the last time "
+             "and whose executables and libraries did not change")
+    parser.set_defaults(list=False, timings=False, gtest_shards=1,
+        shard_index=None, shard_count=None, use_cache=True)
 
 def do(args):
     """Main entry point"""
     logger   = logging.getLogger(__name__)
     toc      = qibuild.toc_open(args.work_tree, args)
 
-    if not args.project:
-        project_name = qibuild.toc.project_from_cwd()
-    else:
-        project_name = args.project
+    if not args.projects and not args.all:
+        # Testing every project is only done with --all
+        toc.active_projects = [qibuild.toc.project_from_cwd()]
+    projects = [toc.get_project(x) for x in toc.active_projects]
+    if args.shard_count is not None or args.shard_index is not None:
+        run_shard(toc, projects, args)
+        return
+    if args.list:
+        for project in projects:
+            print_list(project, args)
+        return
+    failures = list()
+    for project in projects:
+        logger.info("Testing %s in %s", project.name, toc.build_folder_name)
+        try:
+            toc.test_project(project, test_name=args.test_name,
+                             num_jobs=args.num_jobs,
+                             gtest_shards=args.gtest_shards,
+                             use_cache=args.use_cache)
+        except qibuild.toc.TestsFailed, e:
+            if len(projects) == 1:
+                raise
+            logger.error(str(e))
+            failures.append(project.name)
+    if failures:
+        raise qibuild.toc.TocException("Tests failed for: %s" %
+                                       ", ".join(failures))
+
+
+def get_shard(toc, projects, args):
+    """ Compute the partition of the tests of the projects
+
+    :return: (tests, shards) where tests is a dict
+             ``<project>/<test>`` -> (project, test)
+             and shards is the list of names in each shard,
+             as returned by :py:func:`qibuild.ctest.partition_tests`
+
+    """
+    if args.shard_count is None or args.shard_index is None:
+        raise qibuild.toc.TocException("--shard-index and --shard-count "
+                                       "must be used together")
+    if not 0 <= args.shard_index < args.shard_count:
+        raise qibuild.toc.TocException("--shard-index should be between "
+            "0 and %i" % (args.shard_count - 1))
+    tests = dict()
+    names = list()
+    for project in projects:
+        for test in qibuild.ctest.get_tests(project, test_name=args.test_name):
+            name = "%s/%s" % (project.name, test[0])
+            tests[name] = (project, test)
+            names.append(name)
+    # Do not depend on the order of the projects on the command line
+    names.sort()
+    durations = None
+    if args.shard_durations:
+        if not os.path.exists(args.shard_durations):
+            raise qibuild.toc.TocException("%s does not exist" %
+                                           args.shard_durations)
+        durations = Durations(args.shard_durations).durations
+    shards = qibuild.ctest.partition_tests(names, args.shard_count,
+                                           durations=durations)
+    return (tests, shards)
+
+
+def run_shard(toc, projects, args):
+    """ Run the tests of one shard, and write their results """
+    logger = logging.getLogger(__name__)
+    (tests, shards) = get_shard(toc, projects, args)
+    shard = shards[args.shard_index]
+    if args.list:
+        logger.info("Tests for shard %i/%i:", args.shard_index,
+                    args.shard_count)
+        for name in shard:
+            print "  ", name
+        return
+    results_path = args.shard_results
+    if not results_path:
+        results_path = os.path.join(toc.work_tree, "build-tests",
+            "shard-%i.json" % args.shard_index)
+    logger.info("Running shard %i/%i (%i tests out of %i) in %s",
+                args.shard_index, args.shard_count, len(shard), len(tests),
+                toc.build_folder_name)
+    entries = list()
+    for project in projects:
+        to_run = [tests[x][1] for x in shard if tests[x][0] is project]
+        if not to_run:
+            continue
+        logger.info("Testing %s", project.name)
+        sdk_dirs = None
+        if args.use_cache:
+            sdk_dirs = toc.get_test_sdk_dirs(project)
+        results = qibuild.ctest.run_test_list(project, toc.build_env, to_run,
+            num_jobs=args.num_jobs, gtest_shards=args.gtest_shards,
+            sdk_dirs=sdk_dirs, packages=toc.packages)
+        results_dir = qibuild.ctest.get_results_dir(project)
+        for test_res in results:
+            xml_path = os.path.join(results_dir, test_res.test_name + ".xml")
+            entries.append((project.name, test_res, xml_path))
+    qibuild.ctest.write_shard_results(results_path, args.shard_index,
+        args.shard_count, qibuild.ctest.get_partition_key(shards), entries)
+    logger.info("Results written in %s", results_path)
+    failures = ["%s/%s" % (x[0], x[1].test_name) for x in entries
+                if not x[1].ok]
+    if failures:
+        mess  = "Ran %i tests, %i failures\n" % (len(entries), len(failures))
+        for failure in failures:
+            mess += "  * %s\n" % failure
+        raise qibuild.toc.TocException(mess)
+
 
-    project = toc.get_project(project_name)
-    logger.info("Testing %s in %s", project.name, toc.build_folder_name)
-    toc.test_project(project, test_name=args.test_name)
+def print_list(project, args):
+    """ Print the tests of the project, with their expected
+    durations if --timings was given
 
+    """
+    logger = logging.getLogger(__name__)
+    tests = qibuild.ctest.get_tests(project, test_name=args.test_name)
+    if not args.timings:
+        logger.info("Tests for %s:", project.name)
+        for (name, _cmd, _properties) in tests:
+            print "  ", name
+        return
+    durations = qibuild.ctest.get_durations(project)
+    expected = qibuild.ctest.get_expected_durations(tests, durations)
+    num_jobs = max(args.num_jobs, 1)
+    (total, schedule, critical_path) = \
+        qibuild.ctest.predict_schedule(tests, expected, num_jobs)
+    logger.info("Tests for %s (expected duration with -j%i: %.2fs)",
+                project.name, num_jobs, total)
+    max_len = max([len(x[0]) for x in tests] + [0])
+    for (name, _cmd, _properties) in tests:
+        (start, end) = schedule[name]
+        if durations.get(name) is None:
+            known = "?"
+        else:
+            known = " "
+        line = "  %s %s %8.2fs%s  [%.2f - %.2f]" % (
+            "*" if name in critical_path else " ",
+            name.ljust(max_len), expected[name], known, start, end)
+        print line
+    print
+    print "*: on the critical path, ?: never ran, duration is a guess"
@@ -0,0 +1,216 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" Compressed build logs, with an index of the errors and warnings
+
+A log is a gzip file made of several independent gzip members:
+it can be read with zcat, but also from the beginning of any member
+without decompressing what comes before.
+
+Next to it, a small text index has a line for each error or warning::
+
+    <kind> <line number> <offset of the member> <offset in the member>
+
+so that errors can be found without reading the whole log.
+
+"""
+
+import os
+import re
+import gzip
+import zlib
+import logging
+
+import qibuild.sh
+
+LOGGER = logging.getLogger(__name__)
+
+# Where the logs are written, in the build directory
+LOG_DIR = "qibuild-logs"
+
+# Uncompressed size of each gzip member
+MEMBER_SIZE = 256 * 1024
+
+# Incomplete lines longer than this are written as they are
+MAX_PENDING_SIZE = 64 * 1024
+
+# gcc, clang, MSVC, make and cmake errors and warnings
+ERROR_RE = r"\b(fatal )?error( [A-Z]+\d+)?:|\*\*\*.*\bError \d+|CMake Error"
+WARNING_RE = r"\bwarning( [A-Z]+\d+)?:|CMake Warning"
+LINE_RE = re.compile("(?P<error>%s)|(?P<warning>%s)" % (ERROR_RE, WARNING_RE),
+                     re.IGNORECASE)
+
+
+def get_log_path(build_dir, step):
+    """ Where the log of a step (configure, build ...) is written """
+    return os.path.join(build_dir, LOG_DIR, step + ".log.gz")
+
+
+def get_index_path(log_path):
+    """ Where the index of a log is written """
+    if log_path.endswith(".gz"):
+        log_path = log_path[:-3]
+    return log_path + ".idx"
+
+
+class BuildLog:
+    """ Write a compressed log, and its index
+
+    Output is written by chunks, as read by
+    :py:func:`qibuild.command.call`. Lines of each stream are kept
+    together, so that lines coming from stdout and stderr are not
+    mixed, unless they are longer than MAX_PENDING_SIZE (output
+    without newlines, like progress bars)
+
+    """
+    def __init__(self, path):
+        self.path = path
+        qibuild.sh.mkdir(os.path.dirname(path), recursive=True)
+        self._fp = open(path, "wb")
+        self._index = open(get_index_path(path), "w")
+        self._pending = dict()
+        self._member = list()
+        self._member_size = 0
+        self._member_offset = 0
+        self._num_lines = 0
+
+    def write(self, chunk, stream="stdout"):
+        """ Add a chunk of output read from a stream """
+        pending = self._pending.get(stream, "") + chunk
+        end = pending.rfind("\n") + 1
+        if len(pending) - end > MAX_PENDING_SIZE:
+            end = len(pending)
+        self._pending[stream] = pending[end:]
+        if end:
+            self._add(pending[:end])
+
+    def _add(self, lines):
+        """ Add some lines to the current member. The last one
+        is only incomplete when it is too long
+
+        """
+        last = -1
+        for match in LINE_RE.finditer(lines):
+            start = lines.rfind("\n", 0, match.start()) + 1
+            if start == last:
+                # Only index each line once
+                continue
+            last = start
+            if match.group("error"):
+                kind = "error"
+            else:
+                kind = "warning"
+            line_number = self._num_lines + lines.count("\n", 0, start) + 1
+            self._index.write("%s %i %i %i\n" % (kind, line_number,
+                self._member_offset, self._member_size + start))
+        self._num_lines += lines.count("\n")
+        self._member.append(lines)
+        self._member_size += len(lines)
+        if self._member_size >= MEMBER_SIZE:
+            self._flush_member()
+
+    def _flush_member(self):
+        """ Compress the current member and start a new one """
+        if not self._member:
+            return
+        member = gzip.GzipFile(filename="", mode="wb", fileobj=self._fp)
+        member.write("".join(self._member))
+        member.close()
+        self._member = list()
+        self._member_size = 0
+        self._member_offset = self._fp.tell()
+
+    def close(self):
+        """ Write what is left, and close the files """
+        for stream in sorted(self._pending):
+            if self._pending[stream]:
+                self._add(self._pending[stream] + "\n")
+        self._pending = dict()
+        self._flush_member()
+        self._fp.close()
+        self._index.close()
+
+
+def read_index(log_path, kinds=None):
+    """ Read the index of a log
+
+    :param kinds: if given, only return these kinds of lines
+                  ("error", "warning")
+    :return: a list of (kind, line number, member offset, offset in member)
+
+    """
+    res = list()
+    with open(get_index_path(log_path), "r") as fp:
+        for line in fp:
+            try:
+                (kind, line_number, member_offset, offset) = line.split()
+                entry = (kind, int(line_number), int(member_offset), int(offset))
+            except ValueError:
+                # The build may have been interrupted
+                continue
+            if kinds is None or kind in kinds:
+                res.append(entry)
+    return res
+
+
+def read_member(fp, member_offset):
+    """ Decompress the gzip member starting at member_offset """
+    fp.seek(member_offset)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    res = list()
+    while not decompressor.unused_data:
+        data = fp.read(64 * 1024)
+        if not data:
+            break
+        res.append(decompressor.decompress(data))
+    return "".join(res)
+
+
+def find_lines(log_path, kinds=None, context=0):
+    """ Find the errors and the warnings of a log, using its index.
+    Only the members containing them are decompressed.
+
+    :param context: number of lines to return before and after
+                    each line (only from the same member)
+    :return: a list of (kind, line number, lines) tuples,
+             lines being a list of (line number, text) for the
+             line and its context
+
+    """
+    res = list()
+    members = dict()
+    with open(log_path, "rb") as fp:
+        for (kind, line_number, member_offset, offset) in \
+                read_index(log_path, kinds=kinds):
+            member = members.get(member_offset)
+            if member is None:
+                # Only keep the last member in memory
+                members = {member_offset : read_member(fp, member_offset)}
+                member = members[member_offset]
+            start = offset
+            before = 0
+            while before < context and start > 0:
+                start = member.rfind("\n", 0, start - 1) + 1
+                before += 1
+            end = offset
+            for i in range(context + 1):
+                end = member.find("\n", end) + 1
+                if end == 0 or end == len(member):
+                    end = len(member)
+                    break
+            lines = member[start:end].splitlines()
+            first = line_number - before
+            res.append((kind, line_number,
+                        [(first + i, x) for (i, x) in enumerate(lines)]))
+    return res
+
+
+def read_log(log_path):
+    """ Iterate over the lines of a whole log """
+    fp = gzip.open(log_path, "rb")
+    try:
+        for line in fp:
+            yield line
+    finally:
+        fp.close()
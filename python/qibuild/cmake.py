@@ -1,5 +1,8 @@
 import os
 import re
+import shutil
+import hashlib
+import tempfile
 import subprocess
 import logging
 
@@ -43,13 +46,43 @@ def get_known_cmake_generators():
         res.append(generator.strip())
     return res
 
-def cmake(source_dir, build_dir, cmake_args, clean_first=True, env=None):
+# Cache entries that only depend on the toolchain, and can
+# be shared between all the projects of a worktree.
+# The results of the HAVE_* checks are not part of it: they depend
+# on the include and link flags of each project.
+# (see :py:func:`write_seed`)
+SEED_ENTRIES_RE = re.compile(r"""^(
+    CMAKE_(C|CXX)_COMPILER(_\w+)? |
+    CMAKE_(ADDR2LINE|AR|DLLTOOL|LINKER|MAKE_PROGRAM|NM|OBJCOPY|OBJDUMP|RANLIB|READELF|STRIP)
+)$""", re.VERBOSE)
+
+# Environment variables used to choose the compilers
+SEED_ENV_VARS = ["CC", "CXX"]
+
+# Files written by cmake in CMakeFiles/<cmake version>/ with the results
+# of the system and compiler identification, and of the ABI and
+# features checks. They only depend on the toolchain too.
+SEED_PLATFORM_FILES_RE = re.compile(r"^CMake(System|\w+Compiler)\.cmake$")
+
+def cmake(source_dir, build_dir, cmake_args, clean_first=True, env=None,
+          out=None, seed_path=None, log_path=None):
     """Call cmake with from a build dir for a source dir.
     cmake_args are added on the command line.
 
     If clean_first is True, we will remove cmake-generated files.
     Useful when dependencies have changed.
 
+    out and log_path are passed to :py:func:`qibuild.command.call`
+
+    If seed_path is not None, it is used to share the results of
+    the compiler probes between projects: the first successful
+    run writes the toolchain-related entries of the cache there, and
+    keeps the platform files of the build directory next to it. The
+    next runs copy the platform files in their build directory and
+    pre-load the entries with ``cmake -C``, so that cmake does not
+    identify and check the compilers again, as long as the generator,
+    the toolchain file, the compilers and cmake itself have not changed.
+
     """
     if not os.path.exists(source_dir):
         raise Exception("source dir: %s does not exist, aborting")
@@ -83,10 +116,25 @@ def cmake(source_dir, build_dir, cmake_args, clean_first=True, env=None):
     root_cmake = os.path.join(source_dir, "CMakeLists.txt")
     check_root_cmake_list(root_cmake, os.path.basename(source_dir))
 
+    cmd = ["cmake"] + cmake_args
+    seed_key = None
+    use_seed = False
+    if seed_path:
+        seed_key = get_seed_key(cmake_args, env=env)
+        use_seed = is_seed_valid(seed_path, seed_key)
+        if use_seed:
+            copy_seed_platform_files(seed_path, build_dir)
+            cmd += ["-C", seed_path]
+
     # Add path to source to the list of args, and set buildir for
     # the current working dir.
-    cmake_args += [source_dir]
-    qibuild.command.call(["cmake"] + cmake_args, cwd=build_dir, env=env)
+    cmd += [source_dir]
+    qibuild.command.call(cmd, cwd=build_dir, env=env,
+                         out=out, log_path=log_path)
+
+    if seed_path and not use_seed:
+        cache = os.path.join(build_dir, "CMakeCache.txt")
+        write_seed(seed_path, seed_key, cache, env=env)
 
 
 
@@ -114,6 +162,183 @@ def read_cmake_cache(cache_path):
     return res
 
 
+def read_cmake_cache_entries(cache_path):
+    """ Read a CMakeCache.txt file, returning a list of
+    (name, type, value) tuples
+
+    """
+    res = list()
+    with open(cache_path, "r") as fp:
+        for line in fp:
+            match = re.match(r"^([\w\-\.]+):(\w+)=(.*)$", line.rstrip("\r\n"))
+            if match:
+                res.append(match.groups())
+    return res
+
+
+def get_seed_key(cmake_args, env=None):
+    """ Get a key identifying the compiler probes results:
+    it depends on the generator, on the contents of the toolchain
+    file, and on the CC and CXX environment variables
+
+    """
+    sha = hashlib.sha1()
+    generator = ""
+    toolchain_file = None
+    for (i, arg) in enumerate(cmake_args):
+        if arg == "-G" and i + 1 < len(cmake_args):
+            generator = cmake_args[i+1]
+        if arg.startswith("-DCMAKE_TOOLCHAIN_FILE="):
+            toolchain_file = arg.split("=", 1)[1]
+    sha.update("generator: %s\n" % generator)
+    if toolchain_file and os.path.exists(toolchain_file):
+        with open(toolchain_file, "r") as fp:
+            sha.update("toolchain: %s\n" % fp.read())
+    if env is None:
+        env = os.environ
+    for var in SEED_ENV_VARS:
+        sha.update("%s: %s\n" % (var, env.get(var, "")))
+    return sha.hexdigest()
+
+
+def _stat_program(path):
+    """ Return a string describing a program,
+    so that we know when it changes
+
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return "missing"
+    return "%s %s" % (int(stat.st_mtime), stat.st_size)
+
+
+def is_seed_valid(seed_path, seed_key):
+    """ Check that a seed file written by :py:func:`write_seed` exists,
+    was written with the same key, and that the compilers have not
+    changed since then
+
+    """
+    if not os.path.exists(seed_path):
+        return False
+    key_found = False
+    with open(seed_path, "r") as fp:
+        for line in fp:
+            if not line.startswith("#"):
+                continue
+            match = re.match(r"^# key: (\w+)$", line.strip())
+            if match:
+                if match.group(1) != seed_key:
+                    return False
+                key_found = True
+            match = re.match(r"^# program: (.*) \| (.*)$", line.strip())
+            if match and _stat_program(match.group(1)) != match.group(2):
+                return False
+    return key_found
+
+
+def get_seed_platform_dir(seed_path):
+    """ Where the platform files of the seed are kept """
+    return os.path.splitext(seed_path)[0] + "-platform"
+
+
+def copy_seed_platform_files(seed_path, build_dir):
+    """ Copy the platform files kept by :py:func:`write_seed` to
+    build_dir/CMakeFiles. Missing files are simply probed again by cmake
+
+    """
+    platform_dir = get_seed_platform_dir(seed_path)
+    if not os.path.isdir(platform_dir):
+        return
+    for version in os.listdir(platform_dir):
+        dest = os.path.join(build_dir, "CMakeFiles", version)
+        qibuild.sh.mkdir(dest, recursive=True)
+        src = os.path.join(platform_dir, version)
+        for filename in os.listdir(src):
+            try:
+                shutil.copy(os.path.join(src, filename), dest)
+            except (IOError, OSError), e:
+                LOGGER.debug("Could not copy %s: %s", filename, e)
+
+
+def _write_seed_platform_files(seed_path, build_dir):
+    """ Keep the platform files of build_dir next to the seed
+
+    :return: whether some files were found
+
+    """
+    cmake_files = os.path.join(build_dir, "CMakeFiles")
+    if not os.path.isdir(cmake_files):
+        return False
+    platform_dir = get_seed_platform_dir(seed_path)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(seed_path),
+                               suffix=".tmp")
+    found = False
+    for version in os.listdir(cmake_files):
+        src = os.path.join(cmake_files, version)
+        if not re.match(r"^\d+\.\d+", version) or not os.path.isdir(src):
+            continue
+        for filename in os.listdir(src):
+            if not SEED_PLATFORM_FILES_RE.match(filename):
+                continue
+            qibuild.sh.mkdir(os.path.join(tmp_dir, version))
+            shutil.copy(os.path.join(src, filename),
+                        os.path.join(tmp_dir, version))
+            found = True
+    qibuild.sh.rm(platform_dir)
+    try:
+        os.rename(tmp_dir, platform_dir)
+    except OSError:
+        # Written by an other project at the same time
+        qibuild.sh.rm(tmp_dir)
+    return found
+
+
+def write_seed(seed_path, seed_key, cache_path, env=None):
+    """ Write the toolchain-related entries of a cmake cache in a
+    file suitable for ``cmake -C``, and keep the platform files
+    of the build directory (see :py:func:`copy_seed_platform_files`)
+
+    """
+    if not os.path.exists(cache_path):
+        return
+    lines = [
+        "#############################################\n",
+        "#QIBUILD AUTOGENERATED FILE. DO NOT EDIT.\n",
+        "#############################################\n",
+        "# key: %s\n" % seed_key,
+    ]
+    entries = list()
+    qibuild.sh.mkdir(os.path.dirname(seed_path), recursive=True)
+    # The platform files are only valid for this version of cmake
+    cmake_path = qibuild.command.find_program("cmake", env=env)
+    if cmake_path:
+        lines.append("# program: %s | %s\n" % (cmake_path,
+                                               _stat_program(cmake_path)))
+    if _write_seed_platform_files(seed_path, os.path.dirname(cache_path)):
+        # Otherwise cmake removes the platform files, because
+        # the cache is new
+        entries.append('set(CMAKE_PLATFORM_INFO_INITIALIZED "1" '
+                       'CACHE INTERNAL "")\n')
+    for (name, type_, value) in read_cmake_cache_entries(cache_path):
+        if not SEED_ENTRIES_RE.match(name):
+            continue
+        if not value or value.endswith("-NOTFOUND"):
+            continue
+        if name.endswith("_COMPILER"):
+            lines.append("# program: %s | %s\n" % (value, _stat_program(value)))
+        value = value.replace("\\", "\\\\").replace('"', '\\"')
+        entries.append('set(%s "%s" CACHE %s "")\n' % (name, value, type_))
+    # Several projects may be configured at the same time,
+    # so make sure the seed is never half-written
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(seed_path),
+                                      suffix=".tmp")
+    with os.fdopen(fd, "w") as fp:
+        fp.writelines(lines + entries)
+    qibuild.sh.rm(seed_path)
+    os.rename(tmp_path, seed_path)
+
+
 def check_root_cmake_list(cmake_list_file, project_name):
     """Check that the root CMakeLists.txt
     is correct.
@@ -8,6 +8,9 @@
 
 import os
 import sys
+import errno
+import select
+import collections
 import contextlib
 import logging
 import subprocess
@@ -24,27 +27,62 @@ LOGGER = logging.getLogger(__name__)
 # global variable
 CONFIG = dict()
 
+# Size of the chunks read from the output of the processes
+CHUNK_SIZE = 64 * 1024
+
+# What is displayed when a command fails in quiet mode:
+# the last TAIL_LINES lines, with at most TAIL_BYTES bytes
+TAIL_LINES = 300
+TAIL_BYTES = 1024 * 1024
+
+# How much of the output of a ProcessThread is kept in
+# memory when it is written to a log file
+OUTPUT_HEAD_BYTES = 16 * 1024
+OUTPUT_TAIL_BYTES = 64 * 1024
+
 class ProcessThread(threading.Thread):
     """ A simple way to run commands.
 
     The thread will terminate when the command terminates
 
-    The full log is available in self.out, and the subprocess.Popen
+    The log is available in self.out, and the subprocess.Popen
     object in self.process
 
+    If log_path is given, the full log is written there, and
+    self.out only contains its first OUTPUT_HEAD_BYTES and its
+    last OUTPUT_TAIL_BYTES bytes, so that chatty commands do not
+    use too much memory.
+
     """
-    def __init__(self, cmd, name=None, cwd=None, env=None):
+    def __init__(self, cmd, name=None, cwd=None, env=None, log_path=None):
         if name is None:
             thread_name = "ProcessThread"
         else:
             thread_name = "ProcessThread<%s>" % name
         threading.Thread.__init__(self, name=thread_name)
+        # The output is read until EOF: if the command is killed
+        # while one of its children still holds the pipe, this
+        # thread must not prevent the program from exiting
+        self.daemon = True
         self.cmd = cmd
         self.cwd = cwd
         self.env = env
-        self.out = ""
+        self.log_path = log_path
         self.process = None
         self.exception = ""
+        self._head = ""
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._skipped = 0
+
+    @property
+    def out(self):
+        """ The output of the command, truncated if log_path was given """
+        tail = "".join(self._tail)
+        if not self._skipped:
+            return self._head + tail
+        return "%s\n[... %i bytes skipped, full log in %s ...]\n%s" % (
+            self._head, self._skipped, self.log_path, tail)
 
     def run(self):
         try:
@@ -57,8 +95,48 @@ class ProcessThread(threading.Thread):
             self.exception = e
             return
 
-        while self.process.poll() is None:
-            self.out += self.process.stdout.readline()
+        log = None
+        if self.log_path:
+            qibuild.sh.mkdir(os.path.dirname(self.log_path), recursive=True)
+            log = open(self.log_path, "wb")
+        try:
+            fd = self.process.stdout.fileno()
+            while True:
+                chunk = os.read(fd, CHUNK_SIZE)
+                if not chunk:
+                    break
+                if log:
+                    log.write(chunk)
+                self._add_output(chunk)
+        finally:
+            if log:
+                log.close()
+            self.process.stdout.close()
+        self.process.wait()
+
+    def _add_output(self, chunk):
+        """ Keep the beginning and the end of the output """
+        if not self.log_path:
+            self._tail.append(chunk)
+            return
+        if len(self._head) < OUTPUT_HEAD_BYTES:
+            size = OUTPUT_HEAD_BYTES - len(self._head)
+            self._head += chunk[:size]
+            chunk = chunk[size:]
+            if not chunk:
+                return
+        self._tail.append(chunk)
+        self._tail_size += len(chunk)
+        while self._tail_size > OUTPUT_TAIL_BYTES:
+            extra = self._tail_size - OUTPUT_TAIL_BYTES
+            first = self._tail.popleft()
+            if len(first) > extra:
+                self._tail.appendleft(first[extra:])
+                removed = extra
+            else:
+                removed = len(first)
+            self._tail_size -= removed
+            self._skipped += removed
 
 
 class CommandFailedException(Exception):
@@ -107,19 +185,53 @@ class NotInPath(Exception):
         return mess
 
 
+# (executable, PATH, PATHEXT) -> (full path, stat of the full path)
+_PROGRAMS = dict()
+_PROGRAMS_LOCK = threading.Lock()
+
 def find_program(executable, env=None):
     """Get the full path of an executable by
     looking at PATH environment variable
     (and PATHEXT on windows)
 
+    Results are cached, using the executable and the PATH as key.
+    A cached result is used as long as the file it points to
+    still exists and has not changed (size, mtime, mode and inode).
+    Programs that were not found are not cached.
+
     :return: None if program was not found,
       the full path to executable otherwize
     """
-    full_path = None
     if env:
         env_path = env.get("PATH", "")
     else:
         env_path = os.environ["PATH"]
+    key = (executable, env_path, os.environ.get("PATHEXT"))
+    with _PROGRAMS_LOCK:
+        cached = _PROGRAMS.get(key)
+    if cached:
+        (full_path, stat) = cached
+        if _stat_program(full_path) == stat:
+            return full_path
+    full_path = _find_program(executable, env_path)
+    if full_path:
+        with _PROGRAMS_LOCK:
+            _PROGRAMS[key] = (full_path, _stat_program(full_path))
+    return full_path
+
+
+def _stat_program(full_path):
+    """ What is used to check that a cached program has not changed """
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime, stat.st_mode, stat.st_ino)
+
+
+def _find_program(executable, env_path):
+    """ Look for executable in each path of env_path """
+    full_path = None
     for path in env_path.split(os.pathsep):
         path = qibuild.sh.to_native_path(path)
         full_path = os.path.join(path, executable)
@@ -134,13 +246,20 @@ def find_program(executable, env=None):
     return None
 
 
+def clear_programs_cache():
+    """ Forget every program found by :py:func:`find_program` """
+    with _PROGRAMS_LOCK:
+        _PROGRAMS.clear()
+
+
 def check_is_in_path(executable, build_env=None):
     """Check that the given executable is to be found in %PATH%"""
     if find_program(executable, env=build_env) is None:
         raise NotInPath(executable, env=build_env)
 
 
-def call(cmd, cwd=None, env=None, ignore_ret_code=False):
+def call(cmd, cwd=None, env=None, ignore_ret_code=False, out=None,
+         log_path=None):
     """ Execute a command line.
 
     If ignore_ret_code is False:
@@ -169,7 +288,19 @@ def call(cmd, cwd=None, env=None, ignore_ret_code=False):
     does not work on windows with python < 2.7, so it is simply
     disabled, and you have a normal behavior instead.
 
+    If out is not None, it should be a file-like object, and what
+    would have been written to sys.stdout and sys.stderr is written
+    to it instead. (Useful when several commands are run in parallel)
+
+    If log_path is not None, the whole output is also written there,
+    compressed, with an index of the errors and the warnings.
+    See :py:mod:`qibuild.buildlog`
+
     """
+    if out is None:
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+    else:
+        (stdout, stderr) = (out, out)
     exe_full_path = find_program(cmd[0], env=env)
     if not exe_full_path:
         raise NotInPath(cmd[0], env=env)
@@ -182,11 +313,11 @@ def call(cmd, cwd=None, env=None, ignore_ret_code=False):
             raise Exception("Trying to to run %s in non-existing %s" %
                 (" ".join(cmd), cwd))
 
-    ring_buffer = RingBuffer(300)
+    tail = TailBuffer(TAIL_LINES, TAIL_BYTES)
 
     returncode = 0
     minimal_write = CONFIG.get("quiet", False)
-    if sys.platform.startswith("win") and sys.version_info < (2, 7):
+    if sys.platform.startswith("win") and sys.version_info < (2, 7) and out is None:
         returncode = subprocess.call(cmd, env=env, cwd=cwd)
     else:
         # This code won't work on windows with python < 2.7
@@ -194,27 +325,38 @@ def call(cmd, cwd=None, env=None, ignore_ret_code=False):
         if not sys.stdout.isatty() or not sys.stderr.isatty():
             minimal_write = True
 
-        for(out, err) in cmdline.execute():
-            if out is not None:
-                if not minimal_write:
-                    sys.stdout.write(out)
-                ring_buffer.append(out)
-            if err is not None:
-                if not minimal_write:
-                    sys.stderr.write(err)
-                ring_buffer.append(err)
+        log = None
+        if log_path:
+            log = qibuild.buildlog.BuildLog(log_path)
+        try:
+            for (out_chunk, err_chunk) in cmdline.execute():
+                if out_chunk is not None:
+                    if not minimal_write:
+                        stdout.write(out_chunk)
+                    tail.append(out_chunk, "stdout")
+                    if log:
+                        log.write(out_chunk, "stdout")
+                if err_chunk is not None:
+                    if not minimal_write:
+                        stderr.write(err_chunk)
+                    tail.append(err_chunk, "stderr")
+                    if log:
+                        log.write(err_chunk, "stderr")
+        finally:
+            if log:
+                log.close()
         returncode = cmdline.returncode
 
-    sys.stdout.flush()
-    sys.stderr.flush()
+    stdout.flush()
+    stderr.flush()
     if ignore_ret_code:
         return returncode
 
     if returncode != 0:
         if minimal_write:
-            lines = ring_buffer.get()
-            for line in lines:
-                sys.stdout.write(line)
+            stdout.write(tail.get())
+        if log_path:
+            stdout.write("Full log in %s\n" % log_path)
         # Raise correct exception
         raise CommandFailedException(cmd, returncode, cwd)
 
@@ -277,84 +419,167 @@ class CommandLine:
 
     def execute(self):
         """Execute the command, and return a generator for iterating over
-        the output written to the standard output and error streams.
+        the output written to the standard output and error streams,
+        as (out_chunk, err_chunk) tuples, one of them being None.
+
+        Output is read by chunks of at most CHUNK_SIZE bytes, as soon
+        as it is available, so chunks do not necessarily end with a
+        new line.
 
         """
-        def reader(pipe, pipe_name, queue):
-            "To be called in a thread"
-            while pipe and not pipe.closed:
-                line = pipe.readline()
-                if line == '':
-                    break
-                queue.put((pipe_name, line))
-            if not pipe.closed:
-                pipe.close()
         LOGGER.debug("Starting: %s", " ".join(self.cmd))
         process =  subprocess.Popen(
             self.cmd,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             cwd=self.cwd,
             env=self.env)
-        queue = Queue.Queue()
+        if os.name == "posix":
+            chunks = _read_with_poll(process)
+        else:
+            # select() does not work with pipes on windows
+            chunks = _read_with_threads(process)
+        for chunk in chunks:
+            yield chunk
+        self.returncode = process.wait()
 
-        pipe_out = threading.Thread(target=reader,
-            args=(process.stdout, 'stdout', queue))
-        pipe_err = threading.Thread(target=reader,
-            args=(process.stderr, 'stderr', queue))
 
-        pipe_out.start()
-        pipe_err.start()
+def _read_with_poll(process):
+    """ Read the output of a process without any thread, using
+    select.poll (or select.select when poll is not available)
 
+    """
+    streams = {process.stdout.fileno() : "stdout",
+               process.stderr.fileno() : "stderr"}
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        for fd in streams:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        wait = lambda: [x[0] for x in poller.poll()]
+    else:
+        poller = None
+        wait = lambda: select.select(list(streams), [], [])[0]
+    while streams:
+        try:
+            ready = wait()
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            if fd not in streams:
+                continue
+            chunk = os.read(fd, CHUNK_SIZE)
+            if not chunk:
+                # End of file
+                if poller:
+                    poller.unregister(fd)
+                del streams[fd]
+                continue
+            if streams[fd] == "stderr":
+                yield (None, chunk)
+            else:
+                yield (chunk, None)
+    process.stdout.close()
+    process.stderr.close()
+
+
+def _read_with_threads(process):
+    """ Read the output of a process with one thread per pipe.
+    Each thread blocks on a read, and the chunks are sent back
+    through a queue
+
+    """
+    queue = Queue.Queue()
+    def reader(pipe, pipe_name):
+        "To be called in a thread"
+        fd = pipe.fileno()
         while True:
-            if process.poll() is not None and self.returncode is None:
-                self.returncode = process.returncode
-            try:
-                name, line = queue.get(block=True, timeout=.01)
-                if name == "stderr":
-                    yield(None, line)
-                else:
-                    yield(line, None)
-            except Queue.Empty:
-                if self.returncode is not None:
-                    break
+            chunk = os.read(fd, CHUNK_SIZE)
+            if not chunk:
+                break
+            queue.put((pipe_name, chunk))
+        pipe.close()
+        queue.put((pipe_name, None))
+    threads = list()
+    for (pipe, pipe_name) in [(process.stdout, "stdout"),
+                              (process.stderr, "stderr")]:
+        thread = threading.Thread(target=reader, args=(pipe, pipe_name))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    running = len(threads)
+    while running:
+        (pipe_name, chunk) = queue.get()
+        if chunk is None:
+            running -= 1
+        elif pipe_name == "stderr":
+            yield (None, chunk)
+        else:
+            yield (chunk, None)
+    for thread in threads:
+        thread.join()
 
-        pipe_out.join()
-        pipe_err.join()
 
+class TailBuffer:
+    """ Keep the last lines written by a process, using
+    a bounded amount of memory
 
-class RingBuffer:
-    """Quick'n dirty implementation of a ring buffer
+    Chunks are stored as they are read, and the oldest ones are
+    dropped as soon as the other ones contain at least max_lines lines,
+    or max_bytes bytes.
 
-    >>> rb = RingBuffer(4)
-    >>> rb.append(1)
-    >>> rb.get()
-    [1]
-    >>> rb.append(2); rb.append(3); rb.append(4)
-    >>> rb.get()
-    [1, 2, 3, 4]
-    >>> rb.append(5)
-    >>> rb.get()
-    [2, 3, 4, 5]
-    >>> rb.append(6)
-    >>> rb.get()
-    [3, 4, 5, 6]
+    Each stream has its own pending incomplete line, so that lines
+    coming from stdout and stderr are not mixed. Only the last
+    max_bytes bytes of a pending line are kept, so that output
+    without newlines (progress bars ...) does not use more memory.
+
+    >>> tail = TailBuffer(2, 1024)
+    >>> tail.append("a\\nb", "stdout")
+    >>> tail.append("oops\\n", "stderr")
+    >>> tail.append("\\nc\\n", "stdout")
+    >>> tail.get()
+    'b\\nc\\n'
 
     """
-    def __init__(self, size):
-        self.size = size
-        self._data = list()
-        self._full = False
-        self._index = 0
-
-    def append(self, x):
-        if self._full:
-            self._data[self._index] = x
-        else:
-            self._data.append(x)
-            if len(self._data) == self.size:
-                self._full = True
-        self._index = (self._index + 1) % self.size
+    def __init__(self, max_lines, max_bytes):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        # (chunk, number of lines in chunk)
+        self._chunks = collections.deque()
+        self._lines = 0
+        self._bytes = 0
+        self._pending = dict()
+
+    def append(self, chunk, stream="stdout"):
+        """ Add a chunk of output read from a stream """
+        pending = self._pending.get(stream, "") + chunk
+        end = pending.rfind("\n") + 1
+        self._pending[stream] = pending[end:][-self.max_bytes:]
+        if end:
+            self._add(pending[:end])
+
+    def _add(self, lines):
+        """ Add some complete lines, dropping the oldest ones """
+        count = lines.count("\n")
+        self._chunks.append((lines, count))
+        self._lines += count
+        self._bytes += len(lines)
+        while len(self._chunks) > 1:
+            (first, first_count) = self._chunks[0]
+            if self._lines - first_count < self.max_lines and \
+               self._bytes - len(first) < self.max_bytes:
+                break
+            self._chunks.popleft()
+            self._lines -= first_count
+            self._bytes -= len(first)
 
     def get(self):
-        return self._data[self._index:] + \
-               self._data[:self._index]
+        """ The last max_lines lines (at most max_bytes bytes) """
+        for stream in sorted(self._pending):
+            if self._pending[stream]:
+                self._add(self._pending[stream] + "\n")
+                self._pending[stream] = ""
+        res = "".join(x[0] for x in self._chunks)
+        res = res[-self.max_bytes:]
+        lines = res.splitlines(True)
+        return "".join(lines[-self.max_lines:])
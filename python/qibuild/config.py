@@ -29,6 +29,14 @@ def get_global_cfg_path():
     res = qibuild.sh.to_native_path(res)
     return res
 
+def _parse_xml(xml_path):
+    """ Parse a XML file, used with :py:func:`qibuild.configcache.read`
+
+    """
+    tree = etree.ElementTree()
+    tree.parse(xml_path)
+    return tree
+
 def indent(text, num=1):
     """ Helper for __str__ methods
 
@@ -486,7 +494,7 @@ class QiBuildConfig:
         if not cfg_path:
             cfg_path = get_global_cfg_path()
         try:
-            self.tree.parse(cfg_path)
+            self.tree = qibuild.configcache.read(cfg_path, _parse_xml)
         except Exception, e:
             mess  = "Could not parse config from %s\n" % cfg_path
             mess += "Error was: %s" % str(e)
@@ -527,7 +535,7 @@ class QiBuildConfig:
 
     def read_local_config(self, local_xml_path):
         """ Apply a local configuration """
-        local_tree = etree.parse(local_xml_path)
+        local_tree = qibuild.configcache.read(local_xml_path, _parse_xml)
         self.local.parse(local_tree)
         self.merge_configs()
 
@@ -541,6 +549,7 @@ class QiBuildConfig:
         else:
             xml_indent(tree.getroot())
             tree.write(local_xml_path)
+        qibuild.configcache.invalidate(local_xml_path)
 
     def merge_configs(self):
         """ Merge various configs
@@ -691,6 +700,7 @@ class QiBuildConfig:
         else:
             xml_indent(tree.getroot())
             tree.write(xml_path)
+        qibuild.configcache.invalidate(xml_path)
 
     def __str__(self):
         res = ""
@@ -831,6 +841,31 @@ class ProjectConfig:
                 res += "\n"
         return res
 
+def _parse_project_config(cfg_path):
+    """ Parse a qiproject.xml file, used with
+    :py:func:`qibuild.configcache.read`
+
+    """
+    res = ProjectConfig()
+    res.read(cfg_path)
+    return res
+
+def read_project_config(cfg_path):
+    """ Return a :py:class:`ProjectConfig` read from the given
+    qiproject.xml file.
+
+    Each file is parsed only once per process (see
+    :py:mod:`qibuild.configcache`), so WorkTree, Toc and QiDocBuilder
+    can all share the same parse.
+    (use the ``tree`` attribute to read other sections)
+
+    Note that the returned object is shared, and thus should
+    not be modified.
+
+    """
+    return qibuild.configcache.read(cfg_path, _parse_project_config)
+
+
 def xml_indent(elem, level=0):
     """ Poor man's pretty print for elementTree
 
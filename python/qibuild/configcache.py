@@ -0,0 +1,91 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" Parse each configuration file only once per process.
+
+The result of the parsing is kept with the mtime and the size
+of the file, and parsed again only when they change, or when
+the file is written by qibuild (see :py:func:`invalidate`).
+
+The objects returned are shared: callers must not modify them.
+To change a configuration file, parse it again, write it, and
+call :py:func:`invalidate`.
+
+"""
+
+import os
+import threading
+import ConfigParser
+
+# (path, parse function) -> (stat, result)
+_CACHE = dict()
+_LOCK = threading.Lock()
+
+
+def _stat(path):
+    """ What is used to know if a file has changed.
+    None if it does not exist
+
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def read(path, parse):
+    """ Return parse(path), parsing the file only if it has
+    changed since the last call.
+    File objects are always parsed.
+
+    """
+    if not isinstance(path, basestring):
+        return parse(path)
+    path = os.path.abspath(path)
+    key = (path, parse)
+    stat = _stat(path)
+    with _LOCK:
+        cached = _CACHE.get(key)
+    if cached and cached[0] == stat:
+        return cached[1]
+    res = parse(path)
+    with _LOCK:
+        _CACHE[key] = (stat, res)
+    return res
+
+
+def invalidate(path):
+    """ Forget everything parsed from a file.
+    Should be called after writing it.
+
+    """
+    if not isinstance(path, basestring):
+        return
+    path = os.path.abspath(path)
+    with _LOCK:
+        for key in _CACHE.keys():
+            if key[0] == path:
+                del _CACHE[key]
+
+
+def clear():
+    """ Forget everything """
+    with _LOCK:
+        _CACHE.clear()
+
+
+def parse_cfg(path):
+    """ Parse a .cfg file, returns a RawConfigParser.
+    A missing file gives an empty configuration
+
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(path)
+    return config
+
+
+def read_cfg(path):
+    """ Shortcut for read(path, parse_cfg) """
+    return read(path, parse_cfg)
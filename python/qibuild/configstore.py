@@ -197,8 +197,7 @@ class ConfigStore:
     def read(self, filename):
         """ read a configuration file """
         self.logger.debug("loading: %s", filename)
-        parser = ConfigParser.RawConfigParser()
-        parser.read(filename)
+        parser = qibuild.configcache.read_cfg(filename)
         parsed_sections = parser.sections()
         for parsed_section in parsed_sections:
             splitted_section = shlex.split(parsed_section)
@@ -267,6 +266,7 @@ def update_config(config_path, section, key, value):
     qibuild.sh.mkdir(os.path.dirname(config_path), recursive=True)
     with open(config_path, "w") as config_file:
         parser.write(config_file)
+    qibuild.configcache.invalidate(config_path)
 
 
 
@@ -14,12 +14,38 @@ import datetime
 import errno
 import signal
 import shlex
+import json
+import hashlib
 import logging
+import threading
+import Queue
+from xml.etree import ElementTree as etree
 
 import qibuild
+from qibuild.durations import Durations
 
 LOGGER = logging.getLogger(__name__)
 
+# Same default as ctest
+DEFAULT_TIMEOUT = 1500
+
+# Name of the file storing the durations of the tests,
+# in the build directory
+DURATIONS_FILE = "qibuild-test-durations.json"
+
+# Expected duration of a test when nothing is known
+DEFAULT_DURATION = 10.0
+
+# Name of the file storing the keys and the results of the
+# tests that passed, in the build directory
+RESULT_CACHE_FILE = "qibuild-test-cache.json"
+
+SHARED_LIB_RE = re.compile(r".*\.(so(\.[\d\.]+)?|dylib|dll)$")
+
+# Environment variables used to find the programs and the
+# shared libraries, part of the key of the ResultCache
+CACHE_ENV_VARS = ["PATH", "LD_LIBRARY_PATH", "DYLD_LIBRARY_PATH"]
+
 def _str_from_signal(code):
     """ Returns a nice string describing the signal
 
@@ -40,21 +66,31 @@ class TestResult:
         self.test_name = test_name
         self.time = 0
         self.ok   = False
-        # Output of the executable of the test
+        # Output of the executable of the test. Only its beginning
+        # and its end when the full output is in log_path
         self.out = ""
+        self.log_path = None
         # Short description of what went wrong
         self.message = ""
+        # True if the test was not run, because it passed
+        # the last time and nothing it depends on changed
+        self.cached = False
 
 
-def run_test(build_dir, test_name, cmd, properties, build_env):
+def run_test(build_dir, test_name, cmd, properties, build_env,
+             log_path=None):
     """ Run a test.
 
+    :param log_path: If given, write the full output of the test
+                     there, and only keep its beginning and its end
+                     in memory
+
     :return: (res, output) where res is a string describing wether
       the test was sucessul, and output is the output of the test
 
     """
-    timeout = properties.get("TIMEOUT")
-    timeout = int(timeout)
+    timeout = properties.get("TIMEOUT", DEFAULT_TIMEOUT)
+    timeout = int(float(timeout))
     # we will merge the build env coming from toc
     # config with the env coming from CMake config,
     # assuming that cmake is always right
@@ -63,14 +99,16 @@ def run_test(build_dir, test_name, cmd, properties, build_env):
     if cmake_env:
         cmake_env = cmake_env.split(";")
         for key_value in cmake_env:
-            key, value = key_value.split("=")
+            key, value = key_value.split("=", 1)
             env[key] = value
     process_thread = qibuild.command.ProcessThread(cmd,
         name=test_name,
         cwd=build_dir,
-        env=env)
+        env=env,
+        log_path=log_path)
 
     res = TestResult(test_name)
+    res.log_path = log_path
     start = datetime.datetime.now()
     process_thread.start()
     process_thread.join(timeout)
@@ -107,10 +145,21 @@ def run_test(build_dir, test_name, cmd, properties, build_env):
     return res
 
 
-def run_tests(project, build_env, test_name=None):
+def run_tests(project, build_env, test_name=None, num_jobs=1, gtest_shards=1,
+              sdk_dirs=None, packages=None):
     """ Called by :py:meth:`qibuild.toc.Toc.test_project`
 
     :param test_name: If given, only run this test
+    :param num_jobs: If greater than one, run several tests at
+                     the same time, see :py:func:`run_parallel`
+    :param gtest_shards: If greater than one, split each gtest test
+                         in this number of shards, run in parallel.
+                         See :py:func:`shard_gtests`
+    :param sdk_dirs: If not None, do not run the tests that passed
+                     the last time, unless their executables, their
+                     arguments, or the shared libraries found in these
+                     sdk dirs have changed. See :py:class:`ResultCache`
+    :param packages: The packages of the toolchain, used with sdk_dirs
 
     Always write some XML files in build-test/results
     (even if they were no tests to run at all)
@@ -124,52 +173,793 @@ def run_tests(project, build_env, test_name=None):
                     * test_bar
 
     """
-    build_dir = project.build_directory
-    results_dir = os.path.join(project.directory, "build-tests",
-        "results")
-
-    all_tests = list()
-    tests = list()
-    parse_ctest_test_files(all_tests, build_dir, list())
-    if test_name:
-        tests = [x for x in tests if x[0] == test_name]
-        if not tests:
-            mess  = "No such test: %s\n" % test_name
-            mess += "Known tests are:\n"
-            for x in all_tests:
-                mess += "  * " + x[0] + "\n"
-            raise Exception(mess)
-    else:
-        tests = all_tests[:]
-
+    tests = get_tests(project, test_name=test_name)
     if not tests:
         # Create a fake test result to keep CI jobs happy:
         fake_test_res = TestResult("compilation")
         fake_test_res.ok = True
-        xml_out = os.path.join(results_dir, "compilation.xml")
+        xml_out = os.path.join(get_results_dir(project), "compilation.xml")
         write_xml(xml_out, fake_test_res)
-    ok = True
-    fail_tests = list()
-    for (i, test) in enumerate(tests):
-        (test_name, cmd, properties) = test
-        sys.stdout.write("Running %i/%i %s ... " % (i+1, len(tests), test_name))
-        sys.stdout.flush()
-        test_res = run_test(build_dir, test_name, cmd, properties, build_env)
-        if test_res.ok:
-            sys.stdout.write("[OK]\n")
-        else:
-            ok = False
-            sys.stdout.write("[FAIL]\n")
-            print test_res.out
-            fail_tests.append(test_name)
-        xml_out = os.path.join(results_dir, test_name + ".xml")
+    results = run_test_list(project, build_env, tests, num_jobs=num_jobs,
+                            gtest_shards=gtest_shards, sdk_dirs=sdk_dirs,
+                            packages=packages)
+    fail_tests = [x.test_name for x in results if not x.ok]
+    num_cached = len([x for x in results if x.cached])
+    summary  = "Ran %i tests, %i failures" % (len(tests), len(fail_tests))
+    if num_cached:
+        summary += " (%i cached)" % num_cached
+    summary += "\n"
+    for fail_test in fail_tests:
+        summary += "  * %s\n" % fail_test
+
+    return (not fail_tests, summary)
+
+
+def run_test_list(project, build_env, tests, num_jobs=1, gtest_shards=1,
+                  sdk_dirs=None, packages=None):
+    """ Run some tests of a project, as returned by :py:func:`get_tests`,
+    and write their XML files in build-test/results
+
+    (see :py:func:`run_tests` for the meaning of the parameters)
+
+    :return: the list of TestResult, in the same order as tests
+
+    """
+    build_dir = project.build_directory
+    results_dir = get_results_dir(project)
+    durations = get_durations(project)
+    cache = None
+    cached = dict()
+    keys = dict()
+    if sdk_dirs is not None:
+        cache = ResultCache(project, sdk_dirs, build_env=build_env,
+                            packages=packages)
+        for test in tests:
+            keys[test[0]] = cache.get_key(test)
+            test_res = cache.get_result(test[0], keys[test[0]])
+            if test_res:
+                cached[test[0]] = test_res
+                sys.stdout.write("%s ... [CACHED]\n" % test[0])
+                cache.write_xml(test[0],
+                                os.path.join(results_dir, test[0] + ".xml"))
+    all_tests = tests
+    tests = [x for x in tests if x[0] not in cached]
+    # Only keep the XML files written during this run: a stale file
+    # would be kept below, and stored in the cache
+    for (test_name, cmd, _properties) in tests:
+        qibuild.sh.rm(os.path.join(results_dir, test_name + ".xml"))
+        gtest_output = _get_gtest_output(cmd)
+        if gtest_output:
+            qibuild.sh.rm(gtest_output)
+    to_run = tests
+    shards = dict()
+    if gtest_shards > 1:
+        (to_run, shards) = shard_gtests(tests, gtest_shards)
+        num_jobs = max(num_jobs, gtest_shards)
+    if num_jobs > 1 and len(to_run) > 1:
+        results = run_parallel(build_dir, to_run, build_env, num_jobs,
+                               durations=durations, results_dir=results_dir)
+    else:
+        results = list()
+        for (i, test) in enumerate(to_run):
+            (test_name, cmd, properties) = test
+            sys.stdout.write("Running %i/%i %s ... " % (i+1, len(to_run), test_name))
+            sys.stdout.flush()
+            test_res = run_test(build_dir, test_name, cmd, properties, build_env,
+                                log_path=get_log_path(results_dir, test_name))
+            _print_result(test_res)
+            results.append(test_res)
+    for test_res in results:
+        durations.record(test_res.test_name, test_res.time)
+    if shards:
+        results = merge_shards(tests, results, shards)
+    for test_res in results:
+        if test_res.test_name in shards:
+            durations.record(test_res.test_name, test_res.time)
+        xml_out = os.path.join(results_dir, test_res.test_name + ".xml")
         if not os.path.exists(xml_out):
             write_xml(xml_out, test_res)
-    summary  = "Ran %i tests, %i failures\n" % (len(tests), len(fail_tests))
+    durations.save()
+    if cache is None:
+        return results
+    for test_res in results:
+        xml_out = os.path.join(results_dir, test_res.test_name + ".xml")
+        cache.set_result(test_res, keys[test_res.test_name], xml_out)
+    cache.save()
+    by_name = dict((x.test_name, x) for x in results)
+    by_name.update(cached)
+    return [by_name[x[0]] for x in all_tests]
+
+
+def get_results_dir(project):
+    """ Where the XML files of the tests of a project are written """
+    return os.path.join(project.directory, "build-tests", "results")
+
+
+def get_log_path(results_dir, test_name):
+    """ Where the full output of a test is written """
+    # Names of the gtest shards contain a '/'
+    return os.path.join(results_dir, re.sub(r"[^\w\.-]", "_", test_name) + ".log")
+
+
+def _get_gtest_output(cmd):
+    """ Return the path of the XML file written by a gtest test,
+    or None if the test does not look like a gtest test
+
+    """
+    for arg in cmd:
+        if arg.startswith("--gtest_output=xml:"):
+            return arg[len("--gtest_output=xml:"):]
+    return None
+
+
+def _get_shard_xml(xml_out, index):
+    """ Where a shard of a gtest test writes its results """
+    (base, ext) = os.path.splitext(xml_out)
+    return "%s.shard-%i%s" % (base, index, ext)
+
+
+def shard_gtests(tests, num_shards):
+    """ Split each gtest test in num_shards tests, using the
+    GTEST_TOTAL_SHARDS and GTEST_SHARD_INDEX environment variables.
+    Each shard writes its results in its own XML file.
+
+    :return: (to_run, shards) where to_run is the new list of tests,
+             and shards a dict name -> list of shard names for each
+             test that was split
+
+    """
+    to_run = list()
+    shards = dict()
+    for test in tests:
+        (name, cmd, properties) = test
+        xml_out = _get_gtest_output(cmd)
+        if not xml_out:
+            to_run.append(test)
+            continue
+        shards[name] = list()
+        for i in range(num_shards):
+            shard_name = "%s[%i/%i]" % (name, i + 1, num_shards)
+            shard_xml = _get_shard_xml(xml_out, i)
+            qibuild.sh.rm(shard_xml)
+            shard_cmd = list()
+            for arg in cmd:
+                if arg.startswith("--gtest_output=xml:"):
+                    arg = "--gtest_output=xml:%s" % shard_xml
+                shard_cmd.append(arg)
+            shard_env = "GTEST_TOTAL_SHARDS=%i;GTEST_SHARD_INDEX=%i" % (
+                num_shards, i)
+            shard_properties = properties.copy()
+            if properties.get("ENVIRONMENT"):
+                shard_env = properties["ENVIRONMENT"] + ";" + shard_env
+            shard_properties["ENVIRONMENT"] = shard_env
+            to_run.append((shard_name, shard_cmd, shard_properties))
+            shards[name].append(shard_name)
+    return (to_run, shards)
+
+
+def merge_shards(tests, results, shards):
+    """ Merge the results of the shards created by :py:func:`shard_gtests`
+
+    :return: the list of TestResult, one for each test in tests
+
+    """
+    by_name = dict((x.test_name, x) for x in results)
+    merged = list()
+    for (name, cmd, _properties) in tests:
+        if name not in shards:
+            merged.append(by_name[name])
+            continue
+        shard_results = [by_name[x] for x in shards[name]]
+        test_res = TestResult(name)
+        test_res.ok = all(x.ok for x in shard_results)
+        test_res.time = max(x.time for x in shard_results)
+        test_res.out = "".join("[%s]\n%s" % (x.test_name, x.out)
+                               for x in shard_results)
+        test_res.message = "; ".join("%s: %s" % (x.test_name, x.message)
+                                     for x in shard_results if not x.ok)
+        xml_out = _get_gtest_output(cmd)
+        shard_xmls = [_get_shard_xml(xml_out, i)
+                      for i in range(len(shard_results))]
+        # Shards that failed without writing their results:
+        crashed = [x for (x, xml) in zip(shard_results, shard_xmls)
+                   if not x.ok and not os.path.exists(xml)]
+        merge_gtest_xml(xml_out, shard_xmls, crashed=crashed)
+        merged.append(test_res)
+    return merged
+
+
+def merge_gtest_xml(xml_out, xml_files, crashed=None):
+    """ Merge several XML files written by gtest in one.
+    Test suites with the same name are merged too.
+    Missing files are skipped.
+
+    :param crashed: a list of TestResult, added as failures
+                    (for shards that did not write their XML file)
+
+    """
+    counters = ["tests", "failures", "disabled", "errors", "time"]
+    root = etree.Element("testsuites")
+    root.set("name", "AllTests")
+    totals = dict((x, 0) for x in counters)
+    suites = dict()
+    for xml_file in xml_files:
+        if not os.path.exists(xml_file):
+            continue
+        try:
+            tree = etree.parse(xml_file)
+        except Exception, e:
+            LOGGER.warning("Could not parse %s: %s", xml_file, e)
+            continue
+        for suite in tree.getroot().findall("testsuite"):
+            name = suite.get("name")
+            for counter in counters:
+                totals[counter] += float(suite.get(counter, 0))
+            if name not in suites:
+                suites[name] = suite
+                root.append(suite)
+                continue
+            merged_suite = suites[name]
+            for counter in counters:
+                value = float(merged_suite.get(counter, 0)) + \
+                        float(suite.get(counter, 0))
+                merged_suite.set(counter, _xml_number(value))
+            for testcase in suite:
+                merged_suite.append(testcase)
+    for test_res in (crashed or list()):
+        suite = etree.SubElement(root, "testsuite", name=test_res.test_name,
+            tests="1", failures="1", disabled="0", errors="0",
+            time=_xml_number(test_res.time))
+        testcase = etree.SubElement(suite, "testcase", name=test_res.test_name,
+            status="run", time=_xml_number(test_res.time))
+        failure = etree.SubElement(testcase, "failure",
+                                   message=test_res.message)
+        failure.text = test_res.out
+        totals["tests"] += 1
+        totals["failures"] += 1
+    for counter in counters:
+        root.set(counter, _xml_number(totals[counter]))
+    qibuild.sh.mkdir(os.path.dirname(xml_out), recursive=True)
+    etree.ElementTree(root).write(xml_out, encoding="UTF-8")
+
+
+def _xml_number(value):
+    """ Format a number the way gtest does """
+    if value == int(value):
+        return "%i" % value
+    return "%.3f" % value
+
+
+def get_tests(project, test_name=None):
+    """ Get the tests of a project, as a list of
+    (name, cmd, properties) tuples.
+
+    :param test_name: If given, only return this test
+
+    """
+    all_tests = list()
+    parse_ctest_test_files(all_tests, project.build_directory, list())
+    if not test_name:
+        return all_tests
+    tests = [x for x in all_tests if x[0] == test_name]
+    if not tests:
+        mess  = "No such test: %s\n" % test_name
+        mess += "Known tests are:\n"
+        for x in all_tests:
+            mess += "  * " + x[0] + "\n"
+        raise Exception(mess)
+    return tests
+
+
+def get_durations(project):
+    """ Get the :py:class:`qibuild.durations.Durations` storing the
+    durations of the tests of a project
+
+    """
+    return Durations(os.path.join(project.build_directory, DURATIONS_FILE))
+
+
+class ResultCache:
+    """ Remember the results of the tests that passed, with a key
+    computed from everything they depend on:
+
+      * the contents of the executable, and of the arguments that are
+        existing files (python scripts, data files ...)
+      * the arguments themselves, and the ENVIRONMENT property
+      * the contents of the shared libraries found in the sdk dirs
+        (the one of the project and the ones of its dependencies).
+        Knowing which libraries a test really loads would require
+        parsing the executables, so all of them are used.
+      * the paths, versions and sha256 of the packages of the toolchain
+      * the environment variables used to find programs and
+        libraries (see CACHE_ENV_VARS)
+
+    The hashes of the files are stored with their size and their
+    mtime, so that files that did not change are not read again.
+
+    """
+    def __init__(self, project, sdk_dirs, build_env=None, packages=None):
+        self.build_dir = project.build_directory
+        self.path = os.path.join(self.build_dir, RESULT_CACHE_FILE)
+        self.sdk_dirs = sdk_dirs
+        if build_env is None:
+            build_env = dict()
+        self.build_env = build_env
+        if packages is None:
+            packages = list()
+        self.packages = packages
+        # name -> dict(key=..., time=..., xml=...)
+        self.tests = dict()
+        # path -> (size, mtime, sha1)
+        self.files = dict()
+        self._used_files = dict()
+        self._libs_key = None
+        self.load()
+
+    def load(self):
+        """ Read the cache from disk.
+        A missing or invalid file is simply ignored
+
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as fp:
+                contents = json.load(fp)
+            self.tests = contents["tests"]
+            self.files = contents["files"]
+        except Exception, e:
+            LOGGER.debug("Ignoring invalid test cache %s: %s", self.path, e)
+            self.tests = dict()
+            self.files = dict()
+
+    def save(self):
+        """ Write the cache back to disk. Only the hashes of the files
+        used this time are kept
+
+        """
+        to_write = {"tests" : self.tests, "files" : self._used_files}
+        try:
+            with open(self.path, "w") as fp:
+                json.dump(to_write, fp)
+        except (IOError, OSError), e:
+            LOGGER.debug("Could not write test cache %s: %s", self.path, e)
+
+    def hash_file(self, path):
+        """ Get the sha1 of the contents of a file """
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            self._used_files[path] = known
+            return known[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as fp:
+            while True:
+                chunk = fp.read(64 * 1024)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+        res = (stat.st_size, stat.st_mtime, sha1.hexdigest())
+        self.files[path] = res
+        self._used_files[path] = res
+        return res[2]
+
+    def get_libs_key(self):
+        """ A hash of every shared library of the sdk dirs, of the
+        packages and of the environment, computed only once
+
+        """
+        if self._libs_key is not None:
+            return self._libs_key
+        sha1 = hashlib.sha1()
+        for var in CACHE_ENV_VARS:
+            sha1.update("%s: %s\n" % (var, self.build_env.get(var, "")))
+        for package in self.packages:
+            sha1.update("package: %s\n" % json.dumps([package.name,
+                package.path, package.version, package.sha256]))
+        for sdk_dir in self.sdk_dirs:
+            for subdir in ["lib", "bin"]:
+                lib_dir = os.path.join(sdk_dir, subdir)
+                for (root, dirs, files) in os.walk(lib_dir):
+                    dirs.sort()
+                    for filename in sorted(files):
+                        if not SHARED_LIB_RE.match(filename):
+                            continue
+                        path = os.path.join(root, filename)
+                        sha1.update("%s %s\n" % (path, self.hash_file(path)))
+        self._libs_key = sha1.hexdigest()
+        return self._libs_key
+
+    def get_key(self, test):
+        """ Compute the key of a test, as returned by :py:func:`get_tests` """
+        (name, cmd, properties) = test
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps([name, cmd, properties.get("ENVIRONMENT", "")]))
+        executable = os.path.join(self.build_dir, cmd[0])
+        if not os.path.isfile(executable):
+            executable = qibuild.command.find_program(cmd[0])
+        for arg in [executable] + cmd[1:]:
+            if not arg:
+                continue
+            # Tests are run from the build directory
+            path = os.path.join(self.build_dir, arg)
+            if os.path.isfile(path):
+                sha1.update("%s %s\n" % (path, self.hash_file(path)))
+        sha1.update(self.get_libs_key())
+        return sha1.hexdigest()
+
+    def get_result(self, name, key):
+        """ Return a TestResult if the test passed with the same key,
+        None otherwise
+
+        """
+        entry = self.tests.get(name)
+        if not entry or entry.get("key") != key or entry.get("xml") is None:
+            return None
+        test_res = TestResult(name)
+        test_res.ok = True
+        test_res.cached = True
+        test_res.time = entry["time"]
+        return test_res
+
+    def set_result(self, test_res, key, xml_out):
+        """ Remember the result of a test that just ran.
+        Only tests that passed are cached
+
+        """
+        name = test_res.test_name
+        if not test_res.ok or not os.path.exists(xml_out):
+            self.tests.pop(name, None)
+            return
+        with open(xml_out, "r") as fp:
+            xml = fp.read().decode("utf-8", "replace")
+        self.tests[name] = {"key" : key, "time" : test_res.time, "xml" : xml}
+
+    def write_xml(self, name, xml_out):
+        """ Write again the XML file of a cached test """
+        qibuild.sh.mkdir(os.path.dirname(xml_out), recursive=True)
+        with open(xml_out, "w") as fp:
+            fp.write(self.tests[name]["xml"].encode("utf-8"))
+
+
+def get_expected_durations(tests, durations):
+    """ Return a dict name -> expected duration for each test.
+
+    Unknown tests are expected to take as long as the longest
+    known test, so that they are started early.
+
+    """
+    known = [durations.get(x[0]) for x in tests]
+    known = [x for x in known if x is not None]
+    if known:
+        default = max(known)
+    else:
+        default = DEFAULT_DURATION
+    res = dict()
+    for (name, _cmd, _properties) in tests:
+        res[name] = durations.get(name, default)
+    return res
+
+
+def predict_schedule(tests, expected, num_jobs):
+    """ Predict how :py:func:`run_parallel` will run the tests
+
+    :param expected: a dict name -> expected duration
+    :return: (total, schedule, critical_path) where:
+       - total is the expected duration of the whole run,
+       - schedule is a dict name -> (start, end)
+       - critical_path is the list of names of the tests ending
+         the last on the busiest job, sorted by start time
+
+    """
+    slots = [_TestSlot(i, x, num_jobs) for (i, x) in enumerate(tests)]
+    slots.sort(key=lambda x: (-expected[x.name], x.index))
+    # When each job will be free, and which tests it ran
+    job_free = [0.0] * num_jobs
+    job_tests = [list() for i in range(num_jobs)]
+    lock_free = dict()
+    schedule = dict()
+    for slot in slots:
+        if slot.serial:
+            jobs = range(num_jobs)
+        else:
+            jobs = sorted(range(num_jobs), key=lambda x: (job_free[x], x))
+            jobs = jobs[:slot.processors]
+        start = max(job_free[x] for x in jobs)
+        for lock in slot.locks:
+            start = max(start, lock_free.get(lock, 0.0))
+        end = start + expected[slot.name]
+        for job in jobs:
+            job_free[job] = end
+            job_tests[job].append(slot.name)
+        for lock in slot.locks:
+            lock_free[lock] = end
+        schedule[slot.name] = (start, end)
+    total = max(job_free)
+    busiest = job_free.index(total)
+    critical_path = sorted(job_tests[busiest], key=lambda x: schedule[x][0])
+    return (total, schedule, critical_path)
+
+
+def partition_tests(names, shard_count, durations=None):
+    """ Split some tests in shard_count balanced shards.
+
+    The result only depends on the names and the durations,
+    so that several machines can each run their own shard without
+    talking to each other, and every test is run exactly once.
+
+    :param names: unique names of the tests, for instance
+                  ``<project>/<test>``
+    :param durations: a dict name -> expected duration.
+                      Tests not in it are expected to take as long
+                      as the longest known test. If None or empty,
+                      every test is expected to take the same time,
+                      and tests are spread using a stable hash of
+                      their names
+
+    :return: a list of shard_count lists of names, in the order
+             of names
+
+    """
+    durations = durations or dict()
+    known = [durations[x] for x in names if x in durations]
+    if known:
+        default = max(known)
+    else:
+        default = 1.0
+    weights = dict((x, float(durations.get(x, default))) for x in names)
+    def stable_hash(name):
+        "Does not depend on the python version nor on the platform"
+        return hashlib.sha1(name.encode("utf-8")).hexdigest()
+    # Longest tests first, each one going to the least loaded shard
+    ordered = sorted(names, key=lambda x: (-weights[x], stable_hash(x), x))
+    loads = [0.0] * shard_count
+    shards = [list() for i in range(shard_count)]
+    for name in ordered:
+        shard = min(range(shard_count), key=lambda x: (loads[x], x))
+        loads[shard] += weights[name]
+        shards[shard].append(name)
+    index = dict((x, i) for (i, x) in enumerate(names))
+    for shard in shards:
+        shard.sort(key=index.get)
+    return shards
+
+
+def get_partition_key(shards):
+    """ A short string identifying a partition made by
+    :py:func:`partition_tests`. Shards made on different machines can
+    only be merged if they come from the same partition
+
+    """
+    return hashlib.sha1(json.dumps(shards)).hexdigest()
+
+
+def write_shard_results(path, shard_index, shard_count, partition_key,
+                        entries):
+    """ Write the results of a shard in a json file, to be read by
+    :py:func:`merge_shard_results`
+
+    :param entries: a list of (project_name, TestResult, xml_path)
+                    tuples. The contents of the XML file are stored
+                    too, so that the results can be merged on an other
+                    machine
+
+    """
+    tests = list()
+    for (project_name, test_res, xml_path) in entries:
+        xml = None
+        if xml_path and os.path.exists(xml_path):
+            with open(xml_path, "r") as fp:
+                xml = fp.read().decode("utf-8", "replace")
+        tests.append({
+            "project" : project_name,
+            "name"    : test_res.test_name,
+            "ok"      : test_res.ok,
+            "cached"  : test_res.cached,
+            "time"    : test_res.time,
+            "message" : test_res.message,
+            "xml"     : xml,
+        })
+    to_write = {
+        "shard_index"   : shard_index,
+        "shard_count"   : shard_count,
+        "partition_key" : partition_key,
+        "tests"         : tests,
+    }
+    qibuild.sh.mkdir(os.path.dirname(os.path.abspath(path)), recursive=True)
+    with open(path, "w") as fp:
+        json.dump(to_write, fp, indent=2, sort_keys=True)
+
+
+def merge_shard_results(paths, output_dir):
+    """ Merge the files written by :py:func:`write_shard_results`
+
+    Write the XML files in ``output_dir/<project>/<test>.xml``, and
+    the durations of the tests in ``output_dir/durations.json``,
+    suitable for ``qibuild test --shard-durations``
+
+    :return: (ok, summary), like :py:func:`run_tests`
+    :raise: Exception if some shards are missing, or if the shards do
+            not come from the same partition
+
+    """
+    shards = dict()
+    for path in paths:
+        with open(path, "r") as fp:
+            shard = json.load(fp)
+        index = shard["shard_index"]
+        if index in shards:
+            raise Exception("Shard %i found twice (%s and %s)" % (
+                index, shards[index][0], path))
+        shards[index] = (path, shard)
+    if not shards:
+        raise Exception("No shard to merge")
+    shard_counts = set(x[1]["shard_count"] for x in shards.values())
+    keys = set(x[1]["partition_key"] for x in shards.values())
+    if len(shard_counts) != 1 or len(keys) != 1:
+        mess  = "Shards do not come from the same partition\n"
+        mess += "Make sure all the shards use the same shard count, "
+        mess += "the same tests and the same --shard-durations file\n"
+        for index in sorted(shards):
+            (path, shard) = shards[index]
+            mess += "  * %s: shard %i of %i (%s)\n" % (path, index,
+                shard["shard_count"], shard["partition_key"][:8])
+        raise Exception(mess)
+    shard_count = shard_counts.pop()
+    missing = [x for x in range(shard_count) if x not in shards]
+    if missing:
+        raise Exception("Missing shards: %s (shard count: %i)" % (
+            ", ".join(str(x) for x in missing), shard_count))
+
+    durations = Durations(os.path.join(output_dir, "durations.json"))
+    durations.durations = dict()
+    fail_tests = list()
+    num_tests = 0
+    num_cached = 0
+    for index in sorted(shards):
+        for test in shards[index][1]["tests"]:
+            num_tests += 1
+            full_name = "%s/%s" % (test["project"], test["name"])
+            durations.record(full_name, test["time"])
+            if test.get("cached"):
+                num_cached += 1
+            if not test["ok"]:
+                fail_tests.append(full_name)
+            xml_out = os.path.join(output_dir, test["project"],
+                                   test["name"] + ".xml")
+            if test["xml"] is None:
+                test_res = TestResult(test["name"])
+                test_res.ok = test["ok"]
+                test_res.time = test["time"]
+                test_res.message = test["message"]
+                write_xml(xml_out, test_res)
+                continue
+            qibuild.sh.mkdir(os.path.dirname(xml_out), recursive=True)
+            with open(xml_out, "w") as fp:
+                fp.write(test["xml"].encode("utf-8"))
+    durations.save()
+    summary  = "Ran %i tests in %i shards, %i failures" % (num_tests,
+        shard_count, len(fail_tests))
+    if num_cached:
+        summary += " (%i cached)" % num_cached
+    summary += "\n"
     for fail_test in fail_tests:
         summary += "  * %s\n" % fail_test
+    return (not fail_tests, summary)
+
+
+def _print_result(test_res):
+    """ Finish the 'Running ...' line of a test """
+    if test_res.ok:
+        sys.stdout.write("[OK]\n")
+    else:
+        sys.stdout.write("[FAIL]\n")
+        print test_res.out
+    sys.stdout.flush()
+
+
+class _TestSlot:
+    """ What a test needs to run, read from its CMake properties:
+
+      * PROCESSORS: the number of jobs it uses
+      * RESOURCE_LOCK: resources that no other test may use at
+        the same time
+      * RUN_SERIAL: no other test may run at the same time
+
+    """
+    def __init__(self, index, test, num_jobs):
+        (self.name, self.cmd, self.properties) = test
+        self.index = index
+        processors = int(self.properties.get("PROCESSORS", 1))
+        self.processors = max(1, min(processors, num_jobs))
+        locks = self.properties.get("RESOURCE_LOCK", "")
+        self.locks = set(x for x in locks.split(";") if x)
+        self.serial = self.properties.get("RUN_SERIAL", "").upper() in \
+            ["1", "ON", "YES", "TRUE", "Y"]
+
+
+def run_parallel(build_dir, tests, build_env, num_jobs, durations=None,
+                 results_dir=None):
+    """ Run the tests using at most num_jobs jobs, honoring the
+    RUN_SERIAL, RESOURCE_LOCK and PROCESSORS properties.
+
+    Tests are started in the given order, or longest first if
+    durations (a :py:class:`qibuild.durations.Durations`) is given.
+    A test that has to wait for a resource does not prevent the next
+    ones from starting, unless it has to run alone.
+
+    If results_dir is given, the full output of each test is written
+    there, see :py:func:`get_log_path`
+
+    :return: the list of TestResult, in the same order as tests
+
+    """
+    pending = [_TestSlot(i, x, num_jobs) for (i, x) in enumerate(tests)]
+    if durations is not None:
+        expected = get_expected_durations(tests, durations)
+        pending.sort(key=lambda x: (-expected[x.name], x.index))
+    results = [None] * len(tests)
+    done = Queue.Queue()
+    running = list()
+    free_jobs = num_jobs
+    held_locks = set()
+    error = None
+
+    def can_start(slot):
+        "Whether the test can be started now"
+        if slot.serial:
+            return not running
+        if any(x.serial for x in running):
+            return False
+        if slot.processors > free_jobs:
+            return False
+        return not (slot.locks & held_locks)
+
+    def run(slot):
+        "To be called in a thread"
+        try:
+            log_path = None
+            if results_dir:
+                log_path = get_log_path(results_dir, slot.name)
+            res = run_test(build_dir, slot.name, slot.cmd, slot.properties,
+                           build_env, log_path=log_path)
+            done.put((slot, res, None))
+        except Exception:
+            done.put((slot, None, sys.exc_info()))
+
+    while pending or running:
+        if error is None:
+            for slot in pending[:]:
+                if can_start(slot):
+                    pending.remove(slot)
+                    running.append(slot)
+                    free_jobs -= slot.processors
+                    held_locks.update(slot.locks)
+                    thread = threading.Thread(target=run, args=(slot,),
+                                              name="Test<%s>" % slot.name)
+                    thread.daemon = True
+                    thread.start()
+                elif slot.serial:
+                    # Do not let the other tests run before this one forever
+                    break
+        elif not running:
+            break
+        (slot, res, exc_info) = done.get()
+        running.remove(slot)
+        free_jobs += slot.processors
+        held_locks.difference_update(slot.locks)
+        if exc_info:
+            if error is None:
+                error = exc_info
+            continue
+        results[slot.index] = res
+        sys.stdout.write("[%i/%i] %s ... " % (slot.index + 1, len(tests),
+                                              slot.name))
+        _print_result(res)
 
-    return (ok, summary)
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return results
 
 
 def write_xml(xml_out, test_res):
@@ -180,7 +970,7 @@ def write_xml(xml_out, test_res):
 <testsuites tests="1" failures="{num_failures}" disabled="0" errors="0" time="{time}" name="All">
     <testsuite name="{testsuite_name}" tests="1" failures="{num_failures}" disabled="0" errors="0" time="{time}">
     <testcase name="{testcase_name}" status="run">
-      {failure}
+      {failure}{system_out}
     </testcase>
   </testsuite>
 </testsuites>
@@ -197,10 +987,17 @@ def write_xml(xml_out, test_res):
 """
         failure = failure.format(out=test_res.out,
             message=test_res.message)
+    system_out = ""
+    if test_res.log_path:
+        # Jenkins displays this as a link to the file
+        system_out = """
+      <system-out>Full log: [[ATTACHMENT|{log_path}]]</system-out>"""
+        system_out = system_out.format(log_path=test_res.log_path)
     to_write = to_write.format(num_failures=num_failures,
                                testsuite_name="test", # nothing clever to put here :/
                                testcase_name=test_res.test_name,
                                failure=failure,
+                               system_out=system_out,
                                time=test_res.time)
     qibuild.sh.mkdir(os.path.dirname(xml_out), recursive=True)
     with open(xml_out, "w") as fp:
@@ -220,17 +1017,18 @@ def parse_ctest_test_files(tests, root, subdirs):
     cur_test = None
     cur_cmd = None
     for line in lines:
-        match = re.match("SUBDIRS\((.*)\)", line)
+        match = re.match("SUBDIRS\((.*)\)", line, re.IGNORECASE)
         if match:
-            subdir = match.groups()[0]
+            subdir = match.groups()[0].strip('"')
             subdirs.append(subdir)
-        match = re.match("ADD_TEST\((\w+) (.*)\)", line)
+        match = re.match("ADD_TEST\((\w+) (.*)\)", line, re.IGNORECASE)
         if match:
             groups = match.groups()
             cur_test = groups[0]
             args = groups[1]
             cur_cmd = shlex.split(args)
-        match = re.match("SET_TESTS_PROPERTIES\((\w+) PROPERTIES (.*)\)", line)
+        match = re.match("SET_TESTS_PROPERTIES\((\w+) PROPERTIES (.*)\)", line,
+                         re.IGNORECASE)
         if match:
             groups = match.groups()
             test_name = groups[0]
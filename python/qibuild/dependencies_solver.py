@@ -7,7 +7,7 @@ topological_sort
 """
 import logging
 
-__all__ = [ "DagError", "assert_dag", "topological_sort" ]
+__all__ = [ "DagError", "assert_dag", "topological_sort", "DependencyGraph" ]
 
 class DagError(Exception):
     """ Dag Exception """
@@ -108,38 +108,127 @@ def topological_sort(data, heads):
     ...   'e' : ( 'g', 'c' )}, [ 'a', 'q' ])
     ['g', 'c', 'e', 'b', 'd', 'a', 'u', 'y', 'o', 'i', 'q']
     """
-    if isinstance(heads, list):
-        data['internalfakehead'] = heads
-        head = 'internalfakehead'
-        result =  _topological_sort(data, head, head)
-        return [ x for x in result if x != 'internalfakehead' ]
-    else:
-        head = heads
-        return _topological_sort(data, head, head)
-
-def _topological_sort(data, head, top_node, raise_exception = False, result = None, visited = None):
+    if not isinstance(heads, list):
+        heads = [heads]
+    result = list()
+    done = set()
+    visited = set()
+    for head in heads:
+        if head in done:
+            continue
+        _topological_sort(data, head, head, result=result,
+            visited=visited, done=done)
+    return result
+
+def _topological_sort(data, head, top_node, raise_exception = False, result = None,
+        visited = None, done = None):
     """ Internal function
+
+    Iterative depth-first search, so that long chains of
+    dependencies do not hit the recursion limit.
+    Using sets for visited and done nodes keeps it linear.
+
     """
-    if not result:
-        result = []
-    if not visited:
-        visited = []
-    deps = data.get(head, list())
-    if head in visited:
-        if head == top_node and raise_exception:
-            raise DagError(head, head, result)
+    if result is None:
+        result = list()
+    if visited is None:
+        visited = set()
+    if done is None:
+        done = set(result)
+
+    def enter(node):
+        " Returns an iterator on the deps of node, or None if already visited "
+        if node in visited:
+            if node == top_node and raise_exception:
+                raise DagError(node, node, result)
+            return None
+        visited.add(node)
+        return iter(data.get(node, list()))
+
+    deps = enter(head)
+    if deps is None:
         return result
-    visited.append(head)
-    for i in deps:
-        try:
-            result.index(i)
-        except ValueError:
-            #the item does not exist
-            result = _topological_sort(data, i, top_node, raise_exception, result, visited)
-    result.append(head)
+    stack = [(head, deps)]
+    while stack:
+        (node, deps) = stack[-1]
+        for dep in deps:
+            if dep in done:
+                continue
+            dep_deps = enter(dep)
+            if dep_deps is not None:
+                stack.append((dep, dep_deps))
+                break
+        else:
+            stack.pop()
+            result.append(node)
+            done.add(node)
     return result
 
 
+class DependencyGraph:
+    """ A graph of dependencies between projects and packages
+
+    It stores both the build dependencies and the runtime
+    dependencies, and can be built once and then re-used for
+    several calls to :py:meth:`DependenciesSolver.solve`
+
+    When a name is both a project and a package, the dependencies
+    of the package are used.
+
+    """
+    def __init__(self, projects=None, packages=None):
+        self.project_names = set()
+        self.package_names = set()
+        # name -> list of names, for buildtime and runtime:
+        self._deps = {False : dict(), True : dict()}
+        # (heads, runtime) -> sorted list of names, see self.sort()
+        self._sorted = dict()
+        if projects:
+            for project in projects:
+                self.add_project(project.name, project.depends, project.rdepends)
+        if packages:
+            for package in packages:
+                self.add_package(package.name, package.depends)
+
+    def add_project(self, name, depends, rdepends):
+        """ Add a project to the graph """
+        self.project_names.add(name)
+        if name not in self.package_names:
+            self._set_deps(name, depends, rdepends)
+
+    def add_package(self, name, depends):
+        """ Add a package to the graph """
+        self.package_names.add(name)
+        self._set_deps(name, depends, depends)
+
+    def _set_deps(self, name, depends, rdepends):
+        """ Update the dependencies of a node """
+        self._deps[False][name] = list(depends)
+        self._deps[True][name] = list(rdepends)
+        self._sorted = dict()
+
+    def get_deps(self, name, runtime=False):
+        """ Get the direct dependencies of a node """
+        return self._deps[runtime].get(name, list())
+
+    def sort(self, heads, runtime=False):
+        """ Return the heads and all their dependencies,
+        in the same order as :py:func:`topological_sort`
+
+        The result is cached until the graph changes, so
+        the transitive closure of a given list of heads is only
+        computed once.
+
+        """
+        if not isinstance(heads, list):
+            heads = [heads]
+        key = (tuple(heads), runtime)
+        res = self._sorted.get(key)
+        if res is None:
+            res = topological_sort(self._deps[runtime], heads)
+            self._sorted[key] = res
+        return res[:]
+
 
 class DependenciesSolver:
     """This class is able to resolve dependencies between projects
@@ -147,7 +236,13 @@ class DependenciesSolver:
     """
     logger = logging.getLogger(__name__)
 
-    def __init__(self, projects=None, packages=None, active_projects=None):
+    def __init__(self, projects=None, packages=None, active_projects=None,
+            graph=None):
+        """
+        :param graph: a :py:class:`DependencyGraph` built from
+                      the projects and the packages. If not given,
+                      it is built from the projects and packages lists
+        """
         self.projects = list()
         if active_projects is None:
             self.active_projects = list()
@@ -158,6 +253,9 @@ class DependenciesSolver:
             self.projects = projects
         if packages:
             self.packages = packages
+        if graph is None:
+            graph = DependencyGraph(projects=self.projects, packages=self.packages)
+        self.graph = graph
 
     def solve(self, names, runtime=False):
         """Given a list of names, try to sort them in the correct order.
@@ -172,47 +270,38 @@ class DependenciesSolver:
         r_packages = list()
         r_not_found = list()
 
-        project_names = [p.name for p in self.projects]
-        package_names = [p.name for p in self.packages]
-        package_names = [x for x in package_names if not x in self.active_projects]
-
-        mess  = "Solving deps...\n"
-        mess += "Projects:\n"
-        for project in self.projects:
-            mess += "  " + project.name + "\n"
-            mess += "   deps: " +  ",".join(project.depends) + "\n"
-            mess += "  rdeps: " +  ",".join(project.depends) + "\n"
-        mess += "Packages:\n"
-        for package in self.packages:
-            mess += "  " + package.name + "\n"
-
-        self.logger.debug(mess)
+        project_names = self.graph.project_names
+        package_names = self.graph.package_names.difference(self.active_projects)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            mess  = "Solving deps...\n"
+            mess += "Projects:\n"
+            for name in sorted(project_names):
+                mess += "  " + name + "\n"
+                mess += "   deps: " +  ",".join(self.graph.get_deps(name)) + "\n"
+                mess += "  rdeps: " +  ",".join(self.graph.get_deps(name, runtime=True)) + "\n"
+            mess += "Packages:\n"
+            for name in sorted(self.graph.package_names):
+                mess += "  " + name + "\n"
+            self.logger.debug(mess)
 
         # Assert that all the names are known projects:
         for name in names:
             if name not in project_names:
                 raise Exception("Unknown project: %s" % name)
 
-        to_sort = dict()
-        for project in self.projects:
-            if runtime:
-                to_sort[project.name] = project.rdepends
-            else:
-                to_sort[project.name] = project.depends
-        for package in self.packages:
-            to_sort[package.name] = package.depends
-
         if runtime:
-            self.logger.debug("Sorting runtime projects: %s", ",".join(to_sort))
+            self.logger.debug("Sorting runtime projects")
         else:
-            self.logger.debug("Sorting buildable projects: %s", ",".join(to_sort))
-        sorted_names = topological_sort(to_sort, names)
+            self.logger.debug("Sorting buildable projects")
+        sorted_names = self.graph.sort(list(names), runtime=runtime)
 
         # Append what is left in sorted names, looking first in
         # known packages, then in known projects, but keeping
         # in r_projects what was passed as argument:
+        heads = set(names)
         for name in sorted_names:
-            if name in names:
+            if name in heads:
                 r_projects.append(name)
             elif name in package_names:
                 r_packages.append(name)
@@ -233,4 +322,3 @@ class DependenciesSolver:
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
-
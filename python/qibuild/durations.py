@@ -0,0 +1,82 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" This module contains the Durations class, used to remember
+how long things (building a project, running a test ...) took
+the previous times, so that the longest ones can be started first.
+
+"""
+
+import os
+import json
+import logging
+
+import qibuild.sh
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Durations:
+    """ A small persistent store name -> duration in seconds
+
+    Durations are stored in a json file. Each new duration is
+    averaged with the previous one, so that one slow run does
+    not change the order too much.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.durations = dict()
+        self._changed = False
+        self.load()
+
+    def load(self):
+        """ Read the durations from disk.
+        A missing or invalid file is simply ignored
+
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as fp:
+                durations = json.load(fp)
+        except Exception, e:
+            LOGGER.debug("Ignoring invalid durations file %s: %s", self.path, e)
+            return
+        if isinstance(durations, dict):
+            self.durations = durations
+
+    def save(self):
+        """ Write the durations back to disk, if they have changed """
+        if not self._changed:
+            return
+        try:
+            qibuild.sh.mkdir(os.path.dirname(self.path), recursive=True)
+            with open(self.path, "w") as fp:
+                json.dump(self.durations, fp, indent=2, sort_keys=True)
+        except (IOError, OSError), e:
+            LOGGER.debug("Could not write durations file %s: %s", self.path, e)
+            return
+        self._changed = False
+
+    def get(self, name, default=None):
+        """ Get the duration of a name, or default if it is not known """
+        return self.durations.get(name, default)
+
+    def get_default(self):
+        """ A duration to use for unknown names: the average of
+        the known durations, or 1 second if nothing is known
+
+        """
+        if not self.durations:
+            return 1.0
+        return sum(self.durations.values()) / len(self.durations)
+
+    def record(self, name, duration):
+        """ Record a new duration for a name """
+        previous = self.durations.get(name)
+        if previous is not None:
+            duration = (previous + duration) / 2.0
+        self.durations[name] = duration
+        self._changed = True
@@ -0,0 +1,293 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" This module contains a small scheduler running jobs in parallel,
+following a dependency graph.
+
+A job is started as soon as all its dependencies are done,
+with at most num_jobs jobs running at the same time.
+
+It also contains token pools, used to share a global number of
+jobs between several builds running at the same time.
+
+"""
+
+import os
+import sys
+import threading
+import Queue
+
+
+class DagScheduler:
+    """ Run a function on a list of names, following a dependency graph
+
+    :param names: the names of the jobs, sorted so that the dependencies
+                  of a job always come first. (This is what
+                  :py:meth:`qibuild.toc.Toc.resolve_deps` returns)
+    :param get_deps: a function returning the list of the names a
+                     job depends on. Names not in ``names`` are ignored
+    :param num_jobs: maximum number of jobs running at the same time
+    :param keep_going: when False, stop starting new jobs as soon as one
+                       of them fails. When True, only the jobs depending
+                       on a failed job are skipped.
+
+    After :py:meth:`run`, ``self.results``, ``self.errors`` and
+    ``self.skipped`` contain what happened to each job.
+
+    """
+    def __init__(self, names, get_deps, num_jobs=1, keep_going=False):
+        self.names = names
+        self.num_jobs = max(num_jobs, 1)
+        self.keep_going = keep_going
+        known = set(names)
+        self.deps = dict()
+        self.rdeps = dict((x, list()) for x in names)
+        for name in names:
+            deps = set(x for x in get_deps(name) if x in known and x != name)
+            self.deps[name] = deps
+            for dep in deps:
+                self.rdeps[dep].append(name)
+        # name -> return value of the function
+        self.results = dict()
+        # name -> sys.exc_info() of the exception raised by the function
+        self.errors = dict()
+        # names of the jobs that were not run
+        self.skipped = list()
+        # name -> priority. When several jobs are ready, the ones
+        # with the highest priority are started first.
+        # By default, use the order of self.names
+        self.priorities = None
+
+    def use_critical_path(self, durations, default=1.0):
+        """ Start the jobs on the longest path to the end first.
+
+        :param durations: a dict name -> expected duration
+        :param default: duration to use for jobs not in durations
+
+        """
+        priorities = dict()
+        # Longest path from a job to the end, including the job
+        # itself. Dependencies always come first in self.names,
+        # so walk it backwards.
+        for name in reversed(self.names):
+            longest = 0
+            for rdep in self.rdeps[name]:
+                longest = max(longest, priorities[rdep])
+            priorities[name] = durations.get(name, default) + longest
+        self.priorities = priorities
+
+    def run(self, func, on_done=None, with_share=False):
+        """ Call func(name) for each name, in self.num_jobs threads.
+
+        :param on_done: called from the calling thread with
+                        (name, status) when a job is over,
+                        status being "ok", "failed" or "skipped".
+                        Calls are always made in the order of self.names,
+                        so that output of the jobs can be displayed in a
+                        stable order
+        :param with_share: call func(name, share) instead, share being
+                           self.num_jobs divided by the number of jobs
+                           running or ready when the job is started
+                           (at least 1)
+
+        :return: True if every job succeeded
+
+        """
+        to_run = Queue.Queue()
+        done = Queue.Queue()
+
+        def worker():
+            "To be called in a thread"
+            while True:
+                job = to_run.get()
+                if job is None:
+                    return
+                (name, share) = job
+                try:
+                    if with_share:
+                        res = func(name, share)
+                    else:
+                        res = func(name)
+                    done.put((name, True, res))
+                except Exception:
+                    done.put((name, False, sys.exc_info()))
+
+        threads = list()
+        for i in range(min(self.num_jobs, len(self.names))):
+            thread = threading.Thread(target=worker,
+                                      name="DagScheduler<%i>" % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        waiting = dict((x, len(self.deps[x])) for x in self.names)
+        index = dict((x, i) for (i, x) in enumerate(self.names))
+        if self.priorities is None:
+            sort_key = index.get
+        else:
+            sort_key = lambda x: (-self.priorities[x], index[x])
+        # Jobs ready to be run, in the order of self.names.
+        # Only start them when a thread is available, so that
+        # nothing new is started after a failure
+        ready = [x for x in self.names if waiting[x] == 0]
+        ready.sort(key=sort_key)
+        status = dict()
+        running = 0
+        stopping = False
+        next_index = 0
+
+        while True:
+            started = list()
+            while ready and running < self.num_jobs and not stopping:
+                started.append(ready.pop(0))
+                running += 1
+            share = max(self.num_jobs / max(running + len(ready), 1), 1)
+            for name in started:
+                to_run.put((name, share))
+            if not running:
+                break
+            (name, ok, res) = done.get()
+            running -= 1
+            if ok:
+                status[name] = "ok"
+                self.results[name] = res
+            else:
+                status[name] = "failed"
+                self.errors[name] = res
+                if not self.keep_going:
+                    stopping = True
+            for rdep in self.rdeps[name]:
+                waiting[rdep] -= 1
+                if ok:
+                    continue
+                # Dependencies of rdep may still be running,
+                # so just mark it as skipped
+                self._skip(rdep, status)
+            for rdep in self.rdeps[name]:
+                if waiting[rdep] == 0 and rdep not in status:
+                    ready.append(rdep)
+            ready.sort(key=sort_key)
+            next_index = self._flush(next_index, status, on_done)
+
+        for thread in threads:
+            to_run.put(None)
+        for name in self.names:
+            if name not in status:
+                status[name] = "skipped"
+                self.skipped.append(name)
+        self._flush(next_index, status, on_done)
+        return not self.errors
+
+    def _skip(self, name, status):
+        """ Mark a job and every job depending on it as skipped """
+        to_skip = [name]
+        while to_skip:
+            name = to_skip.pop()
+            if name in status:
+                continue
+            status[name] = "skipped"
+            self.skipped.append(name)
+            to_skip.extend(self.rdeps[name])
+
+    def _flush(self, index, status, on_done):
+        """ Call on_done for every job over, in order, starting
+        from index. Return the index of the first job still not over
+
+        """
+        while index < len(self.names):
+            name = self.names[index]
+            if name not in status:
+                break
+            if on_done:
+                on_done(name, status[name])
+            index += 1
+        return index
+
+
+class TokenPool:
+    """ A pool of tokens shared between several threads.
+
+    Each build takes at least one token before starting, and
+    gives them back when it is done, so that the total number of
+    jobs never exceeds the size of the pool.
+
+    """
+    def __init__(self, num_jobs):
+        self.num_jobs = num_jobs
+        self.available = num_jobs
+        self._cond = threading.Condition()
+
+    def acquire(self, count=1):
+        """ Wait for a token, then take up to count tokens.
+        Return the number of tokens taken
+
+        """
+        with self._cond:
+            while self.available == 0:
+                self._cond.wait()
+            res = min(self.available, max(count, 1))
+            self.available -= res
+            return res
+
+    def release(self, count=1):
+        """ Give back tokens """
+        with self._cond:
+            self.available += count
+            self._cond.notify_all()
+
+    def close(self):
+        """ Nothing to do """
+        pass
+
+
+class MakeJobServer:
+    """ A pool of tokens compatible with the GNU make jobserver.
+
+    The tokens are bytes stored in a pipe, whose file descriptors are
+    given to the make processes via MAKEFLAGS (see :py:meth:`make_flags`).
+
+    Each make process has an implicit token: this is the token
+    taken by :py:meth:`acquire` before starting it. Every other job
+    run by make reads a token from the pipe, so the total number of
+    jobs never exceeds num_jobs, whatever the number of projects
+    being built.
+
+    Only available on POSIX.
+
+    """
+    def __init__(self, num_jobs):
+        self.num_jobs = num_jobs
+        (self.read_fd, self.write_fd) = os.pipe()
+        os.write(self.write_fd, "+" * num_jobs)
+
+    def make_flags(self):
+        """ The value of MAKEFLAGS to use """
+        return "-j --jobserver-fds=%i,%i" % (self.read_fd, self.write_fd)
+
+    def acquire(self, count=1):
+        """ Wait for one token. Make will take the other ones
+        from the pipe itself, so always return 1
+
+        """
+        os.read(self.read_fd, 1)
+        return 1
+
+    def release(self, count=1):
+        """ Put tokens back in the pipe """
+        os.write(self.write_fd, "+" * count)
+
+    def close(self):
+        """ Close the pipe """
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+def job_server_supported(cmake_generator):
+    """ Whether builds made with this generator can share a
+    :py:class:`MakeJobServer`
+
+    """
+    return os.name == "posix" and cmake_generator in ["Unix Makefiles",
+        "MSYS Makefiles", "CodeBlocks - Unix Makefiles",
+        "Eclipse CDT4 - Unix Makefiles"]
@@ -34,6 +34,9 @@ def work_tree_parser(parser):
     """
     default_parser(parser)
     parser.add_argument("--work-tree", help="Use a specific work tree path.")
+    parser.add_argument("--rescan", action="store_true",
+        help="Ignore the project index and explore the whole work tree again")
+    parser.set_defaults(rescan=False)
 
 def toc_parser(parser):
     """ Parser settings for every action using a toc dir
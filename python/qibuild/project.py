@@ -60,9 +60,11 @@ class Project:
         project_xml = os.path.join(self.directory, "qiproject.xml")
         if not os.path.exists(project_xml):
             return
-        self.config.read(project_xml)
-        self.depends  = self.config.depends
-        self.rdepends = self.config.rdepends
+        # The config is shared with the other users of
+        # qibuild.config.read_project_config, so copy the deps
+        self.config   = qibuild.config.read_project_config(project_xml)
+        self.depends  = set(self.config.depends)
+        self.rdepends = set(self.config.rdepends)
 
     def set_custom_build_directory(self, build_dir):
         """ could be used to override the default build_directory
@@ -101,15 +103,14 @@ def name_from_directory(project_dir):
     If such a section can not be found, simply return
     the base name of the directory
     """
-    # FIXME: qiproject.xml is read twice!
-    # once for finding project names, and an other time for
-    # loading complete configuration (with {r,}depends)
+    # Note: qiproject.xml is only parsed once, the result
+    # is re-used when loading complete configuration
+    # (see qibuild.config.read_project_config)
     handle_old_manifest(project_dir)
     xml = os.path.join(project_dir, "qiproject.xml")
     if not os.path.exists(xml):
         return os.path.basename(project_dir)
-    p_cfg = qibuild.config.ProjectConfig()
-    p_cfg.read(xml)
+    p_cfg = qibuild.config.read_project_config(xml)
     return p_cfg.name
 
 
@@ -192,6 +193,8 @@ def update_project(project, toc):
 def bootstrap_project(project, toc):
     """ Create the magic build/dependencies.cmake file
 
+    The file is only written if its contents have changed,
+    and the contents are returned.
 
     """
     # To be written in dependencies.cmake
@@ -256,8 +259,13 @@ endif()
 
     dep_cmake = os.path.join(project.build_directory, "dependencies.cmake")
 
+    if os.path.exists(dep_cmake):
+        with open(dep_cmake, "r") as fp:
+            if fp.read() == to_write:
+                return to_write
     with open(dep_cmake, "w") as fp:
         fp.write(to_write)
+    return to_write
 
 
 def handle_old_manifest(directory):
@@ -272,3 +280,4 @@ def handle_old_manifest(directory):
             xml = qibuild.config.convert_project_manifest(qibuild_manifest)
             with open(project_xml, "w") as fp:
                 fp.write(xml)
+            qibuild.configcache.invalidate(project_xml)
@@ -0,0 +1,137 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+""" This module contains the ProjectIndex class.
+
+Exploring a big worktree looking for git and qibuild projects
+is slow, so the results of the exploration are stored in
+.qi/projects.idx, along with the mtime of every directory
+that was visited.
+
+Adding or removing a file in a directory always changes the mtime
+of the directory, so the next time the worktree is explored, only
+directories whose mtime has changed are listed again.
+
+"""
+
+import os
+import time
+import logging
+import threading
+import cPickle
+
+import qibuild.sh
+import qibuild.worktree
+
+LOGGER = logging.getLogger("qibuild.project_index")
+
+# Bump this when changing the layout of the entries:
+INDEX_VERSION = 1
+
+# Directories modified less than RACY_DELAY seconds before
+# the exploration started are not trusted: they may be changed
+# again without their mtime changing.
+RACY_DELAY = 2
+
+
+def get_index_path(work_tree):
+    """ Return the path of the project index of a worktree
+
+    """
+    return os.path.join(work_tree, ".qi", "projects.idx")
+
+
+class ProjectIndex:
+    """ A persistent cache for :py:func:`qibuild.worktree.search_projects`
+
+    Each entry is a tuple (mtime, markers, subdirs) where:
+      - mtime is the mtime of the directory when it was listed,
+        or None if it should be listed again next time
+      - markers is the list of files from
+        qibuild.worktree.PROJECT_MARKERS found in the directory
+      - subdirs is the list of the names of the sub-directories
+
+    """
+    def __init__(self, index_path, rescan=False):
+        self.index_path = index_path
+        self.entries = dict()
+        # Entries visited during this run, only those are saved
+        self._visited = dict()
+        self._scan_start = time.time()
+        self._lock = threading.Lock()
+        # Directories re-used from the index, and directories listed
+        self.hits = 0
+        self.rescans = 0
+        if not rescan:
+            self.load()
+
+    def load(self):
+        """ Read the index from disk.
+        An unreadable or outdated index is simply ignored
+
+        """
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "rb") as fp:
+                (version, entries) = cPickle.load(fp)
+        except Exception, e:
+            LOGGER.debug("Ignoring invalid index %s: %s", self.index_path, e)
+            return
+        if version != INDEX_VERSION:
+            return
+        self.entries = entries
+
+    def save(self):
+        """ Write the index back to disk.
+        Does nothing if no directory has changed since the index was read
+
+        """
+        if self.rescans == 0 and self._visited == self.entries:
+            return
+        to_write = (INDEX_VERSION, self._visited)
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as fp:
+                cPickle.dump(to_write, fp, cPickle.HIGHEST_PROTOCOL)
+            qibuild.sh.rm(self.index_path)
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError), e:
+            LOGGER.debug("Could not write index %s: %s", self.index_path, e)
+
+    def list_directory(self, directory):
+        """ Same as :py:func:`qibuild.worktree.list_directory`,
+        but only list the directory if it has changed since
+        it was last indexed.
+
+        Returns None if the directory can not be read.
+        This is called from several threads.
+
+        """
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return None
+        entry = self.entries.get(directory)
+        if entry is not None and entry[0] is not None and entry[0] == mtime:
+            with self._lock:
+                self.hits += 1
+                self._visited[directory] = entry
+            return entry[1:]
+
+        (markers, subdirs) = qibuild.worktree.list_directory(directory)
+        if mtime >= self._scan_start - RACY_DELAY:
+            mtime = None
+        with self._lock:
+            self.rescans += 1
+            self._visited[directory] = (mtime, markers, subdirs)
+        return (markers, subdirs)
+
+    def search_projects(self, directory, depth=4):
+        """ Same as :py:func:`qibuild.worktree.search_projects`,
+        using and updating the index
+
+        """
+        return qibuild.worktree.search_projects(directory, depth,
+            list_dir=self.list_directory)
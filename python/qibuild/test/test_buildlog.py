@@ -0,0 +1,105 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.buildlog
+
+"""
+
+import os
+import sys
+import gzip
+import tempfile
+import unittest
+
+import qibuild
+from qibuild.buildlog import BuildLog, find_lines, read_index
+
+
+class BuildLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-buildlog")
+        self.log_path = os.path.join(self.tmp, "build.log.gz")
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def write_log(self, lines):
+        """ Write the lines by chunks of various sizes """
+        log = BuildLog(self.log_path)
+        text = "".join(x + "\n" for x in lines)
+        pos = 0
+        size = 1
+        while pos < len(text):
+            log.write(text[pos:pos+size], "stdout")
+            pos += size
+            size = (size * 7) % 65536 + 1
+        log.close()
+
+    def test_index(self):
+        lines = ["[ %i%%] Building CXX object foo_%i.o" % (i % 100, i)
+                 for i in range(20000)]
+        lines[10] = "foo.cpp:12:3: warning: unused variable 'x'"
+        lines[15000] = "foo.cpp:42:1: error: expected ';'"
+        lines[15001] = "make[2]: *** [foo.o] Error 1"
+        lines[19999] = "bar.cpp(3): error C2065: 'y': undeclared identifier"
+        self.write_log(lines)
+        # The log is a normal gzip file, with several members
+        with open(self.log_path, "rb") as fp:
+            self.assertTrue(len(fp.read()) < 200 * 1024)
+        fp = gzip.open(self.log_path, "rb")
+        self.assertEquals(fp.read().splitlines(), lines)
+        fp.close()
+        offsets = set(x[2] for x in read_index(self.log_path))
+        self.assertTrue(len(offsets) > 1)
+
+        errors = find_lines(self.log_path, kinds=["error"])
+        self.assertEquals([(x[0], x[1]) for x in errors],
+            [("error", 15001), ("error", 15002), ("error", 20000)])
+        self.assertEquals(errors[0][2], [(15001, lines[15000])])
+        self.assertEquals(errors[2][2], [(20000, lines[19999])])
+        warnings = find_lines(self.log_path, kinds=["warning"], context=2)
+        self.assertEquals(warnings[0][2],
+            [(9 + i, lines[8 + i]) for i in range(5)])
+
+    def test_streams_not_mixed(self):
+        log = BuildLog(self.log_path)
+        log.write("foo.cpp:1: warn", "stderr")
+        log.write("building\n", "stdout")
+        log.write("ing: oops\nfoo.cpp:2: error: oops", "stderr")
+        log.close()
+        fp = gzip.open(self.log_path, "rb")
+        self.assertEquals(fp.read(),
+            "building\nfoo.cpp:1: warning: oops\nfoo.cpp:2: error: oops\n")
+        fp.close()
+        self.assertEquals([x[:2] for x in read_index(self.log_path)],
+            [("warning", 2), ("error", 3)])
+
+    def test_no_new_line(self):
+        log = BuildLog(self.log_path)
+        for i in range(20000):
+            log.write("progress %i%%\r" % i, "stdout")
+            self.assertTrue(len(log._pending["stdout"]) <=
+                            qibuild.buildlog.MAX_PENDING_SIZE)
+        log.write("\nfoo.cpp:2: error: oops\n", "stdout")
+        log.close()
+        fp = gzip.open(self.log_path, "rb")
+        lines = fp.read().split("\n")
+        fp.close()
+        self.assertEquals(len(lines), 3)
+        self.assertTrue(lines[0].endswith("progress 19999%\r"))
+        self.assertEquals([x[:2] for x in read_index(self.log_path)],
+            [("error", 2)])
+
+    def test_call(self):
+        cmd = [sys.executable, "-c",
+               "import sys; print 'ok'; sys.stderr.write('a.c:1: error: no\\n');"
+               "sys.exit(1)"]
+        self.assertRaises(qibuild.command.CommandFailedException,
+            qibuild.command.call, cmd, log_path=self.log_path)
+        errors = find_lines(self.log_path, kinds=["error"])
+        self.assertEquals(errors[0][2][0][1], "a.c:1: error: no")
+
+
+if __name__ == "__main__":
+    unittest.main()
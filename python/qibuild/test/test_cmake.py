@@ -0,0 +1,131 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for the compiler probes seed in qibuild.cmake
+
+"""
+
+import os
+import tempfile
+import unittest
+
+import qibuild
+from qibuild.cmake import get_seed_key, is_seed_valid, write_seed
+from qibuild.cmake import copy_seed_platform_files
+
+CACHE = """
+# This is the CMakeCache file.
+//C compiler
+CMAKE_C_COMPILER:FILEPATH={compiler}
+CMAKE_DLLTOOL:FILEPATH=CMAKE_DLLTOOL-NOTFOUND
+CMAKE_BUILD_TYPE:STRING=DEBUG
+HAVE_STDINT_H:INTERNAL=1
+HELLO_DEPENDS:STRING=world
+"""
+
+
+class SeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-cmake-seed")
+        self.compiler = os.path.join(self.tmp, "cc")
+        with open(self.compiler, "w") as fp:
+            fp.write("compiler")
+        self.cache = os.path.join(self.tmp, "CMakeCache.txt")
+        with open(self.cache, "w") as fp:
+            fp.write(CACHE.format(compiler=self.compiler))
+        self.toolchain_file = os.path.join(self.tmp, "toolchain.cmake")
+        with open(self.toolchain_file, "w") as fp:
+            fp.write("set(FOO 1)\n")
+        self.args = ["-G", "Unix Makefiles",
+                     "-DCMAKE_TOOLCHAIN_FILE=%s" % self.toolchain_file]
+        self.seed_path = os.path.join(self.tmp, ".qi", "seed.cmake")
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def test_write_seed(self):
+        key = get_seed_key(self.args, env=dict())
+        self.assertFalse(is_seed_valid(self.seed_path, key))
+        write_seed(self.seed_path, key, self.cache)
+        self.assertTrue(is_seed_valid(self.seed_path, key))
+        with open(self.seed_path, "r") as fp:
+            contents = fp.read()
+        self.assertTrue('set(CMAKE_C_COMPILER "%s" CACHE FILEPATH "")' %
+            self.compiler in contents)
+        for not_expected in ["DLLTOOL", "CMAKE_BUILD_TYPE", "HELLO_DEPENDS",
+                             "HAVE_STDINT_H"]:
+            self.assertFalse(not_expected in contents, not_expected)
+
+    def test_platform_files(self):
+        platform_dir = os.path.join(self.tmp, "CMakeFiles", "2.8.12")
+        qibuild.sh.mkdir(os.path.join(platform_dir, "CompilerIdC"),
+                         recursive=True)
+        for name in ["CMakeSystem.cmake", "CMakeCCompiler.cmake",
+                     "CMakeDetermineCompilerABI_C.bin"]:
+            with open(os.path.join(platform_dir, name), "w") as fp:
+                fp.write(name)
+        key = get_seed_key(self.args, env=dict())
+        write_seed(self.seed_path, key, self.cache)
+        with open(self.seed_path, "r") as fp:
+            contents = fp.read()
+        self.assertTrue('set(CMAKE_PLATFORM_INFO_INITIALIZED "1" '
+                        'CACHE INTERNAL "")' in contents)
+        build_dir = os.path.join(self.tmp, "build")
+        copy_seed_platform_files(self.seed_path, build_dir)
+        copied = os.path.join(build_dir, "CMakeFiles", "2.8.12")
+        self.assertEquals(sorted(os.listdir(copied)),
+                          ["CMakeCCompiler.cmake", "CMakeSystem.cmake"])
+        with open(os.path.join(copied, "CMakeCCompiler.cmake"), "r") as fp:
+            self.assertEquals(fp.read(), "CMakeCCompiler.cmake")
+
+    def test_no_key(self):
+        key = get_seed_key(self.args, env=dict())
+        write_seed(self.seed_path, key, self.cache)
+        with open(self.seed_path, "r") as fp:
+            lines = fp.readlines()
+        with open(self.seed_path, "w") as fp:
+            fp.writelines(x for x in lines if not x.startswith("# key:"))
+        self.assertFalse(is_seed_valid(self.seed_path, key))
+
+    def test_checks_not_shared(self):
+        # Two projects using the same toolchain, but with different
+        # include flags: HAVE_FOO is only true for the first one
+        key = get_seed_key(self.args, env=dict())
+        caches = dict()
+        for (name, have_foo) in [("a", "1"), ("b", "")]:
+            caches[name] = os.path.join(self.tmp, name, "CMakeCache.txt")
+            qibuild.sh.mkdir(os.path.dirname(caches[name]))
+            with open(caches[name], "w") as fp:
+                fp.write(CACHE.format(compiler=self.compiler))
+                fp.write("HAVE_FOO:INTERNAL=%s\n" % have_foo)
+        write_seed(self.seed_path, key, caches["a"])
+        with open(self.seed_path, "r") as fp:
+            contents = fp.read()
+        self.assertTrue("CMAKE_C_COMPILER" in contents)
+        # so b still runs its own check
+        self.assertFalse("HAVE_FOO" in contents)
+        write_seed(self.seed_path, key, caches["b"])
+        with open(self.seed_path, "r") as fp:
+            self.assertEquals(fp.read(), contents)
+
+    def test_invalidation(self):
+        key = get_seed_key(self.args, env=dict())
+        write_seed(self.seed_path, key, self.cache)
+        # Changing the generator, the compiler env vars or the toolchain
+        # file changes the key
+        other_args = ["-G", "Ninja"] + self.args[2:]
+        self.assertNotEquals(get_seed_key(other_args, env=dict()), key)
+        self.assertNotEquals(get_seed_key(self.args, env={"CC" : "clang"}), key)
+        with open(self.toolchain_file, "w") as fp:
+            fp.write("set(FOO 2)\n")
+        self.assertNotEquals(get_seed_key(self.args, env=dict()), key)
+        # Changing the compiler invalidates the seed
+        self.assertTrue(is_seed_valid(self.seed_path, key))
+        with open(self.compiler, "w") as fp:
+            fp.write("new compiler")
+        self.assertFalse(is_seed_valid(self.seed_path, key))
+
+
+if __name__ == "__main__":
+    unittest.main()
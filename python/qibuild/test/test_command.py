@@ -0,0 +1,124 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.command.call
+
+"""
+
+import os
+import sys
+import StringIO
+import tempfile
+import unittest
+
+import qibuild
+from qibuild.command import TailBuffer
+
+# Write num_lines lines, alternating between stdout and stderr
+# if num_streams is 2, then exit with the given return code
+SCRIPT = """
+import sys
+(num_lines, num_streams, retcode) = [int(x) for x in sys.argv[1:]]
+for i in range(num_lines):
+    stream = [sys.stdout, sys.stderr][i % num_streams]
+    stream.write("line %i\\n" % i)
+    stream.flush()
+sys.exit(retcode)
+"""
+
+
+class CallTestCase(unittest.TestCase):
+    def call(self, num_lines, num_streams, retcode):
+        out = StringIO.StringIO()
+        cmd = [sys.executable, "-c", SCRIPT, str(num_lines), str(num_streams),
+               str(retcode)]
+        try:
+            qibuild.command.call(cmd, out=out)
+        finally:
+            self.out = out.getvalue()
+
+    def test_last_lines_on_failure(self):
+        self.assertRaises(qibuild.command.CommandFailedException,
+                          self.call, 1000, 1, 2)
+        if not sys.stdout.isatty():
+            lines = self.out.splitlines()
+            self.assertEquals(len(lines), 300)
+            self.assertEquals(lines[0], "line 700")
+            self.assertEquals(lines[-1], "line 999")
+
+    def test_large_output(self):
+        # Both pipes are filled, this must not dead lock
+        self.call(100000, 2, 0)
+
+    def test_tail_bytes(self):
+        tail = TailBuffer(300, 100)
+        for i in range(1000):
+            tail.append("%08i\n" % i, "stdout")
+        res = tail.get()
+        self.assertTrue(len(res) <= 100)
+        self.assertTrue(res.endswith("00000999\n"))
+        self.assertTrue(tail._bytes < 200)
+
+    def test_tail_incomplete_lines(self):
+        tail = TailBuffer(3, 1024)
+        tail.append("a", "stdout")
+        tail.append("b\n", "stderr")
+        tail.append("c\n", "stdout")
+        tail.append("no new line", "stderr")
+        self.assertEquals(tail.get(), "b\nac\nno new line\n")
+
+    def test_tail_no_new_line(self):
+        tail = TailBuffer(3, 100)
+        for i in range(1000):
+            tail.append("progress %i%%\r" % i, "stdout")
+        self.assertTrue(len(tail._pending["stdout"]) <= 100)
+        res = tail.get()
+        self.assertTrue(len(res) <= 100)
+        self.assertTrue(res.endswith("progress 999%\r\n"))
+
+
+class FindProgramTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-find-program")
+        self.bin_dirs = [os.path.join(self.tmp, x) for x in ["a", "b"]]
+        for bin_dir in self.bin_dirs:
+            qibuild.sh.mkdir(bin_dir)
+        self.env = {"PATH" : os.pathsep.join(self.bin_dirs)}
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def add_program(self, bin_dir, name):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as fp:
+            fp.write("#!/bin/sh\n")
+        os.chmod(path, 0755)
+        return path
+
+    def test_cached(self):
+        foo = self.add_program(self.bin_dirs[1], "foo")
+        self.assertEquals(qibuild.command.find_program("foo", env=self.env), foo)
+        # A program added earlier in the PATH is not seen, as long
+        # as the cached one did not change
+        other_foo = self.add_program(self.bin_dirs[0], "foo")
+        self.assertEquals(qibuild.command.find_program("foo", env=self.env), foo)
+        # An other PATH is an other key
+        env = {"PATH" : self.bin_dirs[0]}
+        self.assertEquals(qibuild.command.find_program("foo", env=env), other_foo)
+        qibuild.command.clear_programs_cache()
+        self.assertEquals(qibuild.command.find_program("foo", env=self.env),
+                          other_foo)
+
+    def test_revalidated(self):
+        foo = self.add_program(self.bin_dirs[0], "foo")
+        self.assertEquals(qibuild.command.find_program("foo", env=self.env), foo)
+        qibuild.sh.rm(foo)
+        self.assertEquals(qibuild.command.find_program("foo", env=self.env), None)
+        other_foo = self.add_program(self.bin_dirs[1], "foo")
+        self.assertEquals(qibuild.command.find_program("foo", env=self.env),
+                          other_foo)
+
+
+if __name__ == "__main__":
+    unittest.main()
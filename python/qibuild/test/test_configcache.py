@@ -0,0 +1,70 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.configcache
+
+"""
+
+import os
+import tempfile
+import unittest
+
+import qibuild
+import qibuild.configcache
+
+
+class ConfigCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-configcache")
+        self.cfg_path = os.path.join(self.tmp, "toolchains.cfg")
+        self.parsed = list()
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def parse(self, path):
+        self.parsed.append(path)
+        return qibuild.configcache.parse_cfg(path)
+
+    def write_cfg(self, contents):
+        with open(self.cfg_path, "w") as fp:
+            fp.write(contents)
+
+    def test_parsed_once(self):
+        self.write_cfg("[toolchains]\nlinux32=\n")
+        first = qibuild.configcache.read(self.cfg_path, self.parse)
+        second = qibuild.configcache.read(self.cfg_path, self.parse)
+        self.assertTrue(first is second)
+        self.assertEquals(len(self.parsed), 1)
+        self.assertEquals(first.options("toolchains"), ["linux32"])
+
+    def test_changed(self):
+        self.assertEquals(qibuild.configcache.read(self.cfg_path,
+                          self.parse).sections(), list())
+        # Created
+        self.write_cfg("[toolchains]\nlinux32=\n")
+        config = qibuild.configcache.read(self.cfg_path, self.parse)
+        self.assertEquals(config.options("toolchains"), ["linux32"])
+        # Modified (the size changes)
+        self.write_cfg("[toolchains]\nlinux32=\nlinux64=\n")
+        config = qibuild.configcache.read(self.cfg_path, self.parse)
+        self.assertEquals(config.options("toolchains"), ["linux32", "linux64"])
+        self.assertEquals(len(self.parsed), 3)
+
+    def test_invalidate(self):
+        self.write_cfg("[toolchains]\nlinux32=\n")
+        os.utime(self.cfg_path, (1000000000, 1000000000))
+        qibuild.configcache.read(self.cfg_path, self.parse)
+        # Same size, same mtime: only invalidate() can tell
+        self.write_cfg("[toolchains]\nlinux64=\n")
+        os.utime(self.cfg_path, (1000000000, 1000000000))
+        config = qibuild.configcache.read(self.cfg_path, self.parse)
+        self.assertEquals(config.options("toolchains"), ["linux32"])
+        qibuild.configcache.invalidate(self.cfg_path)
+        config = qibuild.configcache.read(self.cfg_path, self.parse)
+        self.assertEquals(config.options("toolchains"), ["linux64"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,423 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.ctest
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import unittest
+
+import qibuild
+import qibuild.ctest
+import qibuild.durations
+import qitoolchain
+
+# A fake test, writing when it starts and when it stops
+# in a log file
+FAKE_TEST = """
+import sys
+import time
+(log, name, duration, retcode) = sys.argv[1:]
+with open(log, "a") as fp:
+    fp.write("start %s %f\\n" % (name, time.time()))
+time.sleep(float(duration))
+with open(log, "a") as fp:
+    fp.write("stop %s %f\\n" % (name, time.time()))
+sys.exit(int(retcode))
+"""
+
+# A fake gtest test, with 10 test cases, honoring GTEST_TOTAL_SHARDS
+# and GTEST_SHARD_INDEX
+FAKE_GTEST = """
+import os
+import sys
+xml_out = sys.argv[1][len("--gtest_output=xml:"):]
+total = int(os.environ.get("GTEST_TOTAL_SHARDS", 1))
+index = int(os.environ.get("GTEST_SHARD_INDEX", 0))
+cases = [i for i in range(10) if i % total == index]
+with open(xml_out, "w") as fp:
+    fp.write('<testsuites tests="%i" failures="0" disabled="0" errors="0" time="0.1">' % len(cases))
+    fp.write('<testsuite name="Suite" tests="%i" failures="0" disabled="0" errors="0" time="0.1">' % len(cases))
+    for i in cases:
+        fp.write('<testcase name="case_%i" status="run" time="0" />' % i)
+    fp.write('</testsuite></testsuites>')
+"""
+
+# A test writing a lot of lines, then failing
+CHATTY_TEST = """
+import sys
+for i in range(100000):
+    sys.stdout.write("line %i\\n" % i)
+sys.exit(1)
+"""
+
+# A test that times out, leaving a child process which
+# still holds its output
+ORPHAN_TEST = """
+import sys
+import time
+import subprocess
+subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+time.sleep(10)
+"""
+
+# Runs ORPHAN_TEST with a short timeout, then exits
+RUN_ORPHAN_TEST = """
+import os
+import sys
+import qibuild.ctest
+orphan_test = sys.argv[1]
+qibuild.ctest.run_test(os.path.dirname(orphan_test), "orphan",
+    [sys.executable, orphan_test], {"TIMEOUT" : "1"}, os.environ.copy())
+"""
+
+
+class FakeProject:
+    """ Just what qibuild.ctest needs """
+    def __init__(self, directory):
+        self.name = "fake"
+        self.directory = directory
+        self.build_directory = os.path.join(directory, "build")
+
+
+class CTestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-ctest")
+        self.project = FakeProject(self.tmp)
+        qibuild.sh.mkdir(self.project.build_directory)
+        self.fake_test = os.path.join(self.tmp, "fake_test.py")
+        with open(self.fake_test, "w") as fp:
+            fp.write(FAKE_TEST)
+        self.log = os.path.join(self.tmp, "log")
+        self.tests = list()
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def add_fake(self, name, duration=0.2, retcode=0, **properties):
+        """ Add a test to the CTestTestfile.cmake """
+        properties.setdefault("TIMEOUT", "20")
+        self.tests.append('add_test(%s "%s" "%s" "%s" "%s" "%s" "%i")\n' % (
+            name, sys.executable, self.fake_test, self.log, name,
+            duration, retcode))
+        props = " ".join('%s "%s"' % x for x in sorted(properties.items()))
+        self.tests.append("set_tests_properties(%s PROPERTIES %s)\n" % (
+            name, props))
+
+    def launch(self, num_jobs, **kwargs):
+        ctest_file = os.path.join(self.project.build_directory,
+                                  "CTestTestfile.cmake")
+        with open(ctest_file, "w") as fp:
+            fp.writelines(self.tests)
+        build_env = kwargs.pop("build_env", None)
+        if build_env is None:
+            build_env = os.environ.copy()
+        return qibuild.ctest.run_tests(self.project, build_env,
+            num_jobs=num_jobs, **kwargs)
+
+    def get_intervals(self):
+        """ name -> (start, stop) for each test run """
+        res = dict()
+        with open(self.log, "r") as fp:
+            for line in fp:
+                (what, name, when) = line.split()
+                res.setdefault(name, [None, None])
+                res[name][what == "stop"] = float(when)
+        return res
+
+    def overlap(self, intervals, a, b):
+        (start_a, stop_a) = intervals[a]
+        (start_b, stop_b) = intervals[b]
+        return start_a < stop_b and start_b < stop_a
+
+    def test_parallel(self):
+        for i in range(4):
+            self.add_fake("test_%i" % i, duration=0.5)
+        start = time.time()
+        (ok, summary) = self.launch(num_jobs=4)
+        self.assertTrue(ok)
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertTrue(summary.startswith("Ran 4 tests, 0 failures"))
+        results_dir = os.path.join(self.tmp, "build-tests", "results")
+        self.assertEquals(sorted(os.listdir(results_dir)),
+            sorted(["test_%i.xml" % i for i in range(4)] +
+                   ["test_%i.log" % i for i in range(4)]))
+
+    def test_deterministic_summary(self):
+        self.add_fake("slow_fail", duration=0.5, retcode=1)
+        self.add_fake("fast_fail", duration=0.1, retcode=1)
+        self.add_fake("pass")
+        (ok, summary) = self.launch(num_jobs=3)
+        self.assertFalse(ok)
+        self.assertEquals(summary,
+            "Ran 3 tests, 2 failures\n  * slow_fail\n  * fast_fail\n")
+
+    def test_run_serial(self):
+        self.add_fake("a")
+        self.add_fake("serial", RUN_SERIAL="ON")
+        self.add_fake("b")
+        self.launch(num_jobs=4)
+        intervals = self.get_intervals()
+        self.assertFalse(self.overlap(intervals, "a", "serial"))
+        self.assertFalse(self.overlap(intervals, "b", "serial"))
+
+    def test_resource_lock_and_processors(self):
+        self.add_fake("db_1", RESOURCE_LOCK="db")
+        self.add_fake("db_2", RESOURCE_LOCK="db;other")
+        self.add_fake("big", PROCESSORS="3")
+        self.add_fake("small")
+        self.launch(num_jobs=4)
+        intervals = self.get_intervals()
+        self.assertFalse(self.overlap(intervals, "db_1", "db_2"))
+        # big needs 3 jobs, db_1 and db_2 and small one each:
+        self.assertFalse(self.overlap(intervals, "big", "small") and
+                         self.overlap(intervals, "big", "db_1"))
+
+    def test_timeout(self):
+        self.add_fake("too_long", duration=5, TIMEOUT="1")
+        self.add_fake("short")
+        (ok, summary) = self.launch(num_jobs=2)
+        self.assertFalse(ok)
+        self.assertTrue("too_long" in summary)
+
+    def test_timeout_with_orphan(self):
+        orphan_test = os.path.join(self.tmp, "orphan_test.py")
+        with open(orphan_test, "w") as fp:
+            fp.write(ORPHAN_TEST)
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", RUN_ORPHAN_TEST,
+                               orphan_test], env=env)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_test_name(self):
+        self.add_fake("a")
+        self.add_fake("b")
+        (ok, summary) = self.launch(num_jobs=1, test_name="b")
+        self.assertTrue(ok)
+        self.assertEquals(self.get_intervals().keys(), ["b"])
+
+    def test_longest_first(self):
+        self.add_fake("short", duration=0.1)
+        self.add_fake("long", duration=0.6)
+        self.add_fake("medium", duration=0.3)
+        self.launch(num_jobs=1)
+        durations = qibuild.ctest.get_durations(self.project)
+        self.assertTrue(durations.get("long") > durations.get("short"))
+        # Second run: longest tests first, so short
+        # has to wait for medium to finish
+        qibuild.sh.rm(self.log)
+        self.launch(num_jobs=2)
+        intervals = self.get_intervals()
+        self.assertTrue(intervals["short"][0] >= intervals["medium"][1])
+
+    def test_predict_schedule(self):
+        tests = [("a", [], dict()), ("b", [], dict()), ("c", [], dict()),
+                 ("serial", [], {"RUN_SERIAL" : "ON"})]
+        expected = {"a" : 4, "b" : 1, "c" : 2, "serial" : 1}
+        (total, schedule, critical_path) = \
+            qibuild.ctest.predict_schedule(tests, expected, 2)
+        self.assertEquals(total, 5)
+        self.assertEquals(schedule["a"], (0, 4))
+        self.assertEquals(schedule["serial"], (4, 5))
+        self.assertEquals(critical_path, ["a", "serial"])
+
+    def test_unknown_durations(self):
+        durations = qibuild.ctest.get_durations(self.project)
+        tests = [("a", [], dict()), ("b", [], dict())]
+        expected = qibuild.ctest.get_expected_durations(tests, durations)
+        self.assertEquals(expected["a"], qibuild.ctest.DEFAULT_DURATION)
+        durations.record("a", 42)
+        expected = qibuild.ctest.get_expected_durations(tests, durations)
+        self.assertEquals(expected["b"], 42)
+
+    def test_gtest_shards(self):
+        fake_gtest = os.path.join(self.tmp, "fake_gtest.py")
+        with open(fake_gtest, "w") as fp:
+            fp.write(FAKE_GTEST)
+        xml_out = os.path.join(self.tmp, "build-tests", "results", "gtest.xml")
+        qibuild.sh.mkdir(os.path.dirname(xml_out), recursive=True)
+        self.tests.append('add_test(gtest "%s" "%s" "--gtest_output=xml:%s")\n' % (
+            sys.executable, fake_gtest, xml_out))
+        self.tests.append('set_tests_properties(gtest PROPERTIES TIMEOUT "20")\n')
+        self.add_fake("other")
+        (ok, summary) = self.launch(num_jobs=1, gtest_shards=3)
+        self.assertTrue(ok)
+        self.assertTrue(summary.startswith("Ran 2 tests, 0 failures"))
+        tree = qibuild.ctest.etree.parse(xml_out)
+        suites = tree.getroot().findall("testsuite")
+        self.assertEquals(len(suites), 1)
+        self.assertEquals(suites[0].get("tests"), "10")
+        self.assertEquals(len(suites[0].findall("testcase")), 10)
+        self.assertEquals(tree.getroot().get("tests"), "10")
+
+    def test_result_cache(self):
+        sdk_dir = os.path.join(self.tmp, "sdk")
+        lib = os.path.join(sdk_dir, "lib", "libfoo.so.1")
+        qibuild.sh.mkdir(os.path.dirname(lib), recursive=True)
+        with open(lib, "w") as fp:
+            fp.write("v1")
+        self.add_fake("a")
+        self.add_fake("b", retcode=1)
+        (ok, summary) = self.launch(num_jobs=1, sdk_dirs=[sdk_dir])
+        self.assertTrue(summary.startswith("Ran 2 tests, 1 failures\n"))
+        # Only the test that passed is cached, and its XML
+        # file is written again
+        results_dir = os.path.join(self.tmp, "build-tests", "results")
+        qibuild.sh.rm(results_dir)
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, sdk_dirs=[sdk_dir])
+        self.assertTrue(summary.startswith("Ran 2 tests, 1 failures (1 cached)"))
+        self.assertEquals(self.get_intervals().keys(), ["b"])
+        self.assertTrue(os.path.exists(os.path.join(results_dir, "a.xml")))
+        # Changing a library invalidates the cache
+        with open(lib, "w") as fp:
+            fp.write("v2")
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, sdk_dirs=[sdk_dir])
+        self.assertTrue(summary.startswith("Ran 2 tests, 1 failures\n"))
+        # And without sdk_dirs, the cache is not used
+        qibuild.sh.rm(self.log)
+        self.launch(num_jobs=1)
+        self.assertEquals(sorted(self.get_intervals().keys()), ["a", "b"])
+
+    def test_result_cache_toolchain(self):
+        sdk_dir = os.path.join(self.tmp, "sdk")
+        package = qitoolchain.Package("foo", os.path.join(self.tmp, "foo"))
+        package.version = "1"
+        build_env = os.environ.copy()
+        build_env["LD_LIBRARY_PATH"] = "/path/to/v1"
+        self.add_fake("a")
+        kwargs = dict(sdk_dirs=[sdk_dir], packages=[package])
+        self.launch(num_jobs=1, build_env=build_env.copy(), **kwargs)
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, build_env=build_env.copy(),
+                                    **kwargs)
+        self.assertTrue(summary.startswith("Ran 1 tests, 0 failures (1 cached)"))
+        # Upgrading a package invalidates the cache
+        package.version = "2"
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, build_env=build_env.copy(),
+                                    **kwargs)
+        self.assertEquals(self.get_intervals().keys(), ["a"])
+        # So does changing the library path
+        build_env["LD_LIBRARY_PATH"] = "/path/to/v2"
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, build_env=build_env.copy(),
+                                    **kwargs)
+        self.assertEquals(self.get_intervals().keys(), ["a"])
+
+    def test_result_cache_fixed_test(self):
+        sdk_dir = os.path.join(self.tmp, "sdk")
+        results_dir = os.path.join(self.tmp, "build-tests", "results")
+        xml_path = os.path.join(results_dir, "a.xml")
+        self.add_fake("a", retcode=1)
+        (ok, summary) = self.launch(num_jobs=1, sdk_dirs=[sdk_dir])
+        self.assertFalse(ok)
+        with open(xml_path, "r") as fp:
+            self.assertTrue("<failure" in fp.read())
+        # The test is fixed
+        self.tests = list()
+        self.add_fake("a")
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, sdk_dirs=[sdk_dir])
+        self.assertTrue(ok)
+        with open(xml_path, "r") as fp:
+            self.assertFalse("<failure" in fp.read())
+        # And the cached result does not contain the failure either
+        qibuild.sh.rm(results_dir)
+        qibuild.sh.rm(self.log)
+        (ok, summary) = self.launch(num_jobs=1, sdk_dirs=[sdk_dir])
+        self.assertTrue(summary.startswith("Ran 1 tests, 0 failures (1 cached)"),
+                        summary)
+        with open(xml_path, "r") as fp:
+            self.assertFalse("<failure" in fp.read())
+
+    def test_output_spilled_to_log(self):
+        chatty_test = os.path.join(self.tmp, "chatty_test.py")
+        with open(chatty_test, "w") as fp:
+            fp.write(CHATTY_TEST)
+        self.tests.append('add_test(chatty "%s" "%s")\n' % (
+            sys.executable, chatty_test))
+        self.tests.append('set_tests_properties(chatty PROPERTIES TIMEOUT "20")\n')
+        (ok, summary) = self.launch(num_jobs=1)
+        self.assertFalse(ok)
+        results_dir = os.path.join(self.tmp, "build-tests", "results")
+        log_path = os.path.join(results_dir, "chatty.log")
+        with open(log_path, "r") as fp:
+            lines = fp.read().splitlines()
+        self.assertEquals(len(lines), 100000)
+        with open(os.path.join(results_dir, "chatty.xml"), "r") as fp:
+            xml = fp.read()
+        self.assertTrue(len(xml) < 2 * qibuild.command.OUTPUT_TAIL_BYTES)
+        self.assertTrue("line 0\n" in xml)
+        self.assertTrue("line 99999\n" in xml)
+        self.assertTrue("bytes skipped" in xml)
+        self.assertTrue("[[ATTACHMENT|%s]]" % log_path in xml)
+
+    def test_partition(self):
+        names = ["test_%02i" % i for i in range(20)]
+        shards = qibuild.ctest.partition_tests(names, 3)
+        self.assertEquals(sorted(len(x) for x in shards), [6, 7, 7])
+        self.assertEquals(sorted(sum(shards, list())), names)
+        # Does not depend on the order of the names
+        reverse = qibuild.ctest.partition_tests(names[::-1], 3)
+        self.assertEquals([sorted(x) for x in reverse], shards)
+        durations = {"a" : 4, "b" : 3, "c" : 2, "d" : 1}
+        shards = qibuild.ctest.partition_tests(["a", "b", "c", "d"], 2,
+                                               durations=durations)
+        self.assertEquals(shards, [["a", "d"], ["b", "c"]])
+
+    def test_merge_shard_results(self):
+        self.add_fake("a")
+        self.add_fake("b", retcode=1)
+        self.add_fake("c")
+        self.launch(num_jobs=1)
+        tests = qibuild.ctest.get_tests(self.project)
+        names = ["fake/%s" % x[0] for x in tests]
+        shards = qibuild.ctest.partition_tests(names, 2)
+        key = qibuild.ctest.get_partition_key(shards)
+        results_dir = qibuild.ctest.get_results_dir(self.project)
+        paths = list()
+        for (i, shard) in enumerate(shards):
+            to_run = [x for x in tests if "fake/%s" % x[0] in shard]
+            results = qibuild.ctest.run_test_list(self.project,
+                os.environ.copy(), to_run)
+            entries = [("fake", x, os.path.join(results_dir,
+                        x.test_name + ".xml")) for x in results]
+            path = os.path.join(self.tmp, "shard-%i.json" % i)
+            qibuild.ctest.write_shard_results(path, i, 2, key, entries)
+            paths.append(path)
+        out = os.path.join(self.tmp, "merged")
+        # Shards are numbered from 0, like --shard-index
+        error = None
+        try:
+            qibuild.ctest.merge_shard_results(paths[:1], out)
+        except Exception, e:
+            error = e
+        self.assertFalse(error is None)
+        self.assertTrue("Missing shards: 1 " in str(error), error)
+        (ok, summary) = qibuild.ctest.merge_shard_results(paths, out)
+        self.assertFalse(ok)
+        self.assertTrue(summary.startswith("Ran 3 tests in 2 shards, 1 failures"))
+        self.assertTrue("fake/b" in summary)
+        self.assertEquals(sorted(os.listdir(os.path.join(out, "fake"))),
+                          ["a.xml", "b.xml", "c.xml"])
+        durations = qibuild.durations.Durations(
+            os.path.join(out, "durations.json"))
+        self.assertEquals(sorted(durations.durations.keys()),
+                          ["fake/a", "fake/b", "fake/c"])
+        # Shards made from an other partition can not be merged
+        qibuild.ctest.write_shard_results(paths[1], 1, 2, "other", list())
+        self.assertRaises(Exception, qibuild.ctest.merge_shard_results,
+                          paths, out)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,7 +8,8 @@
 import unittest
 
 
-from qibuild.dependencies_solver import DependenciesSolver
+from qibuild.dependencies_solver import DependenciesSolver, DependencyGraph
+from qibuild.dependencies_solver import topological_sort
 
 
 class Project:
@@ -22,6 +23,25 @@ class Package:
         self.name = name
         self.depends = list()
 
+class CountingDeps(dict):
+    """ A dict name -> deps counting how many times
+    the nodes and the edges are visited
+
+    """
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.nodes = 0
+        self.edges = 0
+
+    def get(self, key, default=None):
+        self.nodes += 1
+        return self._iter_deps(dict.get(self, key, default))
+
+    def _iter_deps(self, deps):
+        for dep in deps:
+            self.edges += 1
+            yield dep
+
 class DependenciesSolverTestCase(unittest.TestCase):
 
     def test_bad_solve(self):
@@ -114,6 +134,44 @@ class DependenciesSolverTestCase(unittest.TestCase):
         self.assertEquals(projects,  ["big-lib", "my-exe"])
         self.assertEquals(packages,  [])
         self.assertEquals(not_found, [])
+    def test_shared_graph(self):
+        world = Project("world")
+        hello = Project("hello")
+        hello.depends = ["world"]
+        hello.rdepends = ["world"]
+        graph = DependencyGraph(projects=[world, hello])
+        dep_solver = DependenciesSolver(graph=graph)
+        self.assertEquals(dep_solver.solve(["hello"]),
+            (["world", "hello"], [], []))
+        dep_solver = DependenciesSolver(graph=graph, active_projects=["hello"])
+        self.assertEquals(dep_solver.solve(["world"], runtime=True),
+            (["world"], [], []))
+
+    def test_big_graph(self):
+        # A long chain, plus a lot of projects depending
+        # on every element of the chain
+        projects = list()
+        for i in range(5000):
+            project = Project("p%i" % i)
+            if i > 0:
+                project.depends = ["p%i" % (i - 1)]
+            projects.append(project)
+        for i in range(1000):
+            project = Project("top%i" % i)
+            project.depends = ["p4999"] + ["p%i" % j for j in range(0, 5000, 50)]
+            projects.append(project)
+        names = ["top%i" % i for i in range(1000)]
+        dep_solver = DependenciesSolver(projects=projects)
+        (res, _, _) = dep_solver.solve(names)
+        self.assertEquals(len(res), 6000)
+        self.assertEquals(res[:3], ["p0", "p1", "p2"])
+        self.assertEquals(res[-1], "top999")
+        # Each node and each edge is only visited once
+        deps = CountingDeps((x.name, x.depends) for x in projects)
+        self.assertEquals(topological_sort(deps, names), res)
+        self.assertEquals(deps.nodes, 6000)
+        self.assertEquals(deps.edges, 4999 + 1000 * 101)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,125 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.parallel
+
+"""
+
+import os
+import time
+import threading
+import unittest
+
+from qibuild.parallel import DagScheduler, TokenPool, MakeJobServer
+
+# a <- b <- d
+# a <- c
+# e
+DEPS = {
+    "a" : [],
+    "b" : ["a"],
+    "c" : ["a", "not-a-job"],
+    "d" : ["b"],
+    "e" : [],
+}
+NAMES = ["a", "b", "c", "d", "e"]
+
+
+class DagSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.started = list()
+        self.finished = list()
+        self.lock = threading.Lock()
+
+    def _job(self, to_fail=None):
+        def job(name):
+            with self.lock:
+                self.started.append(name)
+            for dep in DEPS[name]:
+                if dep in NAMES:
+                    self.assertTrue(dep in self.finished)
+            time.sleep(0.01)
+            if name == to_fail:
+                raise Exception("%s failed" % name)
+            with self.lock:
+                self.finished.append(name)
+            return name.upper()
+        return job
+
+    def test_all_jobs(self):
+        for num_jobs in [1, 2, 8]:
+            self.setUp()
+            done = list()
+            scheduler = DagScheduler(NAMES, DEPS.get, num_jobs=num_jobs)
+            ok = scheduler.run(self._job(),
+                on_done=lambda name, status: done.append((name, status)))
+            self.assertTrue(ok)
+            self.assertEquals(done, [(x, "ok") for x in NAMES])
+            self.assertEquals(scheduler.results["d"], "D")
+
+    def test_fail_fast(self):
+        scheduler = DagScheduler(NAMES, DEPS.get, num_jobs=1)
+        ok = scheduler.run(self._job(to_fail="a"))
+        self.assertFalse(ok)
+        self.assertEquals(scheduler.errors.keys(), ["a"])
+        self.assertEquals(self.started, ["a"])
+        self.assertEquals(sorted(scheduler.skipped), ["b", "c", "d", "e"])
+
+    def test_keep_going(self):
+        done = list()
+        scheduler = DagScheduler(NAMES, DEPS.get, num_jobs=2, keep_going=True)
+        ok = scheduler.run(self._job(to_fail="b"),
+            on_done=lambda name, status: done.append((name, status)))
+        self.assertFalse(ok)
+        self.assertEquals(done, [("a", "ok"), ("b", "failed"), ("c", "ok"),
+                                 ("d", "skipped"), ("e", "ok")])
+        self.assertEquals(scheduler.skipped, ["d"])
+
+    def test_critical_path(self):
+        scheduler = DagScheduler(NAMES, DEPS.get, num_jobs=1)
+        # e is long, but a -> b -> d is longer, and c is short
+        scheduler.use_critical_path({"a" : 1, "b" : 2, "c" : 1, "d" : 3, "e": 5})
+        self.assertEquals(scheduler.priorities["a"], 6)
+        scheduler.run(self._job())
+        self.assertEquals(self.started, ["a", "b", "e", "d", "c"])
+
+    def test_share(self):
+        shares = dict()
+        def job(name, share):
+            with self.lock:
+                shares[name] = share
+        scheduler = DagScheduler(NAMES, DEPS.get, num_jobs=4)
+        scheduler.run(job, with_share=True)
+        # a and e are started together
+        self.assertEquals(shares["a"], 2)
+        self.assertEquals(shares["e"], 2)
+        scheduler = DagScheduler(NAMES, DEPS.get, num_jobs=1)
+        scheduler.run(job, with_share=True)
+        self.assertEquals(set(shares.values()), set([1]))
+
+
+class TokenPoolTestCase(unittest.TestCase):
+    def _check_pool(self, pool):
+        self.assertEquals(pool.acquire(), 1)
+        self.assertTrue(pool.acquire(count=2) >= 1)
+        pool.release(1)
+        pool.release(1)
+        pool.close()
+
+    def test_token_pool(self):
+        pool = TokenPool(3)
+        self.assertEquals(pool.acquire(count=2), 2)
+        self.assertEquals(pool.acquire(count=2), 1)
+        pool.release(3)
+        self._check_pool(pool)
+
+    @unittest.skipUnless(os.name == "posix", "needs os.pipe")
+    def test_job_server(self):
+        pool = MakeJobServer(2)
+        self.assertTrue(pool.make_flags().startswith("-j --jobserver-fds="))
+        self._check_pool(pool)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,8 @@
 """
 
 import os
+import time
+import tempfile
 import qibuild
 import unittest
 from StringIO import StringIO
@@ -44,6 +46,36 @@ class ProjectConfigTestClass(unittest.TestCase):
         self.assertEqual(project_cfg.depends,  set(["bar", "baz", "eggs"]))
         self.assertEqual(project_cfg.rdepends, set(["bar", "baz", "spam"]))
 
+    def test_read_project_config_cache(self):
+        tmp = tempfile.mkdtemp(prefix="test-project-config")
+        try:
+            xml_path = os.path.join(tmp, "qiproject.xml")
+            with open(xml_path, "w") as fp:
+                fp.write('<project name="foo" />\n')
+            first = qibuild.config.read_project_config(xml_path)
+            second = qibuild.config.read_project_config(xml_path)
+            self.assertTrue(first is second)
+            self.assertEqual(qibuild.project.name_from_directory(tmp), "foo")
+
+            with open(xml_path, "w") as fp:
+                fp.write('<project name="bar">\n'
+                         '  <depends buildtime="true" names="spam" />\n'
+                         '</project>\n')
+            # Make sure the mtime changes even on coarse file systems:
+            future = time.time() + 10
+            os.utime(xml_path, (future, future))
+            third = qibuild.config.read_project_config(xml_path)
+            self.assertEqual(third.name, "bar")
+            self.assertEqual(third.depends, set(["spam"]))
+
+            # Shared with the other configuration files
+            qibuild.configcache.invalidate(xml_path)
+            fourth = qibuild.config.read_project_config(xml_path)
+            self.assertFalse(fourth is third)
+            self.assertEqual(fourth.name, "bar")
+        finally:
+            qibuild.sh.rm(tmp)
+
 
 if __name__ == "__main__":
     unittest.main()
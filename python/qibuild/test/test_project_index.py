@@ -0,0 +1,90 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.project_index
+
+"""
+
+import os
+import time
+import tempfile
+import unittest
+
+import qibuild
+from qibuild.project_index import ProjectIndex
+
+
+def touch(path):
+    """ Create an empty file """
+    qibuild.sh.mkdir(os.path.dirname(path), recursive=True)
+    with open(path, "w") as fp:
+        fp.write("")
+
+def make_old(directory):
+    """ Set the mtime of every directory in the past,
+    so that they are not considered as 'racy'
+
+    """
+    old = time.time() - 3600
+    for (root, dirs, _files) in os.walk(directory):
+        for d in dirs:
+            os.utime(os.path.join(root, d), (old, old))
+    os.utime(directory, (old, old))
+
+
+class ProjectIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-project-index")
+        self.index_path = os.path.join(self.tmp, "projects.idx")
+        self.work_tree = os.path.join(self.tmp, "work")
+        touch(os.path.join(self.work_tree, "foo", "qiproject.xml"))
+        touch(os.path.join(self.work_tree, "lib", "bar", "qibuild.manifest"))
+        qibuild.sh.mkdir(os.path.join(self.work_tree, "lib", ".git"), recursive=True)
+        touch(os.path.join(self.work_tree, "nested", ".qi", "spam", "qiproject.xml"))
+        touch(os.path.join(self.work_tree, "black", ".qiblacklist"))
+        touch(os.path.join(self.work_tree, "black", "eggs", "qiproject.xml"))
+        touch(os.path.join(self.work_tree, "a", "b", "c", "d", "qiproject.xml"))
+        make_old(self.work_tree)
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def _search(self):
+        index = ProjectIndex(self.index_path)
+        res = index.search_projects(self.work_tree)
+        index.save()
+        return (index, res)
+
+    def test_same_results(self):
+        expected = qibuild.worktree.search_projects(self.work_tree)
+        (_, res) = self._search()
+        self.assertEquals(res, expected)
+        (index, res) = self._search()
+        self.assertEquals(res, expected)
+        self.assertEquals(index.rescans, 0)
+        self.assertTrue(index.hits > 0)
+
+    def test_new_project(self):
+        self._search()
+        touch(os.path.join(self.work_tree, "lib", "baz", "qiproject.xml"))
+        (index, (_, src)) = self._search()
+        self.assertTrue(os.path.join(self.work_tree, "lib", "baz") in src)
+        # Only lib and lib/baz should have been listed again
+        self.assertEquals(index.rescans, 2)
+
+    def test_removed_project(self):
+        self._search()
+        qibuild.sh.rm(os.path.join(self.work_tree, "foo", "qiproject.xml"))
+        (_, (_, src)) = self._search()
+        self.assertFalse(os.path.join(self.work_tree, "foo") in src)
+
+    def test_rescan(self):
+        self._search()
+        index = ProjectIndex(self.index_path, rescan=True)
+        index.search_projects(self.work_tree)
+        self.assertEquals(index.hits, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,11 +10,13 @@
 import os
 import re
 import sys
+import time
 import difflib
 
 import unittest
 import qibuild
-import qibuild
+import qibuild.actions.make
+import qibuild.durations
 
 
 try:
@@ -45,10 +47,92 @@ class QiBuildTestCase(unittest.TestCase):
     def test_configure(self):
         self._run_action("configure", "world")
 
+    def test_configure_parallel(self):
+        self._run_action("configure", "-j", "4", "hello")
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        for name in ["world", "hello"]:
+            build_dir = toc.get_project(name).build_directory
+            self.assertTrue(os.path.exists(
+                os.path.join(build_dir, "CMakeCache.txt")))
+
+    def test_configure_seed(self):
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        qibuild.sh.rm(toc.get_seed_path())
+        self._run_action("configure", "-s", "world")
+        self.assertTrue(os.path.exists(toc.get_seed_path()))
+        self._run_action("configure", "-s", "hello")
+        # The compilers of hello were not identified again
+        cmake_files = os.path.join(toc.get_project("hello").build_directory,
+                                   "CMakeFiles")
+        versions = [x for x in os.listdir(cmake_files)
+                    if re.match(r"^\d+\.\d+", x)]
+        self.assertEquals(len(versions), 1)
+        platform_files = os.listdir(os.path.join(cmake_files, versions[0]))
+        self.assertTrue("CMakeSystem.cmake" in platform_files)
+        self.assertFalse([x for x in platform_files
+                          if x.startswith("CompilerId")])
+
+    def test_prepare_projects(self):
+        self._run_action("configure", "world")
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        toc.prepare_projects(["hello"])
+        build_env = toc.build_env.copy()
+        def no_graph():
+            raise Exception("Dependencies solved again")
+        toc.get_dependency_graph = no_graph
+        toc.configure_project(toc.get_project("hello"))
+        self.assertEquals(toc.get_sdk_dirs("hello"),
+                          [toc.get_project("world").get_sdk_dir()])
+        self.assertEquals(toc.build_env, build_env)
+
+    def test_configure_incremental(self):
+        self._run_action("configure", "hello")
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        build_dir = toc.get_project("hello").build_directory
+        cmake_cache = os.path.join(build_dir, "CMakeCache.txt")
+        dep_cmake = os.path.join(build_dir, "dependencies.cmake")
+        fingerprint = os.path.join(build_dir, qibuild.toc.CONFIGURE_FINGERPRINT)
+        self.assertTrue(os.path.exists(fingerprint))
+        # Nothing changed: cmake should not run again, and
+        # dependencies.cmake should not be re-written
+        old = int(time.time()) - 3600
+        os.utime(cmake_cache, (old, old))
+        os.utime(dep_cmake, (old, old))
+        self._run_action("configure", "hello")
+        self.assertEquals(os.stat(cmake_cache).st_mtime, old)
+        self.assertEquals(os.stat(dep_cmake).st_mtime, old)
+        # Changing a cmake flag runs cmake again:
+        self._run_action("configure", "hello", "-DFOO=BAR")
+        self.assertNotEquals(os.stat(cmake_cache).st_mtime, old)
+        self.assertEquals(os.stat(dep_cmake).st_mtime, old)
+        # So does --force
+        os.utime(cmake_cache, (old, old))
+        self._run_action("configure", "hello", "-DFOO=BAR", "--force")
+        self.assertNotEquals(os.stat(cmake_cache).st_mtime, old)
+
     def test_make(self):
         self._run_action("configure", "hello")
         self._run_action("make", "hello")
 
+    def test_make_parallel(self):
+        self._run_action("configure", "-j", "4", "hello")
+        self._run_action("make", "-j", "4", "--critical-path", "hello")
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        durations_path = qibuild.actions.make.get_durations_path(toc)
+        durations = qibuild.durations.Durations(durations_path)
+        self.assertTrue(durations.get("world") is not None)
+        self.assertTrue(durations.get("hello") is not None)
+
+    def test_build_log(self):
+        self._run_action("configure", "hello")
+        self._run_action("make", "hello")
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        build_dir = toc.get_project("hello").build_directory
+        for step in ["configure", "build"]:
+            log_path = qibuild.buildlog.get_log_path(build_dir, step)
+            self.assertTrue(os.path.exists(log_path))
+        self._run_action("log", "hello", "--errors", "--warnings")
+
     def test_make_without_configure(self):
         self.assertRaises(Exception, self._run_action, "make", "hello")
 
@@ -62,6 +146,50 @@ class QiBuildTestCase(unittest.TestCase):
         self._run_action("make", "hello")
         self._run_action("test", "hello")
 
+    def test_ctest_from_cwd(self):
+        self._run_action("configure", "hello")
+        self._run_action("make", "hello")
+        cwd = os.getcwd()
+        try:
+            # Outside a project, the project must be given
+            os.chdir(self.test_dir)
+            error = None
+            try:
+                self._run_action("test")
+            except Exception, e:
+                error = e
+            self.assertFalse(error is None)
+            self.assertTrue("Could not guess project name" in str(error),
+                            error)
+            os.chdir(os.path.join(self.test_dir, "hello"))
+            self._run_action("test")
+        finally:
+            os.chdir(cwd)
+
+    def test_list_tests(self):
+        self._run_action("configure", "hello")
+        self._run_action("make", "hello")
+        self._run_action("test", "hello", "-j", "2")
+        self._run_action("test", "hello", "--list", "--timings")
+        toc = qibuild.toc.toc_open(self.test_dir, args=self.args)
+        durations = qibuild.ctest.get_durations(toc.get_project("hello"))
+        self.assertTrue(durations.get("zero_test") is not None)
+
+    def test_test_shards(self):
+        self._run_action("configure", "hello")
+        self._run_action("make", "hello")
+        results = list()
+        for i in range(2):
+            path = os.path.join(self.test_dir, "build-tests",
+                                "shard-%i.json" % i)
+            self._run_action("test", "hello", "--shard-index", str(i),
+                             "--shard-count", "2", "--shard-results", path)
+            results.append(path)
+        output_dir = os.path.join(self.test_dir, "build-tests", "merged")
+        self._run_action("merge_shards", "-o", output_dir, *results)
+        merged = os.listdir(os.path.join(output_dir, "hello"))
+        self.assertTrue("zero_test.xml" in merged)
+
     def test_package(self):
         self._run_action("package", "world")
 
@@ -51,6 +51,73 @@ class TocTestCase(unittest.TestCase):
         qibuild.sh.rm(self.tmp)
 
 
+def write_project(work_tree, name, depends=None):
+    """ Create a project named name, with a qiproject.xml """
+    project_dir = os.path.join(work_tree, name)
+    qibuild.sh.mkdir(project_dir, recursive=True)
+    project_cfg = qibuild.config.ProjectConfig()
+    project_cfg.name = name
+    if depends:
+        project_cfg.depends = set(depends)
+    project_cfg.write(os.path.join(project_dir, "qiproject.xml"))
+
+
+class LazyTocTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-lazy-toc")
+        qibuild.sh.mkdir(os.path.join(self.tmp, ".qi"))
+        write_project(self.tmp, "world")
+        write_project(self.tmp, "hello", depends=["world"])
+        write_project(self.tmp, "spam")
+        self.toc = qibuild.toc.Toc(self.tmp)
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def test_no_project_created(self):
+        self.assertEquals(self.toc.project_names, ["hello", "spam", "world"])
+        self.assertEquals(self.toc._projects, dict())
+
+    def test_get_project(self):
+        hello = self.toc.get_project("hello")
+        self.assertEquals(hello.depends, set(["world"]))
+        self.assertTrue(hello.build_directory)
+        self.assertTrue(self.toc.get_project("hello") is hello)
+        self.assertEquals(self.toc._projects.keys(), ["hello"])
+        self.assertRaises(qibuild.toc.TocException, self.toc.get_project, "nope")
+
+    def test_resolve_deps(self):
+        self.toc.active_projects = ["hello"]
+        (projects, _, _) = self.toc.resolve_deps()
+        self.assertEquals(projects, ["world", "hello"])
+        # Dependencies are read from the dependency graph,
+        # so no project had to be created
+        self.assertEquals(self.toc._projects, dict())
+        sdk_dirs = self.toc.get_sdk_dirs("hello")
+        self.assertEquals(sdk_dirs, [self.toc.get_project("world").get_sdk_dir()])
+        self.assertEquals(sorted(self.toc._projects.keys()), ["world"])
+
+    def test_all_projects(self):
+        names = [p.name for p in self.toc.projects]
+        self.assertEquals(names, ["hello", "spam", "world"])
+
+    def test_deps_cache(self):
+        graph = self.toc.get_dependency_graph()
+        (projects, _, _) = self.toc.solve_dependencies(["hello"])
+        self.assertEquals(projects, ["world", "hello"])
+        self.assertEquals(graph._sorted.keys(), [(("hello",), False)])
+        # Callers are free to modify the results:
+        projects.remove("world")
+        self.assertEquals(self.toc.solve_dependencies(["hello"])[0],
+            ["world", "hello"])
+        self.assertTrue(self.toc.get_dependency_graph() is graph)
+        # Setting packages invalidates the cache
+        self.toc.packages = [qitoolchain.Package("world", "/path/to/world")]
+        self.assertFalse(self.toc.get_dependency_graph() is graph)
+        self.assertEquals(self.toc.solve_dependencies(["hello"]),
+            (["hello"], ["world"], []))
+
 
 if __name__ == "__main__":
     unittest.main()
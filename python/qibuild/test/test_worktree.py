@@ -0,0 +1,71 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qibuild.worktree.search_projects
+
+"""
+
+import os
+import tempfile
+import unittest
+
+import qibuild
+from qibuild.worktree import search_projects
+
+
+def touch(path):
+    """ Create an empty file """
+    qibuild.sh.mkdir(os.path.dirname(path), recursive=True)
+    with open(path, "w") as fp:
+        fp.write("")
+
+
+class SearchProjectsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-search-projects")
+        touch(os.path.join(self.tmp, "qiproject.xml"))
+        for i in range(10):
+            for j in range(5):
+                touch(os.path.join(self.tmp, "g%i" % i, "p%i" % j, "qiproject.xml"))
+            qibuild.sh.mkdir(os.path.join(self.tmp, "g%i" % i, ".git"))
+        touch(os.path.join(self.tmp, "old", "qibuild.manifest"))
+        touch(os.path.join(self.tmp, "both", "qibuild.manifest"))
+        touch(os.path.join(self.tmp, "both", "qiproject.xml"))
+        touch(os.path.join(self.tmp, "nested", ".qi", "spam", "qiproject.xml"))
+        touch(os.path.join(self.tmp, "android", ".repo", "eggs", "qiproject.xml"))
+        touch(os.path.join(self.tmp, "black", ".qiblacklist"))
+        touch(os.path.join(self.tmp, "black", "qiproject.xml"))
+        touch(os.path.join(self.tmp, "black", "bar", "qiproject.xml"))
+        touch(os.path.join(self.tmp, "a", "b", "c", "qiproject.xml"))
+        touch(os.path.join(self.tmp, "a", "b", "c", "d", "qiproject.xml"))
+
+    def tearDown(self):
+        qibuild.sh.rm(self.tmp)
+
+    def test_pruning(self):
+        (git, src) = search_projects(self.tmp)
+        self.assertEquals(len(git), 10)
+        rel_src = [os.path.relpath(x, self.tmp) for x in src]
+        self.assertEquals(rel_src.count("both"), 2)
+        self.assertTrue("old" in rel_src)
+        self.assertTrue("black" in rel_src)
+        self.assertTrue(os.path.join("a", "b", "c") in rel_src)
+        for not_expected in [os.path.join("black", "bar"),
+                             os.path.join("a", "b", "c", "d"),
+                             os.path.join("nested", ".qi", "spam"),
+                             os.path.join("android", ".repo", "eggs")]:
+            self.assertFalse(not_expected in rel_src, not_expected)
+
+    def test_parallel_same_order(self):
+        serial = search_projects(self.tmp, num_jobs=1)
+        for num_jobs in [2, 8, 32]:
+            self.assertEquals(search_projects(self.tmp, num_jobs=num_jobs), serial)
+
+    def test_non_existing(self):
+        res = search_projects(os.path.join(self.tmp, "nope"))
+        self.assertEquals(res, (list(), list()))
+
+
+if __name__ == "__main__":
+    unittest.main()
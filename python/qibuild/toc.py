@@ -9,9 +9,9 @@ which is where all the 'magic' happens ....
 
 import os
 import glob
+import hashlib
 import platform
 import logging
-import operator
 
 import qibuild
 import qitoolchain
@@ -19,10 +19,17 @@ import qitoolchain
 from qibuild.project  import Project
 from qibuild.worktree import WorkTree
 from qibuild.command  import CommandFailedException
-from qibuild.dependencies_solver import DependenciesSolver
+from qibuild.dependencies_solver import DependenciesSolver, DependencyGraph
 
 LOGGER = logging.getLogger("qibuild.toc")
 
+# Name of the file storing the configure fingerprint in a build dir,
+# see Toc.configure_project
+CONFIGURE_FINGERPRINT = "qibuild-configure.sha1"
+
+# Environment variables changing the results of cmake
+CONFIGURE_ENV_VARS = ["PATH", "CC", "CXX", "CFLAGS", "CXXFLAGS", "LDFLAGS"]
+
 
 class TocException(Exception):
     """Custom exception.
@@ -92,7 +99,8 @@ class Toc(WorkTree):
             cmake_flags=None,
             cmake_generator=None,
             active_projects=None,
-            solve_deps=True):
+            solve_deps=True,
+            rescan=False):
         """
         Create a new Toc object. Most of the keyargs come directly from
         the command line. (--wortree, --debug, -c, etc.)
@@ -105,8 +113,9 @@ class Toc(WorkTree):
         :param cmake_generator: optional cmake generator
                          (defaults to Unix Makefiles)
         :param active_projects: the projects excplicitely specified by user
+        :param rescan:     see :py:meth:`qibuild.worktree.WorkTree.__init__`
         """
-        WorkTree.__init__(self, work_tree, path_hints=path_hints)
+        WorkTree.__init__(self, work_tree, path_hints=path_hints, rescan=rescan)
         # The local config file in which to write
         self.config_path = os.path.join(self.work_tree, ".qi", "qibuild.xml")
 
@@ -147,9 +156,18 @@ class Toc(WorkTree):
         envsetter.read_config(self.config)
         self.build_env =  envsetter.get_build_env()
 
-        # List of objects of type qibuild.project.Project,
-        # this is updated using WorkTree.buildable_projects
-        self.projects          = list()
+        # Objects of type qibuild.project.Project are created
+        # lazily from WorkTree.buildable_projects, see self.projects
+        # and self.get_project()
+        self._project_paths    = dict()
+        self._projects         = dict()
+        # Built from the projects and the packages when needed,
+        # see self.get_dependency_graph()
+        self._dependency_graph = None
+        self._packages         = list()
+        # Filled by self.prepare_projects()
+        self._sdk_dirs         = dict()
+        self._cmake_env        = None
 
         # The list of projects the user asked for from command
         # line.
@@ -224,24 +242,61 @@ class Toc(WorkTree):
         This make sure that every project managed by a Toc instance has the correct
         build config, and the same build folder
 
+        Note that the Project objects are only created when they are
+        needed, see :py:meth:`get_project`
+
         """
         self.set_build_folder_name()
 
         # self.buildable_projects has been set by WorkTree.__init__
-        for pname, ppath in self.buildable_projects.iteritems():
-            project = Project(pname, ppath)
-            self.projects.append(project)
-
         # Small warning here: when we update the projects, we do NOT
         # have the complete list of the projects, their dependencies,
         # the list of sdk dirs, and so on ...
         # So we only call qibuild.projects.bootstrap_project() at the last
         # moment...
-        for project in self.projects:
-            qibuild.project.update_project(project, self)
+        self._project_paths = self.buildable_projects.copy()
+        self._projects = dict()
+        self._dependency_graph = None
+        self._sdk_dirs = dict()
+
+    def _get_projects(self):
+        """ The list of all the projects, sorted by name.
+
+        Note that this creates every Project object, so
+        use :py:meth:`get_project` and :py:attr:`project_names`
+        when possible.
+
+        """
+        return [self.get_project(name) for name in self.project_names]
+
+    def _set_projects(self, projects):
+        """ Replace the list of projects """
+        self._project_paths = dict((p.name, p.directory) for p in projects)
+        self._projects = dict((p.name, p) for p in projects)
+        self._dependency_graph = None
+        self._sdk_dirs = dict()
+
+    projects = property(_get_projects, _set_projects)
+
+    def _get_packages(self):
+        """ The list of packages from the toolchain """
+        return self._packages
+
+    def _set_packages(self, packages):
+        """ Replace the list of packages """
+        self._packages = packages
+        self._dependency_graph = None
+        self._sdk_dirs = dict()
 
-        self.projects.sort(key=operator.attrgetter('name'))
+    packages = property(_get_packages, _set_packages)
 
+    @property
+    def project_names(self):
+        """ The sorted list of the names of the projects.
+        No Project object is created
+
+        """
+        return sorted(self._project_paths.keys())
 
     def set_build_folder_name(self):
         """Get a reasonable build folder.
@@ -275,12 +330,48 @@ class Toc(WorkTree):
         :raise: a TocException if the project was not found
 
         """
-        res = [p for p in self.projects if p.name == project_name]
-        if len(res) == 1:
-            return res[0]
-        else:
+        project = self._projects.get(project_name)
+        if project is not None:
+            return project
+        project_dir = self._project_paths.get(project_name)
+        if project_dir is None:
             raise TocException("No such project: %s" % project_name)
+        project = Project(project_name, project_dir)
+        qibuild.project.update_project(project, self)
+        self._projects[project_name] = project
+        return project
 
+    def get_dependency_graph(self):
+        """ Get a :py:class:`qibuild.dependencies_solver.DependencyGraph`
+        of all the projects and packages.
+
+        It is built only once, and reset when self.projects or
+        self.packages are set, so the dependencies computed
+        with it are also cached until then.
+        The dependencies are read from the qiproject.xml files, so
+        no Project object is created.
+
+        """
+        if self._dependency_graph is not None:
+            return self._dependency_graph
+        graph = DependencyGraph()
+        for name in self.project_names:
+            project = self._projects.get(name)
+            if project is not None:
+                graph.add_project(name, project.depends, project.rdepends)
+                continue
+            project_dir = self._project_paths[name]
+            qibuild.project.handle_old_manifest(project_dir)
+            project_xml = os.path.join(project_dir, "qiproject.xml")
+            if os.path.exists(project_xml):
+                project_cfg = qibuild.config.read_project_config(project_xml)
+                graph.add_project(name, project_cfg.depends, project_cfg.rdepends)
+            else:
+                graph.add_project(name, list(), list())
+        for package in self.packages:
+            graph.add_package(package.name, package.depends)
+        self._dependency_graph = graph
+        return graph
 
     def get_sdk_dirs(self, project_name):
         """ Return a list of sdk needed to build a project.
@@ -295,16 +386,17 @@ class Toc(WorkTree):
         of projects
 
         """
+        dirs = self._sdk_dirs.get(project_name)
+        if dirs is not None:
+            return dirs[:]
         dirs = list()
 
-        known_project_names = [p.name for p in self.projects]
-        if project_name not in known_project_names:
+        if project_name not in self._project_paths:
             raise TocException("%s is not a buildable project" % project_name)
 
         # Here do not honor self.solve_deps or the software won't compile :)
-        dep_solver = DependenciesSolver(projects=self.projects, packages=self.packages,
-            active_projects=self.active_projects)
-        (r_project_names, _package_names, not_found) = dep_solver.solve([project_name])
+        (r_project_names, _package_names, not_found) = \
+            self.solve_dependencies([project_name])
 
         # Nothing to do with with the packages:
         # SDK dirs from toolchain are managed by the toolchain file in
@@ -357,13 +449,64 @@ class Toc(WorkTree):
         if not self.solve_deps:
             return (self.active_projects, list(), list())
         else:
-            dep_solver = DependenciesSolver(projects=self.projects,
-                                            packages=self.packages,
-                                            active_projects=self.active_projects)
-            return dep_solver.solve(self.active_projects,
-                                    runtime=runtime)
+            return self.solve_dependencies(self.active_projects,
+                                           runtime=runtime)
+
+    def solve_dependencies(self, names, runtime=False, active_projects=None):
+        """ Solve the dependencies of the given project names,
+        using the dependency graph of the Toc object.
+
+        The transitive closures are cached by the dependency graph,
+        (see :py:meth:`get_dependency_graph`), so calling this
+        for every project is cheap.
 
-    def configure_project(self, project, clean_first=True):
+        :param active_projects: the projects that should win over
+                                packages (default: self.active_projects)
+        :return: (projects, packages, not_found), see
+                 :py:meth:`qibuild.dependencies_solver.DependenciesSolver.solve`
+
+        """
+        if active_projects is None:
+            active_projects = self.active_projects
+        dep_solver = DependenciesSolver(graph=self.get_dependency_graph(),
+                                        active_projects=active_projects)
+        return dep_solver.solve(names, runtime=runtime)
+
+    def prepare_projects(self, project_names):
+        """ Create the projects and everything computed lazily when
+        configuring or building them: their dependencies, their sdk
+        dirs and the environment for cmake.
+
+        Must be called from the main thread before calling
+        :py:meth:`configure_project` or :py:meth:`build_project` from
+        several threads at the same time: they then only read the
+        state of the Toc object.
+
+        """
+        for project_name in project_names:
+            self.get_project(project_name)
+            self._sdk_dirs[project_name] = self.get_sdk_dirs(project_name)
+        self._cmake_env = self.get_cmake_env()
+
+    def get_cmake_env(self):
+        """ The environment used to call cmake: self.build_env, without
+        the paths containing sh.exe when using MinGW
+
+        """
+        if self._cmake_env is not None:
+            return self._cmake_env
+        if not "MinGW" in self.cmake_generator:
+            return self.build_env
+        build_env = self.build_env.copy()
+        paths = build_env["PATH"].split(os.pathsep)
+        paths_withoutsh = list()
+        for p in paths:
+            if not os.path.exists(os.path.join(p, "sh.exe")):
+                paths_withoutsh.append(p)
+        build_env["PATH"] = os.pathsep.join(paths_withoutsh)
+        return build_env
+
+    def configure_project(self, project, clean_first=True, out=None, force=False):
         """ Call cmake with correct options.
 
         Few notes:
@@ -380,6 +523,14 @@ class Toc(WorkTree):
             This is mainly useful when you are calling cmake NOT from
             `qibuild configure`.
 
+          * If out is not None, the output of cmake is written to it,
+            see :py:func:`qibuild.command.call`
+
+          * A fingerprint of everything cmake depends on (arguments,
+            toolchain file, dependencies ...) is stored in the build
+            directory. If it has not changed since the last successful
+            run, cmake is not called at all, unless force is True.
+
         """
         if not os.path.exists(project.directory):
             raise TocException("source dir: %s does not exist, aborting" % project.directory)
@@ -391,7 +542,7 @@ class Toc(WorkTree):
             raise TocException(mess)
 
         # Generate the dependencies.cmake just in time:
-        qibuild.project.bootstrap_project(project, self)
+        dependencies_cmake = qibuild.project.bootstrap_project(project, self)
 
         # Set generator if necessary
         cmake_args = list()
@@ -411,30 +562,58 @@ class Toc(WorkTree):
 
         cmake_args.extend(["-D" + x for x in cmake_flags])
 
-        if "MinGW" in self.cmake_generator:
-            paths = self.build_env["PATH"].split(os.pathsep)
-            paths_withoutsh = list()
-            for p in paths:
-                if not os.path.exists(os.path.join(p, "sh.exe")):
-                    paths_withoutsh.append(p)
-            self.build_env["PATH"] = os.pathsep.join(paths_withoutsh)
-
+        fingerprint = _get_configure_fingerprint(self, project, cmake_args,
+                                                 dependencies_cmake)
+        fingerprint_path = os.path.join(project.build_directory,
+                                        CONFIGURE_FINGERPRINT)
+        cmake_cache = os.path.join(project.build_directory, "CMakeCache.txt")
+        if not force and os.path.exists(cmake_cache) and \
+                _read_file(fingerprint_path) == fingerprint:
+            LOGGER.info("%s is up to date, not running cmake", project.name)
+            return
+
+        qibuild.sh.rm(fingerprint_path)
         try:
             qibuild.cmake.cmake(project.directory,
                           project.build_directory,
                           cmake_args,
                           clean_first=clean_first,
-                          env=self.build_env)
+                          env=self.get_cmake_env(),
+                          out=out,
+                          seed_path=self.get_seed_path(),
+                          log_path=qibuild.buildlog.get_log_path(
+                              project.build_directory, "configure"))
         except CommandFailedException:
             raise ConfigureFailed(project)
+        with open(fingerprint_path, "w") as fp:
+            fp.write(fingerprint)
+
 
+    def get_seed_path(self):
+        """ Path to the file used to share the results of the compiler
+        probes between the projects, see :py:func:`qibuild.cmake.cmake`
+
+        """
+        return os.path.join(self.work_tree, ".qi",
+                            "%s-seed.cmake" % self.build_folder_name)
 
-    def build_project(self, project, incredibuild=False, num_jobs=1, target=None, rebuild=False):
+    def build_project(self, project, incredibuild=False, num_jobs=1, target=None, rebuild=False,
+                      makeflags=None, out=None):
         """ Build a project.
 
         Usually we will simply can ``cmake --build``, but for incredibuild
         we need to call `BuildConsole.exe` with an sln.
 
+        If makeflags is not None, it is used as MAKEFLAGS environment
+        variable instead of passing -j to make. (This is how several
+        builds share a GNU make jobserver, see :py:mod:`qibuild.parallel`)
+
+        If out is not None, the output of the build is written to it,
+        see :py:func:`qibuild.command.call`
+
+        The output is also written to a compressed log in the build
+        directory, see :py:mod:`qibuild.buildlog`
+
         """
         build_dir = project.build_directory
         cmake_cache = os.path.join(build_dir, "CMakeCache.txt")
@@ -463,32 +642,54 @@ class Toc(WorkTree):
                 if num_jobs > 1 and "visual studio" in self.cmake_generator.lower():
                     cmd += ["/m:%d" % num_jobs]
 
-        if num_jobs > 1 and "make" in self.cmake_generator.lower():
+        build_env = self.build_env
+        if makeflags is not None:
+            build_env = build_env.copy()
+            build_env["MAKEFLAGS"] = makeflags
+        elif num_jobs > 1 and ("make" in self.cmake_generator.lower() or
+                               "ninja" in self.cmake_generator.lower()):
             cmd += [ "-j%d" % num_jobs]
 
         try:
-            qibuild.command.call(cmd, env=self.build_env)
+            qibuild.command.call(cmd, env=build_env, out=out,
+                log_path=qibuild.buildlog.get_log_path(build_dir, "build"))
         except CommandFailedException:
             raise BuildFailed(project)
 
-    def test_project(self, project, test_name=None):
+    def test_project(self, project, test_name=None, num_jobs=1, gtest_shards=1,
+                     use_cache=False):
         """Run qibuild.ctest on a project
 
         :param test_name: if given, only this test will run
+        :param num_jobs: number of tests to run at the same time
+        :param gtest_shards: number of shards for each gtest test
+        :param use_cache: do not run again the tests that passed,
+                          if nothing they depend on changed
 
         """
         build_dir = project.build_directory
         cmake_cache = os.path.join(build_dir, "CMakeCache.txt")
         if not os.path.exists(cmake_cache):
             _advise_using_configure(self, project)
+        sdk_dirs = None
+        if use_cache:
+            sdk_dirs = self.get_test_sdk_dirs(project)
         (res, summary) = qibuild.ctest.run_tests(project, self.build_env,
-            test_name=test_name)
+            test_name=test_name, num_jobs=num_jobs, gtest_shards=gtest_shards,
+            sdk_dirs=sdk_dirs, packages=self.packages)
         if res:
             LOGGER.info(summary)
         else:
             raise TestsFailed(project, summary)
 
 
+    def get_test_sdk_dirs(self, project):
+        """ The sdk dirs where the tests of the project may find
+        shared libraries: its own and the ones of its dependencies
+
+        """
+        return [project.get_sdk_dir()] + self.get_sdk_dirs(project.name)
+
     def install_project(self, project, destdir, runtime=False):
         """ Install the project
 
@@ -547,7 +748,7 @@ def _projects_from_args(toc, args):
         project_names: the actual list for project
         single: user specified --single
     """
-    toc_p_names = [p.name for p in toc.projects]
+    toc_p_names = toc.project_names
     if hasattr(args, "all") and args.all:
         # Pretend the user has asked for all the known projects
         LOGGER.debug("select: All projects have been selected")
@@ -611,6 +812,10 @@ def toc_open(work_tree, args=None):
     if hasattr(args, 'cmake_generator'):
         cmake_generator = args.cmake_generator
 
+    rescan = False
+    if hasattr(args, 'rescan'):
+        rescan = args.rescan
+
     if not work_tree:
         work_tree = qibuild.worktree.guess_work_tree()
     current_project = qibuild.worktree.search_current_project_root(os.getcwd())
@@ -637,7 +842,8 @@ def toc_open(work_tree, args=None):
                build_type=build_type,
                cmake_flags=cmake_flags,
                cmake_generator=cmake_generator,
-               path_hints=path_hints)
+               path_hints=path_hints,
+               rescan=rescan)
 
     (active_projects, single) =  _projects_from_args(toc, args)
     toc.active_projects = active_projects
@@ -667,6 +873,52 @@ def project_from_cwd():
     return qibuild.project.name_from_directory(project_dir)
 
 
+def _get_configure_fingerprint(toc, project, cmake_args, dependencies_cmake):
+    """ Compute a sha1 of everything the results of cmake
+    depend on, apart from the CMake files of the project itself
+    (the generated build system already re-runs cmake when they change)
+
+    """
+    sha = hashlib.sha1()
+    def add(*args):
+        "Add some strings to the fingerprint"
+        for arg in args:
+            sha.update(str(arg))
+            sha.update("\0")
+
+    add("args", *cmake_args)
+    add("generator", toc.cmake_generator)
+    for var in CONFIGURE_ENV_VARS:
+        add(var, toc.build_env.get(var, ""))
+    add("dependencies.cmake", dependencies_cmake)
+    if toc.toolchain is not None:
+        add("toolchain", _read_file(toc.toolchain.toolchain_file))
+    if toc.active_config:
+        local_cmake = os.path.join(toc.work_tree, ".qi",
+                                   "%s.cmake" % toc.active_config)
+        add("local cmake", _read_file(local_cmake))
+    # The -config.cmake files of the dependencies are used
+    # by find_package(), and their results are stored in the cache
+    for sdk_dir in toc.get_sdk_dirs(project.name):
+        add("sdk", sdk_dir)
+        cmake_dir = os.path.join(sdk_dir, "cmake")
+        if not os.path.isdir(cmake_dir):
+            continue
+        for name in sorted(os.listdir(cmake_dir)):
+            try:
+                stat = os.stat(os.path.join(cmake_dir, name))
+            except OSError:
+                continue
+            add(name, stat.st_mtime, stat.st_size)
+    return sha.hexdigest()
+
+def _read_file(path):
+    """ Return the contents of a file, or None if it does not exist """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fp:
+        return fp.read()
+
 def _advise_using_configure(self, project):
     """Just throw a nice exception because
     CMakeCache.txt was not found.
@@ -28,10 +28,31 @@ have different configurations with different work trees if you need.
 
 import os
 import logging
+import threading
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # pylint: disable-msg=F0401
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 import qibuild.sh
+from qibuild.project_index import ProjectIndex, get_index_path
 
 LOGGER = logging.getLogger("WorkTree")
 
+# The files looked for in every directory when searching for projects
+PROJECT_MARKERS = [".git", "qiproject.xml", "qibuild.manifest", ".qiblacklist"]
+
+# Number of threads used to explore the worktree. Most of the time is
+# spent waiting for the file system, (especially over NFS), so it is
+# fine to use more threads than cores.
+SEARCH_JOBS = 8
+
 class WorkTreeException(Exception):
     """Custom exception """
     def __init__(self, message):
@@ -55,18 +76,20 @@ class ProjectAlreadyExists(Exception):
 
 
 
-class WorkTree:
+class WorkTree(object):
     """ This class represent a :term:`worktree`
 
     """
 
-    def __init__(self, work_tree, path_hints=None):
+    def __init__(self, work_tree, path_hints=None, rescan=False):
         """
         Construct a new worktree
 
         :param work_tree: The directory to be used as a worktree.
         :param path_hints: Some additional directories to be
                               used when searching for projects.
+        :param rescan: Ignore the project index stored in .qi
+                       and explore every directory again.
         :raise: WorkTreeException if two projects have the same name or
                     if two git directories have the same basename
         """
@@ -75,6 +98,13 @@ class WorkTree:
         self.buildable_projects = dict()
         self.git_projects       = dict()
 
+        # The index is only used when there is a .qi directory
+        # to store it, see qibuild.project_index
+        self.project_index = None
+        if os.path.isdir(os.path.join(self.work_tree, ".qi")):
+            index_path = get_index_path(self.work_tree)
+            self.project_index = ProjectIndex(index_path, rescan=rescan)
+
         if not path_hints:
             path_hints = list()
         if self.work_tree not in path_hints:
@@ -90,7 +120,10 @@ class WorkTree:
         Make sure there is no name conflict.
         """
         for p in path_hints:
-            (git_p, src_p) = search_projects(p)
+            if self.project_index:
+                (git_p, src_p) = self.project_index.search_projects(p)
+            else:
+                (git_p, src_p) = search_projects(p)
             for d in src_p:
                 # Get the name of the project from its directory:
                 project_name = qibuild.project.name_from_directory(d)
@@ -134,11 +167,16 @@ class WorkTree:
                 else:
                     self.git_projects[os.path.basename(d)] = d
 
+        if self.project_index:
+            self.project_index.save()
 
-def worktree_open(work_tree=None):
+
+def worktree_open(work_tree=None, rescan=False):
     """
     Open a qi worktree.
 
+    :param rescan: see :py:meth:`WorkTree.__init__`
+
     :return: a valid :py:class:`WorkTree` instance.
              If worktree is None, guess it from the current working dir.
 
@@ -178,7 +216,7 @@ def worktree_open(work_tree=None):
             " - try from a valid work tree\n"
             " - specify an existing work tree with \"--work-tree PATH\"\n"
             " - create a new work tree with \"qibuild init\"")
-    return WorkTree(work_tree, path_hints=path_hints)
+    return WorkTree(work_tree, path_hints=path_hints, rescan=rescan)
 
 def search_current_project_root(working_directory):
     """ When you run qibuild without any arguement,
@@ -242,56 +280,191 @@ def _search_manifest_directory(working_directory):
 
     return None
 
-def search_projects(directory=None, depth=4):
-    """ Search for qibuild.manifest files recursively starting from directory
-        This function return a list of directories.
+def list_directory(directory):
+    """ List a directory, looking for the files in PROJECT_MARKERS
+
+    :return: a tuple (markers, subdirs) where markers is the
+             list of files from PROJECT_MARKERS found in the directory,
+             and subdirs the list of the names of its sub-directories.
+
+    When scandir is available, the type of the entries is read from the
+    directory itself, so no additional stat() is required.
+
+    """
+    markers = list()
+    subdirs = list()
+    if scandir is not None:
+        try:
+            for entry in scandir(directory):
+                name = entry.name
+                if name in PROJECT_MARKERS:
+                    markers.append(name)
+                try:
+                    if entry.is_dir():
+                        subdirs.append(name)
+                except OSError:
+                    pass
+            return (markers, subdirs)
+        except OSError:
+            pass
+    try:
+        for name in os.listdir(directory):
+            if name in PROJECT_MARKERS:
+                markers.append(name)
+            if os.path.isdir(os.path.join(directory, name)):
+                subdirs.append(name)
+    except OSError:
+        # We may still be able to see the markers if
+        # the directory is not readable, but searchable
+        markers = [x for x in PROJECT_MARKERS
+            if os.path.exists(os.path.join(directory, x))]
+    return (markers, subdirs)
+
+
+def _should_explore(directory, depth):
+    """ Helper for search_projects """
+    if depth == 0:
+        return False
+    # Do not go through nested worktrees, nor repo config dir:
+    if os.path.basename(directory) in [".qi", ".repo"]:
+        return False
+    return True
+
+
+def _explore(directory, depth, list_dir, num_jobs):
+    """ Call list_dir on every directory that may contain projects,
+    using num_jobs threads
+
+    :return: a dict directory -> list_dir(directory)
+
+    """
+    entries = dict()
+    if not _should_explore(directory, depth):
+        return entries
+
+    def process(directory, depth):
+        " Returns the sub-directories to explore "
+        entry = list_dir(directory)
+        entries[directory] = entry
+        if entry is None:
+            return list()
+        (markers, subdirs) = entry
+        if ".qiblacklist" in markers:
+            return list()
+        res = list()
+        for subdir in subdirs:
+            sub_path = os.path.join(directory, subdir)
+            if _should_explore(sub_path, depth - 1):
+                res.append((sub_path, depth - 1))
+        return res
+
+    if num_jobs <= 1:
+        todo = [(directory, depth)]
+        while todo:
+            todo.extend(process(*todo.pop()))
+        return entries
+
+    queue = Queue.Queue()
+    lock = threading.Lock()
+    # Number of directories queued but not processed yet,
+    # and first exception raised by a worker
+    state = {"pending" : 1, "error" : None}
+
+    def worker():
+        " To be called in a thread "
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            to_add = list()
+            try:
+                to_add = process(*item)
+            except Exception, e:
+                with lock:
+                    if state["error"] is None:
+                        state["error"] = e
+            with lock:
+                state["pending"] += len(to_add) - 1
+                finished = (state["pending"] == 0)
+            for sub_item in to_add:
+                queue.put(sub_item)
+            if finished:
+                for _ in range(num_jobs):
+                    queue.put(None)
+
+    queue.put((directory, depth))
+    threads = list()
+    for i in range(num_jobs):
+        thread = threading.Thread(target=worker, name="search_projects<%i>" % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if state["error"] is not None:
+        raise state["error"]
+    return entries
+
+
+def _collect(directory, depth, entries):
+    """ Build the (git, src) lists from the result
+    of _explore(), in the same order as a serial
+    depth-first exploration
+
     """
-    # TODO: caching, please!
-    # TODO: may warn the user that this may take some time, of force user
-    # to run qibuild init in empty directories
     rgit = list()
     rsrc = list()
-    if depth == 0:
+    if not _should_explore(directory, depth):
         return (rgit, rsrc)
+    entry = entries.get(directory)
+    if entry is None:
+        return (rgit, rsrc)
+    (markers, subdirs) = entry
 
-
-    if os.path.exists(os.path.join(directory, ".git")):
+    if ".git" in markers:
         rgit.append(directory)
 
-    if os.path.exists(os.path.join(directory, "qiproject.xml")):
+    if "qiproject.xml" in markers:
         rsrc.append(directory)
 
     # old qibuild syntax
-    if os.path.exists(os.path.join(directory, "qibuild.manifest")):
+    if "qibuild.manifest" in markers:
         rsrc.append(directory)
 
-    blacklist_file = os.path.join(directory, ".qiblacklist")
-    if os.path.exists(blacklist_file):
-        return(rgit, rsrc)
-
-    subdirs = list()
-    try:
-        dir_contents = [os.path.join(directory, s) for s in os.listdir(directory)]
-        subdirs = [s for s in dir_contents if os.path.isdir(s)]
-    except OSError:
-        pass
-
-    # Do not go through nested worktrees:
-    if os.path.basename(directory) == ".qi":
-        return (list(), list())
-
-    # Do not go through repo config dir
-    if os.path.basename(directory) == ".repo":
-        return (list(), list())
+    if ".qiblacklist" in markers:
+        return (rgit, rsrc)
 
-    # If os.listdir fails (permission denied for instance),
-    # we will iter on a empty list, so no worry :)
-    for p in subdirs:
-        sub_rgit, sub_rsrc = search_projects(p, depth - 1)
+    for subdir in subdirs:
+        sub_path = os.path.join(directory, subdir)
+        (sub_rgit, sub_rsrc) = _collect(sub_path, depth - 1, entries)
         rgit.extend(sub_rgit)
         rsrc.extend(sub_rsrc)
     return (rgit, rsrc)
 
+
+def search_projects(directory=None, depth=4, list_dir=None, num_jobs=None):
+    """ Search for qibuild.manifest files recursively starting from directory
+        This function return a list of directories.
+
+    :param list_dir: the function used to list a directory
+                     (defaults to :py:func:`list_directory`)
+    :param num_jobs: number of threads used to explore the
+                     sub-directories (defaults to SEARCH_JOBS)
+
+    Directories are explored concurrently, but the results are
+    always returned in the same order.
+    """
+    # Note: WorkTree uses a qibuild.project_index.ProjectIndex
+    # as list_dir, so that unchanged directories are not listed again.
+    # TODO: may warn the user that this may take some time, of force user
+    # to run qibuild init in empty directories
+    if list_dir is None:
+        list_dir = list_directory
+    if num_jobs is None:
+        num_jobs = SEARCH_JOBS
+    entries = _explore(directory, depth, list_dir, num_jobs)
+    return _collect(directory, depth, entries)
+
 def guess_work_tree():
     """Look for parent directories until a .qi dir is found somewhere.
 
@@ -8,6 +8,8 @@
 
 from xml.etree import ElementTree as etree
 
+import qibuild
+
 class Depends:
     def __init__(self):
         self.name = None
@@ -131,15 +133,17 @@ def parse_project_config(config_path):
     """ Parse a config file, returns a  tuple
     of lists (SphinxDoc, DoxyDoc)
 
+    The file is only parsed once, see
+    :py:func:`qibuild.config.read_project_config`
+
     """
-    tree = etree.ElementTree()
     try:
-        tree.parse(config_path)
+        project_config = qibuild.config.read_project_config(config_path)
     except Exception, e:
         mess  = "Could not parse config from %s\n" % config_path
         mess += "Error was: %s" % e
         raise Exception(mess)
-    root = tree.getroot()
+    root = project_config.tree.getroot()
     doxydocs = list()
     doxy_trees = root.findall("doxydoc")
     for doxy_tree in doxy_trees:
@@ -158,7 +162,6 @@ def is_template(qiproj_xml):
     """ Check whether a project is a template repo
 
     """
-    tree = etree.ElementTree()
-    tree.parse(qiproj_xml)
-    root = tree.getroot()
+    project_config = qibuild.config.read_project_config(qiproj_xml)
+    root = project_config.tree.getroot()
     return root.get("template_repo", "")  in ["true", "1"]
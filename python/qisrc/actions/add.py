@@ -29,7 +29,7 @@ def do(args):
     if not name:
         name = url.split("/")[-1].replace(".git", "")
 
-    work_tree = qibuild.worktree.worktree_open(args.work_tree)
+    work_tree = qibuild.worktree.worktree_open(args.work_tree, rescan=args.rescan)
 
     git_src_dir = os.path.join(work_tree.work_tree, name)
     LOGGER.info("Git clone: %s -> %s", url, git_src_dir)
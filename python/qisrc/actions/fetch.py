@@ -61,7 +61,7 @@ def do(args):
             raise Exception(mess)
         manifest_url = manifest.url
 
-    qiwt = qibuild.worktree_open(args.work_tree)
+    qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
 
     projects = qisrc.parse_manifest(manifest_url)
     for (project_name, project_url) in projects.iteritems():
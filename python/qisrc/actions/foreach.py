@@ -22,7 +22,7 @@ def configure_parser(parser):
 
 def do(args):
     """Main entry point"""
-    qiwt = qibuild.worktree_open(args.work_tree)
+    qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
     logger = logging.getLogger(__name__)
     for pname, ppath in qiwt.git_projects.iteritems():
         logger.info("Running `%s` for %s", " ".join(args.command), pname)
@@ -12,8 +12,6 @@ import logging
 import qibuild
 import qisrc
 
-from qibuild.dependencies_solver import DependenciesSolver
-
 LOGGER = logging.getLogger(__name__)
 
 
@@ -46,12 +44,13 @@ def toc_dep_to_git_proj(names, git_projects):
     return uniq(ret)
 
 #for each git project find all toc associated projects
+#(toc_projects is a dict name -> directory)
 def git_dep_to_toc_dep(names, toc_projects):
     ret = list()
     for g in names:
-        for t in toc_projects:
-            if t.directory.startswith(g):
-                ret.append(t.name)
+        for (t_name, t_directory) in toc_projects.iteritems():
+            if t_directory.startswith(g):
+                ret.append(t_name)
     return ret
 
 def _search_git_directory(working_directory):
@@ -106,11 +105,11 @@ def resolv_git_deps(toc, qiwt, args):
     #resolv deps
     #convert the toc-project-list to git-project-list again
     #merge new deps into current list of git projects
-    toc_projects = git_dep_to_toc_dep(project_names, toc.projects)
+    toc_projects = git_dep_to_toc_dep(project_names, toc.buildable_projects)
 
-    dep_solver = DependenciesSolver(projects=toc.projects, packages=toc.packages)
-    (all_toc_projects, _, _) = dep_solver.solve(toc_projects, runtime=False)
-    toc_project_names = [ toc.get_project(x).directory for x in all_toc_projects ]
+    (all_toc_projects, _, _) = toc.solve_dependencies(toc_projects,
+        runtime=False, active_projects=list())
+    toc_project_names = [ toc.buildable_projects[x] for x in all_toc_projects ]
     new_toc_deps = toc_dep_to_git_proj(toc_project_names, qiwt.git_projects.values())
     new_toc_deps.extend(project_names)
     return uniq(new_toc_deps)
@@ -120,7 +119,7 @@ def resolv_git_deps(toc, qiwt, args):
 def do(args):
     """Main entry point"""
     fail = list()
-    qiwt = qibuild.worktree_open(args.work_tree)
+    qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
     toc  = qibuild.toc_open(args.work_tree, args)
 
     manifest = toc.config.local.manifest
@@ -48,7 +48,7 @@ def _pad(szold, sznew):
 
 def do(args):
     """ Main method """
-    qiwt = qibuild.worktree_open(args.work_tree)
+    qiwt = qibuild.worktree_open(args.work_tree, rescan=args.rescan)
     gitrepo = list()
     dirty = list()
     sz = len(qiwt.git_projects.values())
@@ -21,7 +21,10 @@ class GitException(Exception):
 GIT = None
 
 def find_git():
-    """ Find the Git executable """
+    """ Find the Git executable
+    (results are cached, see :py:func:`qibuild.command.find_program`)
+
+    """
     # FIXME: trusting path when on a cmd line makes sense,
     # but one day we may have a GUI calling qisrc...
     return command.find_program("git")
@@ -132,7 +135,7 @@ def get_remote_refs(git_url):
     return { 'refs/bla/bla'  : 'sha1',
              'refs/bla/bla2' : 'sha2' }
     """
-    git = command.find_program("git")
+    git = find_git()
     if not git:
         raise Exception("git not found")
     process = subprocess.Popen([git, "ls-remote", git_url], stdout=subprocess.PIPE)
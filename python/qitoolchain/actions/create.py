@@ -32,6 +32,8 @@ def configure_parser(parser):
         help="CMake generator to use when using this toolchain")
     parser.add_argument("--dry-run", action="store_true",
         help="Print what would be done")
+    parser.add_argument("-j", dest="num_jobs", type=int,
+        help="Number of packages to download at the same time")
 
 def do(args):
     """Main entry point
@@ -79,7 +81,8 @@ def do(args):
 
     toolchain = qitoolchain.Toolchain(tc_name)
     if feed:
-        toolchain.parse_feed(feed, dry_run=dry_run)
+        toolchain.parse_feed(feed, dry_run=dry_run,
+            num_jobs=args.num_jobs)
 
     cmake_generator = args.cmake_generator
     qibuild_cfg = qibuild.config.QiBuildConfig()
@@ -27,6 +27,8 @@ def configure_parser(parser):
         nargs="?")
     parser.add_argument("--dry-run", action="store_true",
         help="Print what would be done")
+    parser.add_argument("-j", dest="num_jobs", type=int,
+        help="Number of packages to download at the same time")
 
 def do(args):
     """Main entry point
@@ -51,7 +53,8 @@ def do(args):
 
         LOGGER.info("Updating toolchain %s using %s", tc_name, feed)
         toolchain = qitoolchain.Toolchain(tc_name)
-        toolchain.parse_feed(feed, dry_run=dry_run)
+        toolchain.parse_feed(feed, dry_run=dry_run,
+            num_jobs=args.num_jobs)
     else:
         for tc_name in qitoolchain.get_tc_names():
             tc_feed = qitoolchain.toolchain.get_tc_feed(tc_name)
@@ -62,6 +65,7 @@ def do(args):
             LOGGER.info("###\n## Updating toolchain %s using %s\n##\n",
                 tc_name, tc_feed)
             toolchain = qitoolchain.Toolchain(tc_name)
-            toolchain.parse_feed(tc_feed, dry_run=dry_run)
+            toolchain.parse_feed(tc_feed, dry_run=dry_run,
+                num_jobs=args.num_jobs)
             print
 
@@ -11,6 +11,8 @@ import sys
 import logging
 import hashlib
 import urlparse
+import threading
+import Queue
 from xml.etree import ElementTree
 
 import qibuild
@@ -18,6 +20,15 @@ import qitoolchain
 
 LOGGER = logging.getLogger(__name__)
 
+# Number of packages downloaded at the same time
+DOWNLOAD_JOBS = 4
+
+# Number of packages extracted at the same time
+EXTRACT_JOBS = 2
+
+# Name of the ETag and Last-Modified cache, in the toolchain cache
+VALIDATORS_FILE = "http-validators.json"
+
 
 def raise_parse_error(package_tree, feed, message):
     """ Raise a nice pasing error about the given
@@ -31,16 +42,26 @@ def raise_parse_error(package_tree, feed, message):
     raise Exception(mess)
 
 
-def tree_from_feed(feed_location):
+def tree_from_feed(feed_location, cache_dir=None, validators=None):
     """ Returns an ElementTree object from an
     feed location
 
+    If cache_dir and validators (a :py:class:`qitoolchain.remote.ValidatorCache`)
+    are given, remote feeds are kept in cache_dir, and only downloaded again
+    when they have changed
+
     """
     fp = None
     tree = None
     try:
         if os.path.exists(feed_location):
             fp = open(feed_location, "r")
+        elif cache_dir and validators:
+            # pylint: disable-msg=E1101
+            feed_name = "feed-%s.xml" % hashlib.sha1(feed_location).hexdigest()
+            feed_path = qitoolchain.remote.download(feed_location, cache_dir,
+                output_name=feed_name, callback=None, validators=validators)
+            fp = open(feed_path, "r")
         else:
             fp = qitoolchain.remote.open_remote_location(feed_location)
         tree = ElementTree.ElementTree()
@@ -55,10 +76,11 @@ def tree_from_feed(feed_location):
     return tree
 
 
-def handle_package(package, package_tree, toolchain):
+def handle_package(package, package_tree, toolchain, package_path=None):
     """ Handle a package.
 
-    It is has an url, download and extract it.
+    It is has an url, download and extract it, unless
+    package_path is given (see :py:func:`fetch_packages`)
 
     Update the package given as first parameter
     """
@@ -69,20 +91,26 @@ def handle_package(package, package_tree, toolchain):
         raise_parse_error(package_tree, feed, "Missing 'name' attribute")
 
     package.name = name
+    package.version = package_tree.get("version")
+    package.sha256 = package_tree.get("sha256")
     if package_tree.get("url"):
-        handle_remote_package(feed, package, package_tree, toolchain)
+        (package.url, _archive) = get_package_archive(feed, package_tree,
+                                                      toolchain)
+        if package_path:
+            package.path = package_path
+        else:
+            handle_remote_package(feed, package, package_tree, toolchain)
     if package_tree.get("directory"):
         handle_local_package(package, package_tree)
     if package_tree.get("toolchain_file"):
         handle_toochain_file(package, package_tree)
 
-def handle_remote_package(feed, package, package_tree, toolchain):
-    """ Set package.path of the given package,
-    downloading it and extracting it if necessary.
+def get_package_archive(feed, package_tree, toolchain):
+    """ Return the full url of a remote package, and where
+    its archive is stored in the toolchain cache
 
     """
     package_url = package_tree.get("url")
-    package_name = package_tree.get("name")
 
     if "://"  in feed:
         # package_url may be relative to the feed url:
@@ -98,20 +126,64 @@ def handle_remote_package(feed, package, package_tree, toolchain):
         rest += ".tar.gz"
     if package_url.endswith(".zip"):
         rest += ".zip"
-    output = toolchain.cache
-    output = os.path.join(output, top)
+    archive_path = os.path.join(toolchain.cache, top, rest)
+    return (package_url, archive_path)
+
+
+def download_package(feed, package_tree, toolchain, callback=None,
+                     validators=None, force=False):
+    """ Download the archive of a remote package, unless
+    it is already in the toolchain cache.
+
+    The optional sha256 and size attributes of the package
+    are checked during the download.
+
+    If validators is given, a package already in the cache is only
+    downloaded again if it changed on the server.
+
+    If force is True, the archive is always downloaded again (or
+    checked with a conditional request, if validators is given)
+
+    :return: the path to the archive
+
+    """
+    package_name = package_tree.get("name")
+    (package_url, archive_path) = get_package_archive(feed, package_tree,
+                                                      toolchain)
     message = "Getting package %s from %s" % (package_name, package_url)
-    package_archive = qitoolchain.remote.download(package_url,
-        output,
-        output_name=rest,
-        clobber=False,
-        message=message)
+    kwargs = dict()
+    if callback:
+        kwargs["callback"] = callback
+    kwargs["sha256"] = package_tree.get("sha256")
+    kwargs["validators"] = validators
+    size = package_tree.get("size")
+    if size:
+        try:
+            kwargs["size"] = int(size)
+        except ValueError:
+            raise_parse_error(package_tree, feed,
+                              "'size' attribute should be an integer")
+    return qitoolchain.remote.download(package_url,
+        os.path.dirname(archive_path),
+        output_name=os.path.basename(archive_path),
+        clobber=force,
+        message=message,
+        **kwargs)
+
+
+def extract_package(package_name, package_archive, toolchain, force=False):
+    """ Extract the archive of a package in the packages path of
+    the toolchain, unless it is already there and newer than the
+    archive (and force is False).
 
-    LOGGER.info("Toolchain %s: adding package %s", toolchain.name, package.name)
+    :return: the path of the package
+
+    """
+    LOGGER.info("Toolchain %s: adding package %s", toolchain.name, package_name)
     packages_path = qitoolchain.toolchain.get_default_packages_path(toolchain.name)
     should_skip = False
     dest = os.path.join(packages_path, package_name)
-    if not os.path.exists(dest):
+    if force or not os.path.exists(dest):
         should_skip = False
     else:
         dest_mtime = os.stat(dest).st_mtime
@@ -122,12 +194,22 @@ def handle_remote_package(feed, package, package_tree, toolchain):
         if os.path.exists(dest):
             qibuild.sh.rm(dest)
         try:
-            extracted = qibuild.archive.extract(package_archive, packages_path, topdir=package_name)
+            qibuild.archive.extract(package_archive, packages_path, topdir=package_name)
         except qibuild.archive.InvalidArchive, err:
             mess = str(err)
             mess += "\nPlease fix the archive and try again"
             raise Exception(mess)
-    package.path = dest
+    return dest
+
+
+def handle_remote_package(feed, package, package_tree, toolchain):
+    """ Set package.path of the given package,
+    downloading it and extracting it if necessary.
+
+    """
+    package_archive = download_package(feed, package_tree, toolchain)
+    package.path = extract_package(package_tree.get("name"),
+                                   package_archive, toolchain)
 
 
 def handle_local_package(package, package_tree):
@@ -156,8 +238,12 @@ class ToolchainFeedParser:
     """ A class to handle feed parsing
 
     """
-    def __init__(self):
+    def __init__(self, cache_dir=None, validators=None):
         self.packages = list()
+        # Used to only download the feeds again when they change,
+        # see tree_from_feed
+        self.cache_dir = cache_dir
+        self.validators = validators
         # A dict name -> version used to only keep the latest
         # version
         self._versions = dict()
@@ -191,7 +277,8 @@ class ToolchainFeedParser:
         """ Recursively parse the feed, filling the self.packages
 
         """
-        tree = tree_from_feed(feed)
+        tree = tree_from_feed(feed, cache_dir=self.cache_dir,
+                              validators=self.validators)
         package_trees = tree.findall("package")
         for package_tree in package_trees:
             package_tree.set("feed", feed)
@@ -203,52 +290,346 @@ class ToolchainFeedParser:
                 self.parse(feed_url)
 
 
-def parse_feed(toolchain, feed, dry_run=False):
-    """ Helper for toolchain.parse_feed
+class DownloadProgress:
+    """ Display the progress of several downloads running at
+    the same time on a single line
 
     """
-    # Reset toolchain.packages:
-    package_names = [package.name for package in toolchain.packages]
-    for package_name in package_names:
-        toolchain.remove_package(package_name)
-    parser = ToolchainFeedParser()
-    parser.parse(feed)
-    package_trees = parser.packages
-    errors = list()
-    for package_tree in package_trees:
-        package = qitoolchain.Package(None, None)
-        if dry_run:
-            package_name = package_tree.get("name")
-            package_url  = package_tree.get("url")
-            # Check that url can be opened
-            fp = None
+    def __init__(self, num_packages):
+        self.num_packages = num_packages
+        self.num_done = 0
+        # package index -> (total size, downloaded size)
+        self._sizes = dict()
+        self._lock = threading.Lock()
+
+    def get_callback(self, index):
+        """ Return a callback for :py:func:`qitoolchain.remote.download`
+
+        """
+        def callback(total, done):
+            "Called from the download threads"
+            with self._lock:
+                self._sizes[index] = (total, done)
+                self._display()
+        return callback
+
+    def package_done(self):
+        """ Called when a package is extracted """
+        with self._lock:
+            self.num_done += 1
+            self._display()
+
+    def _display(self):
+        """ Display the progress, if stdout is a terminal """
+        if not sys.stdout.isatty():
+            return
+        total = sum(x[0] for x in self._sizes.values())
+        done = sum(x[1] for x in self._sizes.values())
+        sys.stdout.write("Packages: %i/%i, downloaded: %i/%i kB\r" %
+            (self.num_done, self.num_packages, done / 1024, total / 1024))
+        sys.stdout.flush()
+
+
+def fetch_packages(toolchain, package_trees, num_jobs=None,
+                   extract_jobs=EXTRACT_JOBS, validators=None, force=None):
+    """ Download and extract the remote packages of a feed.
+
+    At most num_jobs packages are downloaded, and extract_jobs
+    packages are extracted at the same time. A package is extracted
+    as soon as its download is over.
+
+    If something goes wrong, no new download is started, and the
+    error of the first failing package (in the order of package_trees)
+    is raised once the running jobs are over.
+
+    :param validators: passed to :py:func:`download_package`
+    :param force: package trees whose archive must be downloaded (or
+                  checked) again, and always extracted, for instance
+                  because they were published again at the same url
+
+    :return: a dict: index in package_trees -> path of the package
+
+    """
+    if not num_jobs:
+        num_jobs = DOWNLOAD_JOBS
+    if force is None:
+        force = list()
+    remote_trees = [(i, x) for (i, x) in enumerate(package_trees)
+                    if x.get("url")]
+    forced = set(i for (i, x) in remote_trees if x in force)
+    res = dict()
+    if not remote_trees:
+        return res
+
+    progress = DownloadProgress(len(remote_trees))
+    to_download = Queue.Queue()
+    to_extract = Queue.Queue()
+    # (index, status, result) where status is "ok", "failed"
+    # or "skipped"
+    done = Queue.Queue()
+    stopping = threading.Event()
+    # Packages sharing an url share their archive too: make sure
+    # it is only downloaded once
+    archive_locks = dict()
+    for (_index, package_tree) in remote_trees:
+        (_url, archive_path) = get_package_archive(package_tree.get("feed"),
+                                                   package_tree, toolchain)
+        archive_locks.setdefault(archive_path, threading.Lock())
+
+    def downloader():
+        "To be called in a thread"
+        while True:
+            job = to_download.get()
+            if job is None:
+                return
+            (index, package_tree) = job
+            if stopping.is_set():
+                done.put((index, "skipped", None))
+                continue
+            feed = package_tree.get("feed")
             try:
-                fp = qitoolchain.remote.open_remote_location(package_url)
-            except Exception, e:
-                error = "Could not add %s from %s\n" % (package_name, package_url)
-                error += "Error was: %s" % e
-                errors.append(error)
+                (_url, archive_path) = get_package_archive(feed, package_tree,
+                                                           toolchain)
+                with archive_locks[archive_path]:
+                    download_package(feed, package_tree, toolchain,
+                        callback=progress.get_callback(index),
+                        validators=validators, force=index in forced)
+                to_extract.put((index, package_tree, archive_path))
+            except Exception:
+                done.put((index, "failed", sys.exc_info()))
+
+    def extractor():
+        "To be called in a thread"
+        while True:
+            job = to_extract.get()
+            if job is None:
+                return
+            (index, package_tree, archive_path) = job
+            if stopping.is_set():
+                done.put((index, "skipped", None))
                 continue
-            finally:
-                if fp:
-                    fp.close()
-            if package_url:
-                print "Would add ", package_name, "from", package_url
-            continue
-        else:
-            handle_package(package, package_tree, toolchain)
-        if package.path is None:
-            mess  = "could guess package path from this configuration:\n"
-            mess += ElementTree.tostring(package_tree)
-            mess += "Please make sure you have at least an url or a directory\n"
-            LOGGER.warning(mess)
-            continue
-        if not dry_run:
-            toolchain.add_package(package)
+            try:
+                path = extract_package(package_tree.get("name"), archive_path,
+                                       toolchain, force=index in forced)
+                progress.package_done()
+                done.put((index, "ok", path))
+            except Exception:
+                done.put((index, "failed", sys.exc_info()))
+
+    threads = list()
+    for (i, target) in enumerate([downloader] * num_jobs +
+                                 [extractor] * extract_jobs):
+        thread = threading.Thread(target=target,
+                                  name="%s<%i>" % (target.__name__, i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for job in remote_trees:
+        to_download.put(job)
+
+    errors = list()
+    for i in range(len(remote_trees)):
+        (index, status, result) = done.get()
+        if status == "ok":
+            res[index] = result
+        elif status == "failed":
+            errors.append((index, result))
+            stopping.set()
+
+    for i in range(num_jobs):
+        to_download.put(None)
+    for i in range(extract_jobs):
+        to_extract.put(None)
+    for thread in threads:
+        thread.join()
+    if sys.stdout.isatty():
+        sys.stdout.write("\n")
+
+    if errors:
+        errors.sort()
+        exc_info = errors[0][1]
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return res
+
+
+def _same_package(package, other):
+    """ Check if two packages come from the same place """
+    for attr in ["path", "toolchain_file", "url", "version", "sha256"]:
+        if getattr(package, attr) != getattr(other, attr):
+            return False
+    return True
+
+
+class UpdatePlan:
+    """ What has to be done to update a toolchain from a feed
+
+    The packages of the feed are compared to the packages of the
+    toolchain by name, then by path, toolchain file, url, version
+    and sha256. Nothing is downloaded.
+
+    """
+    def __init__(self, toolchain, package_trees):
+        self.toolchain = toolchain
+        # The packages of the toolchain once updated, in the order
+        # of the feed
+        self.packages = list()
+        # Package trees of the new and changed packages
+        self.to_add = list()
+        self.to_upgrade = list()
+        # Names of the packages no longer in the feed
+        self.to_remove = list()
+        # Names of the packages that did not change
+        self.unchanged = list()
+        # Package trees to give to fetch_packages, in the order of
+        # the feed: new and changed remote packages, plus the remote
+        # packages with neither a version nor a sha256, which may have
+        # been published again at the same url (see
+        # qitoolchain.remote.ValidatorCache)
+        self.to_fetch = list()
+        self._current = dict((x.name, x) for x in toolchain.packages)
+        self._new = dict()
+        self._compute(package_trees)
+
+    def _compute(self, package_trees):
+        """ Fill the lists of the plan """
+        packages_path = None
+        for package_tree in package_trees:
+            name = package_tree.get("name")
+            package_path = None
+            if name and package_tree.get("url"):
+                # Where extract_package will put it
+                if packages_path is None:
+                    packages_path = qitoolchain.toolchain.get_default_packages_path(
+                        self.toolchain.name)
+                package_path = os.path.join(packages_path, name)
+            package = qitoolchain.Package(None, None)
+            handle_package(package, package_tree, self.toolchain,
+                           package_path=package_path)
+            if package.path is None:
+                mess  = "could guess package path from this configuration:\n"
+                mess += ElementTree.tostring(package_tree)
+                mess += "Please make sure you have at least an url or a directory\n"
+                LOGGER.warning(mess)
+                continue
+            self.packages.append(package)
+            self._new[package.name] = package
+            current = self._current.get(package.name)
+            if current is None:
+                self.to_add.append(package_tree)
+            elif not _same_package(current, package) or \
+                    (package.url and not os.path.exists(package.path)):
+                self.to_upgrade.append(package_tree)
+            else:
+                self.unchanged.append(package.name)
+                if package.url and not package.version and not package.sha256:
+                    self.to_fetch.append(package_tree)
+                continue
+            if package.url:
+                self.to_fetch.append(package_tree)
+        self.to_remove = [x.name for x in self.toolchain.packages
+                          if x.name not in self._new]
+
+    def needs_update(self):
+        """ Whether the configuration of the toolchain has to be written """
+        if self.to_add or self.to_upgrade or self.to_remove:
+            return True
+        new_order = [x.name for x in self.packages]
+        return new_order != [x.name for x in self.toolchain.packages]
+
+    def __str__(self):
+        res  = "Toolchain %s: " % self.toolchain.name
+        res += "%i to add, %i to upgrade, %i to remove, %i unchanged" % \
+            (len(self.to_add), len(self.to_upgrade), len(self.to_remove),
+             len(self.unchanged))
+        for package_tree in self.to_add:
+            package = self._new[package_tree.get("name")]
+            res += "\n  + %s" % _describe(package)
+        for package_tree in self.to_upgrade:
+            package = self._new[package_tree.get("name")]
+            current = self._current[package.name]
+            res += "\n  ~ %s -> %s" % (_describe(current), _describe(package))
+        for name in self.to_remove:
+            res += "\n  - %s" % name
+        return res
+
+
+def _describe(package):
+    """ Used when printing an UpdatePlan """
+    res = package.name
+    if package.version:
+        res += " " + package.version
+    res += " (from %s)" % (package.url or package.path)
+    return res
+
+
+def parse_feed(toolchain, feed, dry_run=False, num_jobs=None):
+    """ Helper for toolchain.parse_feed
+
+    Only the packages that changed are fetched (see :py:class:`UpdatePlan`).
+    Remote packages are fetched in parallel (see :py:func:`fetch_packages`),
+    and the configuration of the toolchain is written once, with the
+    packages in the order of the feed.
+
+    The ETag and Last-Modified headers of the feeds and of the packages
+    are stored in the toolchain cache, so that they are only downloaded
+    again when they change.
+
+    With dry_run, print the plan, and check that the urls of the
+    packages to fetch can be opened. Nothing is written in the
+    toolchain cache in this case.
+
+    """
+    if dry_run:
+        parser = ToolchainFeedParser()
+        parser.parse(feed)
+        plan = UpdatePlan(toolchain, parser.packages)
+        print plan
+        check_plan(plan, feed)
+        return
+
+    validators = qitoolchain.remote.ValidatorCache(
+        os.path.join(toolchain.cache, VALIDATORS_FILE))
+    try:
+        parser = ToolchainFeedParser(cache_dir=toolchain.cache,
+                                     validators=validators)
+        parser.parse(feed)
+        plan = UpdatePlan(toolchain, parser.packages)
+        LOGGER.info(str(plan).splitlines()[0])
+        fetch_packages(toolchain, plan.to_fetch, num_jobs=num_jobs,
+                       validators=validators, force=plan.to_upgrade)
+    finally:
+        validators.save()
 
-    if dry_run and errors:
+    if plan.needs_update():
+        toolchain.set_packages(plan.packages)
+
+
+def check_plan(plan, feed):
+    """ Check that the urls of the packages to add or
+    to upgrade can be opened. Exit if they can not
+
+    """
+    errors = list()
+    for package_tree in plan.to_add + plan.to_upgrade:
+        package_name = package_tree.get("name")
+        package_url = package_tree.get("url")
+        if not package_url:
+            continue
+        (package_url, _archive) = get_package_archive(package_tree.get("feed"),
+            package_tree, plan.toolchain)
+        fp = None
+        try:
+            fp = qitoolchain.remote.open_remote_location(package_url)
+        except Exception, e:
+            error = "Could not add %s from %s\n" % (package_name, package_url)
+            error += "Error was: %s" % e
+            errors.append(error)
+        finally:
+            if fp:
+                fp.close()
+
+    if errors:
         print "Errors when parsing %s\n" % feed
         for error in errors:
             print error
         sys.exit(2)
-
@@ -9,16 +9,28 @@ downloading package or reading configs from URLs
 
 import os
 import sys
+import atexit
 import ftplib
+import httplib
+import socket
 import urlparse
 import urllib2
+import json
 import logging
+import hashlib
+import threading
 import StringIO
 
 import qibuild
 
 LOGGER = logging.getLogger(__name__)
 
+# Size of the chunks read when downloading
+BUFF_SIZE = 100 * 1024
+
+# Number of idle connections kept for each server
+MAX_IDLE_CONNECTIONS = 4
+
 def callback(total, done):
     """ Called during download """
     if not sys.stdout.isatty():
@@ -58,24 +70,256 @@ def get_ftp_access(server_name):
         return (access.username, access.password, access.root)
 
 
-def authenticated_urlopen(location):
+class ConnectionPool:
+    """ Keep the FTP sessions and the HTTP connections open, so
+    that downloading several files from the same server only
+    connects and logs in once.
+
+    A connection is only used by one thread at a time: it is taken
+    from the pool, and given back with :py:meth:`release` once the
+    transfer is over. Connections in an unknown state should be
+    closed instead.
+
+    """
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+        self.max_idle = max_idle
+        # key -> list of idle connections
+        self._idle = dict()
+        # (scheme, netloc) -> urllib2 opener
+        self._openers = dict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """ Return an idle connection, or None """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def release(self, key, connection):
+        """ Give a connection back to the pool """
+        with self._lock:
+            idle = self._idle.setdefault(key, list())
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        _close_connection(connection)
+
+    def get_ftp(self, server_name):
+        """ Return a (key, ftp) tuple, ftp being a logged in
+        ftplib.FTP object, in the root directory of the server
+
+        """
+        (username, password, root) = get_ftp_access(server_name)
+        key = ("ftp", server_name, username)
+        ftp = self.take(key)
+        while ftp:
+            try:
+                ftp.voidcmd("NOOP")
+                return (key, ftp)
+            except ftplib.all_errors:
+                _close_connection(ftp)
+                ftp = self.take(key)
+        ftp = ftplib.FTP(server_name, username, password)
+        if root:
+            ftp.cwd(root)
+        return (key, ftp)
+
+    def get_opener(self, location):
+        """ Return an urllib2 opener for the server of the location,
+        using authentication information if provided by the user,
+        and keeping the HTTP connections alive
+
+        """
+        #pylint: disable-msg=E1103
+        url_split = urlparse.urlsplit(location)
+        key = (url_split.scheme, url_split.netloc)
+        with self._lock:
+            opener = self._openers.get(key)
+        if opener:
+            return opener
+        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        access = get_server_access(url_split.netloc)
+        if access is not None:
+            user = access.username
+            password = access.password
+            if user is not None and password is not None:
+                passman.add_password(None, "%s://%s/" % key, user, password)
+        authhandler = urllib2.HTTPBasicAuthHandler(passman)
+        opener = urllib2.build_opener(authhandler, KeepAliveHandler(self))
+        with self._lock:
+            return self._openers.setdefault(key, opener)
+
+    def close(self):
+        """ Close every idle connection """
+        with self._lock:
+            idle = self._idle
+            self._idle = dict()
+            self._openers = dict()
+        for connections in idle.itervalues():
+            for connection in connections:
+                _close_connection(connection)
+
+
+def _close_connection(connection):
+    """ Close a FTP or a HTTP connection, ignoring errors """
+    try:
+        if isinstance(connection, ftplib.FTP):
+            try:
+                connection.quit()
+            except ftplib.all_errors:
+                connection.close()
+        else:
+            connection.close()
+    except Exception, e:
+        LOGGER.debug("Error when closing connection: %s", e)
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """ A urllib2 handler for http and https urls, using the
+    connections of a :py:class:`ConnectionPool`
+
+    """
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        "Called by urllib2"
+        return self._open(req, httplib.HTTPConnection)
+
+    def https_open(self, req):
+        "Called by urllib2"
+        return self._open(req, httplib.HTTPSConnection)
+
+    def _open(self, req, connection_class):
+        """ Send the request, on an idle connection if possible """
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+        # pylint: disable-msg=W0212
+        tunnel_host = req._tunnel_host
+        key = (req.get_type(), host, tunnel_host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for (k, v) in req.headers.items()
+                       if k not in headers)
+        headers = dict((k.title(), v) for (k, v) in headers.items())
+        headers["Connection"] = "keep-alive"
+        while True:
+            connection = self.pool.take(key)
+            reused = connection is not None
+            if not reused:
+                connection = connection_class(host, timeout=req.timeout)
+                if tunnel_host:
+                    connection.set_tunnel(tunnel_host)
+            try:
+                connection.request(req.get_method(), req.get_selector(),
+                                   req.data, headers)
+                response = connection.getresponse()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if not reused:
+                    raise urllib2.URLError(e)
+                # The server closed the idle connection, try again
+
+        pooled = PooledResponse(self.pool, key, connection, response)
+        res = urllib2.addinfourl(pooled, response.msg, req.get_full_url())
+        res.code = response.status
+        res.msg = response.reason
+        return res
+
+
+class PooledResponse:
+    """ Wrap a httplib response, giving the connection back
+    to the pool once the whole body has been read
+
+    """
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._buffer = ""
+        if response.length == 0:
+            # No body (HEAD, 304 ...)
+            response.read()
+        self._check_done()
+
+    def read(self, amt=None):
+        "Read at most amt bytes, or everything"
+        buffered = self._buffer
+        if amt is None:
+            data = buffered + self._response.read()
+            self._buffer = ""
+        elif len(buffered) >= amt:
+            data = buffered[:amt]
+            self._buffer = buffered[amt:]
+        else:
+            data = buffered + self._response.read(amt - len(buffered))
+            self._buffer = ""
+        self._check_done()
+        return data
+
+    def readline(self):
+        "Read a line"
+        while "\n" not in self._buffer:
+            data = self._response.read(BUFF_SIZE)
+            if not data:
+                break
+            self._buffer += data
+        end = self._buffer.find("\n") + 1 or len(self._buffer)
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end:]
+        self._check_done()
+        return line
+
+    def _check_done(self):
+        """ Release the connection if the whole body has been read """
+        if self._connection is None or not self._response.isclosed():
+            return
+        if self._response.will_close or self._response.length:
+            # Closed by the server, maybe in the middle of the body
+            self._connection.close()
+        else:
+            self._pool.release(self._key, self._connection)
+        self._connection = None
+
+    def close(self):
+        "Close the response. The connection is only reused if it was read"
+        if self._connection is None:
+            return
+        self._response.close()
+        self._connection.close()
+        self._connection = None
+
+
+_POOL = ConnectionPool()
+
+
+def close_connections():
+    """ Close the idle connections. Called when the program exits """
+    _POOL.close()
+
+atexit.register(close_connections)
+
+
+def authenticated_urlopen(location, headers=None):
     """ A wrapper around urlopen adding authentication information
     if provided by the user.
 
+    Connections to the server are kept open, see :py:class:`ConnectionPool`
+
+    :param headers: a dict of additional headers to send
+
     """
-    passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-    #pylint: disable-msg=E1103
-    server_name = urlparse.urlsplit(location).netloc
-    access = get_server_access(server_name)
-    if access is not None:
-        user = access.username
-        password = access.password
-        if user is not None and password is not None:
-            passman.add_password(None, location, user, password)
-    authhandler = urllib2.HTTPBasicAuthHandler(passman)
-    opener = urllib2.build_opener(authhandler)
-    urllib2.install_opener(opener)
-    return urllib2.urlopen(location)
+    opener = _POOL.get_opener(location)
+    request = urllib2.Request(location)
+    if headers:
+        for (key, value) in headers.iteritems():
+            request.add_header(key, value)
+    return opener.open(request)
 
 def open_remote_location(location):
     """ Open a file from an url
@@ -88,10 +332,7 @@ def open_remote_location(location):
     server_name = url_split.netloc
     #pylint: disable-msg=E1103
     if url_split.scheme == "ftp":
-        (username, password, root) = get_ftp_access(server_name)
-        ftp = ftplib.FTP(server_name, username, password)
-        if root:
-            ftp.cwd(root)
+        (key, ftp) = _POOL.get_ftp(server_name)
         class Transfer:
             pass
         Transfer.data = ""
@@ -99,20 +340,43 @@ def open_remote_location(location):
         cmd = "RETR " + url_split.path
         def retr_callback(data):
             Transfer.data += data
-        ftp.retrbinary(cmd, retr_callback)
+        try:
+            ftp.retrbinary(cmd, retr_callback)
+        except:
+            _close_connection(ftp)
+            raise
+        _POOL.release(key, ftp)
         return StringIO.StringIO(Transfer.data)
     else:
         return authenticated_urlopen(location)
 
 
+class ChecksumMismatch(Exception):
+    """ Raised when a downloaded file does not match
+    the expected size or sha256
+
+    """
+    pass
+
+
 def download(url, output_dir,
     output_name=None,
     callback=callback,
     clobber=True,
-    message=None):
+    message=None,
+    sha256=None,
+    size=None,
+    validators=None):
     """ Download a file from an url, and save it
     in output_dir.
 
+    The file is first written to <dest>.part, which is kept if the
+    download fails, so that the next download of the same url starts
+    where it stopped (using a HTTP Range request, or a FTP REST command).
+    This is only done when sha256 or size is given, so that a partial
+    download of an older version of the file is never completed with
+    the end of a newer one.
+
     :param output_name: The name of the file will be the basename of the url,
         unless output_name is given
 
@@ -123,7 +387,21 @@ def download(url, output_dir,
         bar.
 
     :param clobber: If False, the file won't be overwritten if it
-        already exists (True by default)
+        already exists (True by default), unless it does not match
+        the given sha256 or size
+
+    :param sha256: If given, the expected sha256 of the file, computed
+        while downloading. If it does not match (or if size does not match),
+        the partial download is discarded and the file is downloaded
+        again, once.
+
+    :param size: If given, the expected size of the file
+
+    :param validators: a :py:class:`ValidatorCache`. If the file
+        already exists and the cache has an ETag or a Last-Modified
+        date for the url, a conditional request is sent, even if
+        clobber is False, and the file is left untouched if it has
+        not changed on the server.
 
     :return: the path to the downloaded file
 
@@ -135,75 +413,296 @@ def download(url, output_dir,
         dest_name = url.split("/")[-1]
         dest_name = os.path.join(output_dir, dest_name)
 
-    error = None
-
-    if os.path.exists(dest_name) and not clobber:
-        return dest_name
+    conditional = None
+    if os.path.exists(dest_name) and not _file_matches(dest_name, sha256, size):
+        LOGGER.debug("%s does not match, downloading it again", dest_name)
+    elif os.path.exists(dest_name):
+        if validators:
+            conditional = validators.get_headers(url)
+        if not conditional and not clobber:
+            return dest_name
 
     if message:
         LOGGER.info(message)
 
-    try:
-        dest_file = open(dest_name, "wb")
-    except Exception, e:
-        mess  = "Could not save %s to %s\n" % (url, dest_name)
-        mess += "Error was %s" % e
-        raise Exception(mess)
+    part_name = dest_name + ".part"
+    error = None
+    for attempt in range(2):
+        try:
+            headers = _download_part(url, part_name, callback, sha256, size,
+                                     conditional=conditional)
+            if headers is None:
+                LOGGER.debug("%s not modified", url)
+                return dest_name
+            error = None
+            break
+        except ChecksumMismatch, e:
+            conditional = None
+            qibuild.sh.rm(part_name)
+            error  = "Could not dowload file from %s\n to %s\n" % (url, dest_name)
+            error += "Error was: %s" % e
+            if attempt == 0:
+                LOGGER.warning("%s: %s\nDownloading it again", url, e)
+        except Exception, e:
+            error  = "Could not dowload file from %s\n to %s\n" % (url, dest_name)
+            error += "Error was: %s" % e
+            if os.path.exists(part_name):
+                error += "\n(Partial download kept in %s)" % part_name
+            break
+    if error:
+        raise Exception(error)
+
+    if os.path.exists(dest_name):
+        qibuild.sh.rm(dest_name)
+    os.rename(part_name, dest_name)
+    if validators:
+        validators.update(url, headers)
+    return dest_name
+
+
+def _file_matches(path, sha256, size):
+    """ Check that an existing file has the given sha256 and size.
+    (True if none of them is given)
+
+    """
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if not sha256:
+        return True
+    # pylint: disable-msg=E1101
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(BUFF_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest() == sha256.lower()
+
+
+class ValidatorCache:
+    """ Store the ETag and Last-Modified headers of the downloaded
+    urls, so that the next downloads of the same urls can be
+    conditional requests.
+
+    Can be used from several threads. Changes are only written
+    by :py:meth:`save`
+
+    """
+    def __init__(self, path):
+        self.path = path
+        # url -> {"etag" : ..., "last_modified" : ...}
+        self._validators = dict()
+        self._lock = threading.Lock()
+        self._changed = False
+        self.load()
+
+    def load(self):
+        """ Read the cache file, if it exists """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as fp:
+                self._validators = json.load(fp)
+        except (IOError, ValueError), e:
+            LOGGER.warning("Could not read %s: %s", self.path, e)
+            self._validators = dict()
+
+    def save(self):
+        """ Write the cache file, if something changed """
+        with self._lock:
+            if not self._changed:
+                return
+            qibuild.sh.mkdir(os.path.dirname(self.path), recursive=True)
+            with open(self.path, "w") as fp:
+                json.dump(self._validators, fp, indent=2, sort_keys=True)
+            self._changed = False
+
+    def get_headers(self, url):
+        """ Return the headers of a conditional request for
+        the url, or None if nothing is known about it
+
+        """
+        with self._lock:
+            entry = self._validators.get(url)
+        if not entry:
+            return None
+        headers = dict()
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers or None
+
+    def update(self, url, headers):
+        """ Store the validators found in the headers of
+        a response. Only http and https urls are stored:
+        conditional requests make no sense for the others
+
+        """
+        #pylint: disable-msg=E1103
+        if urlparse.urlsplit(url).scheme not in ("http", "https"):
+            return
+        etag = headers.get("etag")
+        last_modified = headers.get("last-modified")
+        with self._lock:
+            if etag or last_modified:
+                entry = {"etag" : etag, "last_modified" : last_modified}
+                if self._validators.get(url) == entry:
+                    return
+                self._validators[url] = entry
+            elif url in self._validators:
+                del self._validators[url]
+            else:
+                return
+            self._changed = True
+
+
+def _download_part(url, part_name, callback, sha256, size, conditional=None):
+    """ Download url to part_name, resuming the download if
+    part_name exists.
+
+    Check the size and the sha256 of the result when they are given.
+    Without them, there is no way to tell whether part_name comes
+    from the same version of the file, so it is written again from
+    the beginning
+
+    :param conditional: headers to send for a conditional request
+                        (see :py:class:`ValidatorCache`). If given,
+                        part_name is written from the beginning.
+
+    :return: the headers of the response, or None if the server
+             said the file was not modified
+
+    """
+    hasher = None
+    if sha256:
+        # pylint: disable-msg=E1101
+        hasher = hashlib.sha256()
+    offset = 0
+    can_resume = sha256 or size is not None
+    if os.path.exists(part_name) and can_resume and not conditional:
+        offset = os.path.getsize(part_name)
+        if size is not None and offset > size:
+            offset = 0
+    if offset and hasher:
+        with open(part_name, "rb") as fp:
+            while True:
+                data = fp.read(BUFF_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
 
     url_split = urlparse.urlsplit(url)
-    url_obj = None
     #pylint: disable-msg=E1103
     server_name = url_split.netloc
+    class Transfer:
+        pass
+    Transfer.xferd = 0
+    Transfer.total = None
+    Transfer.headers = dict()
+    Transfer.dest_file = None
+    def write(data):
+        "Called for each chunk of data"
+        Transfer.xferd += len(data)
+        if hasher:
+            hasher.update(data)
+        Transfer.dest_file.write(data)
+        if callback and Transfer.total:
+            callback(Transfer.total, Transfer.xferd)
+
+    url_obj = None
     try:
         #pylint: disable-msg=E1103
         if url_split.scheme == "ftp":
-        # We cannot use urllib2 here because it has no support
-        # for username/password for ftp, so we will use ftplib
-        # here.
-            #pylint: disable-msg=E1103
-
-            (username, password, root) = get_ftp_access(server_name)
-            ftp = ftplib.FTP(server_name, username, password)
-            if root:
-                ftp.cwd(root)
-            class Tranfert:
-                pass
-            #pylint: disable-msg=E1103
-            size = ftp.size(url_split.path)
-            Tranfert.xferd = 0
-            def retr_callback(data):
-                Tranfert.xferd += len(data)
-                if callback:
-                    callback(size, Tranfert.xferd)
-                dest_file.write(data)
-            #pylint: disable-msg=E1103
-            cmd = "RETR " + url_split.path
-            ftp.retrbinary(cmd, retr_callback)
+            # We cannot use urllib2 here because it has no support
+            # for username/password for ftp, so we will use ftplib
+            # here.
+            (key, ftp) = _POOL.get_ftp(server_name)
+            try:
+                #pylint: disable-msg=E1103
+                Transfer.total = ftp.size(url_split.path)
+                if Transfer.total is not None and offset > Transfer.total:
+                    offset = 0
+                Transfer.xferd = offset
+                if offset:
+                    Transfer.dest_file = open(part_name, "ab")
+                else:
+                    Transfer.dest_file = open(part_name, "wb")
+                if Transfer.total is None or offset < Transfer.total:
+                    #pylint: disable-msg=E1103
+                    cmd = "RETR " + url_split.path
+                    try:
+                        ftp.retrbinary(cmd, write, rest=offset or None)
+                    except ftplib.error_perm, e:
+                        if not offset:
+                            raise
+                        LOGGER.debug("Could not resume %s: %s", url, e)
+                        # REST not supported: start from the beginning
+                        Transfer.dest_file.close()
+                        Transfer.dest_file = open(part_name, "wb")
+                        offset = 0
+                        Transfer.xferd = 0
+                        if hasher:
+                            # pylint: disable-msg=E1101
+                            hasher = hashlib.sha256()
+                        ftp.retrbinary(cmd, write)
+            except:
+                _close_connection(ftp)
+                raise
+            _POOL.release(key, ftp)
         else:
-            url_obj = authenticated_urlopen(url)
-            content_length = url_obj.headers.dict['content-length']
-            size = int(content_length)
-            buff_size = 100 * 1024
-            xferd = 0
-            while xferd < size:
-                data = url_obj.read(buff_size)
-                if not data:
-                    break
-                xferd += len(data)
-                if callback:
-                    callback(size, xferd)
-                dest_file.write(data)
-    except Exception, e:
-        error  = "Could not dowload file from %s\n to %s\n" % (url, dest_name)
-        error += "Error was: %s" % e
+            headers = dict()
+            if offset:
+                headers["Range"] = "bytes=%i-" % offset
+            if conditional:
+                headers.update(conditional)
+            try:
+                url_obj = authenticated_urlopen(url, headers=headers)
+            except urllib2.HTTPError, e:
+                if e.code == 304 and conditional:
+                    return None
+                if e.code != 416:
+                    raise
+                if offset != size:
+                    raise ChecksumMismatch("Partial download is bigger "
+                                           "than the file")
+                # Nothing left to download
+                Transfer.total = offset
+            if url_obj and url_obj.getcode() != 206:
+                # Range not supported: start from the beginning
+                offset = 0
+                if hasher:
+                    # pylint: disable-msg=E1101
+                    hasher = hashlib.sha256()
+            Transfer.xferd = offset
+            if offset:
+                Transfer.dest_file = open(part_name, "ab")
+            else:
+                Transfer.dest_file = open(part_name, "wb")
+            if url_obj:
+                Transfer.headers = url_obj.headers
+                content_length = url_obj.headers.get("content-length")
+                if content_length is not None:
+                    Transfer.total = offset + int(content_length)
+                while True:
+                    data = url_obj.read(BUFF_SIZE)
+                    if not data:
+                        break
+                    write(data)
     finally:
-        dest_file.close()
+        if Transfer.dest_file:
+            Transfer.dest_file.close()
         if url_obj:
             url_obj.close()
-    if error:
-        qibuild.sh.rm(dest_name)
-        raise Exception(error)
-
-    return dest_name
-
 
+    if Transfer.total is not None and Transfer.xferd < Transfer.total:
+        raise Exception("Connection closed after %i bytes (out of %i)" %
+            (Transfer.xferd, Transfer.total))
+    if size is not None and Transfer.xferd != size:
+        raise ChecksumMismatch("Expecting %i bytes, got %i" %
+            (size, Transfer.xferd))
+    if hasher and hasher.hexdigest() != sha256.lower():
+        raise ChecksumMismatch("Expecting sha256 %s, got %s" %
+            (sha256, hasher.hexdigest()))
+    return Transfer.headers
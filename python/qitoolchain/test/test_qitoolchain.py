@@ -387,7 +387,124 @@ class FeedTestCase(unittest.TestCase):
         feed_url = "file://" + qibuild.sh.to_posix_path(a_feed)
         tc.parse_feed(feed_url)
 
+    def test_dry_run_keeps_cache(self):
+        self.setup_srv()
+        feed_url = "file://" + qibuild.sh.to_posix_path(
+            os.path.join(self.srv, "buildfarm.xml"))
+        tc = qitoolchain.Toolchain("test")
+        before = os.listdir(tc.cache)
+        tc.parse_feed(feed_url, dry_run=True)
+        self.assertEquals(os.listdir(tc.cache), before)
+        tc.parse_feed(feed_url)
+        # Whereas a real update keeps the feed in the cache
+        self.assertNotEquals(os.listdir(tc.cache), before)
+
+    def test_parallel_fetch(self):
+        packages = os.path.join(self.srv, "packages")
+        qibuild.sh.mkdir(packages, recursive=True)
+        names = ["p%i" % i for i in range(10)]
+        urls = list()
+        for name in names:
+            package_path = os.path.join(packages, name)
+            os.mkdir(package_path)
+            with open(os.path.join(package_path, name + ".txt"), "w") as fp:
+                fp.write(name + "\n")
+            archive = qibuild.archive.zip(package_path)
+            urls.append("file://" + qibuild.sh.to_posix_path(archive))
+        # Two packages using the same archive
+        names.append("p0-again")
+        urls.append(urls[0])
+        feed = os.path.join(self.srv, "feed.xml")
+        with open(feed, "w") as fp:
+            fp.write("<toolchain>\n")
+            for (name, url) in zip(names, urls):
+                fp.write('<package name="%s" url="%s" />\n' % (name, url))
+            fp.write("</toolchain>\n")
+
+        tc = qitoolchain.Toolchain("test")
+        tc.parse_feed(feed, num_jobs=3)
+        self.assertEquals([p.name for p in tc.packages], names)
+        for name in names:
+            txt = os.path.join(tc.get(name), name.split("-")[0] + ".txt")
+            self.assertTrue(os.path.exists(txt), txt)
+        # The order is kept in the toolchain file
+        tc_file = get_tc_file_contents(tc)
+        positions = [tc_file.index(tc.get(x) + '"') for x in names]
+        self.assertEquals(positions, sorted(positions))
+
+        # An error is raised, and nothing is added
+        with open(feed, "w") as fp:
+            fp.write('<toolchain><package name="p1" url="%s" />'
+                     '<package name="missing" url="%s" /></toolchain>' %
+                     (urls[1], urls[1] + ".nope"))
+        tc = qitoolchain.Toolchain("broken")
+        self.assertRaises(Exception, tc.parse_feed, feed, num_jobs=2)
+        self.assertEquals(tc.packages, list())
+
+
+
+    def test_update_plan(self):
+        packages = os.path.join(self.srv, "packages")
+        qibuild.sh.mkdir(packages, recursive=True)
+        urls = dict()
+        archives = dict()
+        for name in ["a", "b", "c"]:
+            package_path = os.path.join(packages, name)
+            os.mkdir(package_path)
+            with open(os.path.join(package_path, "README"), "w") as fp:
+                fp.write(name + "\n")
+            archive = qibuild.archive.zip(package_path)
+            archives[name] = archive
+            urls[name] = "file://" + qibuild.sh.to_posix_path(archive)
+        feed = os.path.join(self.srv, "feed.xml")
+        def write_feed(packages):
+            with open(feed, "w") as fp:
+                fp.write("<toolchain>\n")
+                for (name, version) in packages:
+                    fp.write('<package name="%s" version="%s" url="%s" />\n' %
+                             (name, version, urls[name]))
+                fp.write("</toolchain>\n")
+
+        write_feed([("a", "1.0"), ("b", "1.0")])
+        tc = qitoolchain.Toolchain("test")
+        tc.parse_feed(feed)
+        self.assertEquals([p.name for p in tc.packages], ["a", "b"])
+        self.assertEquals(tc.packages[0].version, "1.0")
 
+        # Nothing changed
+        tc = qitoolchain.Toolchain("test")
+        parser = qitoolchain.feed.ToolchainFeedParser()
+        parser.parse(feed)
+        plan = qitoolchain.feed.UpdatePlan(tc, parser.packages)
+        self.assertEquals(plan.unchanged, ["a", "b"])
+        self.assertEquals(plan.to_fetch, list())
+        self.assertFalse(plan.needs_update())
+
+        write_feed([("b", "2.0"), ("c", "1.0")])
+        parser = qitoolchain.feed.ToolchainFeedParser()
+        parser.parse(feed)
+        plan = qitoolchain.feed.UpdatePlan(tc, parser.packages)
+        self.assertEquals([x.get("name") for x in plan.to_add], ["c"])
+        self.assertEquals([x.get("name") for x in plan.to_upgrade], ["b"])
+        self.assertEquals(plan.to_remove, ["a"])
+        self.assertTrue("~ b 1.0 (from %s) -> b 2.0" % urls["b"] in str(plan))
+
+        # dry-run does not change anything
+        tc.parse_feed(feed, dry_run=True)
+        tc = qitoolchain.Toolchain("test")
+        self.assertEquals([p.name for p in tc.packages], ["a", "b"])
+
+        # b 2.0 is published at the same url
+        with open(os.path.join(packages, "b", "README"), "w") as fp:
+            fp.write("b 2.0\n")
+        qibuild.sh.rm(archives["b"])
+        qibuild.archive.zip(os.path.join(packages, "b"))
+        tc.parse_feed(feed)
+        self.assertEquals([(p.name, p.version) for p in tc.packages],
+                          [("b", "2.0"), ("c", "1.0")])
+        self.assertTrue(os.path.exists(tc.get("c")))
+        with open(os.path.join(tc.get("b"), "README"), "r") as fp:
+            self.assertEquals(fp.read(), "b 2.0\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,271 @@
+## Copyright (c) 2012 Aldebaran Robotics. All rights reserved.
+## Use of this source code is governed by a BSD-style license that can be
+## found in the COPYING file.
+
+"""Automatic testing for qitoolchain.remote
+
+"""
+
+import os
+import ftplib
+import hashlib
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+import qibuild
+import qitoolchain.remote
+
+DATA = "".join(chr(i % 251) for i in range(300 * 1024))
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve DATA, honoring Range and If-None-Match headers,
+    and possibly closing the connection in the middle of the transfer
+
+    """
+    protocol_version = "HTTP/1.1"
+
+    # Set by the test case
+    ranges = list()
+    clients = list()
+    truncate = None
+    support_range = True
+    etag = None
+    not_modified = 0
+
+    def do_GET(self):
+        "Called by BaseHTTPServer"
+        offset = 0
+        range_header = self.headers.get("Range")
+        RangeHandler.ranges.append(range_header)
+        RangeHandler.clients.append(self.client_address)
+        etag = RangeHandler.etag
+        if etag and self.headers.get("If-None-Match") == etag:
+            RangeHandler.not_modified += 1
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if range_header and RangeHandler.support_range:
+            offset = int(range_header.split("=")[1].rstrip("-"))
+            if offset >= len(DATA):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" %
+                (offset, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(DATA) - offset))
+        self.end_headers()
+        to_send = DATA[offset:]
+        if RangeHandler.truncate is not None:
+            to_send = to_send[:RangeHandler.truncate]
+            self.close_connection = 1
+        self.wfile.write(to_send)
+
+    def log_message(self, *args):
+        "Do not write on stderr"
+        pass
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Needed because of keep-alive connections """
+    daemon_threads = True
+
+
+class NoRestFTP(ftplib.FTP):
+    """ A FTP session serving DATA, without support for the
+    REST command
+
+    """
+    def __init__(self):
+        ftplib.FTP.__init__(self)
+        self.retrieved = list()
+
+    def voidcmd(self, cmd):
+        return "200 OK"
+
+    def size(self, filename):
+        return len(DATA)
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        self.retrieved.append(rest)
+        if rest is not None:
+            raise ftplib.error_perm("502 REST not implemented")
+        for i in range(0, len(DATA), blocksize):
+            callback(DATA[i:i+blocksize])
+        return "226 Transfer complete"
+
+    def quit(self):
+        pass
+
+
+class RemoteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-remote")
+        self.dest = os.path.join(self.tmp, "data.bin")
+        RangeHandler.ranges = list()
+        RangeHandler.clients = list()
+        RangeHandler.truncate = None
+        RangeHandler.support_range = True
+        RangeHandler.etag = None
+        RangeHandler.not_modified = 0
+        self.server = ThreadedServer(("127.0.0.1", 0), RangeHandler)
+        self.url = "http://127.0.0.1:%i/data.bin" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        # pylint: disable-msg=E1101
+        self.sha256 = hashlib.sha256(DATA).hexdigest()
+
+    def tearDown(self):
+        qitoolchain.remote.close_connections()
+        self.server.shutdown()
+        self.server.server_close()
+        qibuild.sh.rm(self.tmp)
+
+    def download(self, **kwargs):
+        return qitoolchain.remote.download(self.url, self.tmp,
+            output_name="data.bin", callback=None, **kwargs)
+
+    def read_dest(self):
+        with open(self.dest, "rb") as fp:
+            return fp.read()
+
+    def test_simple(self):
+        self.download(sha256=self.sha256, size=len(DATA))
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertFalse(os.path.exists(self.dest + ".part"))
+        self.assertEquals(RangeHandler.ranges, [None])
+
+    def test_resume(self):
+        RangeHandler.truncate = 100 * 1024
+        self.assertRaises(Exception, self.download, sha256=self.sha256)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEquals(os.path.getsize(self.dest + ".part"), 100 * 1024)
+        RangeHandler.truncate = None
+        self.download(sha256=self.sha256)
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(RangeHandler.ranges, [None, "bytes=102400-"])
+
+    def test_range_not_supported(self):
+        with open(self.dest + ".part", "wb") as fp:
+            fp.write(DATA[:1000])
+        RangeHandler.support_range = False
+        self.download(sha256=self.sha256)
+        self.assertEquals(self.read_dest(), DATA)
+
+    def test_bad_part_fetched_again(self):
+        # A partial download of an older version of the file
+        with open(self.dest + ".part", "wb") as fp:
+            fp.write("x" * 1000)
+        self.download(sha256=self.sha256, size=len(DATA))
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(RangeHandler.ranges, ["bytes=1000-", None])
+
+    def test_stale_part_without_checksum(self):
+        # Without sha256 nor size, there is no way to tell the
+        # partial download is from the same file
+        with open(self.dest + ".part", "wb") as fp:
+            fp.write("x" * 1000)
+        self.download()
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(RangeHandler.ranges, [None])
+
+    def test_ftp_rest_not_supported(self):
+        with open(self.dest + ".part", "wb") as fp:
+            fp.write(DATA[:1000])
+        url = "ftp://ftp.example.com/data.bin"
+        (username, _password, _root) = \
+            qitoolchain.remote.get_ftp_access("ftp.example.com")
+        ftp = NoRestFTP()
+        qitoolchain.remote._POOL.release(("ftp", "ftp.example.com", username),
+                                         ftp)
+        qitoolchain.remote.download(url, self.tmp, output_name="data.bin",
+            callback=None, sha256=self.sha256)
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(ftp.retrieved, [1000, None])
+
+    def test_checksum_mismatch(self):
+        error = None
+        try:
+            self.download(sha256="0" * 64)
+        except Exception, e:
+            error = e
+        self.assertFalse(error is None)
+        self.assertTrue("sha256" in str(error), error)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + ".part"))
+        self.assertEquals(len(RangeHandler.ranges), 2)
+
+    def test_conditional(self):
+        validators_path = os.path.join(self.tmp, "validators.json")
+        validators = qitoolchain.remote.ValidatorCache(validators_path)
+        RangeHandler.etag = '"v1"'
+        self.download(clobber=False, validators=validators)
+        validators.save()
+        self.assertEquals(validators.get_headers(self.url),
+                          {"If-None-Match" : '"v1"'})
+
+        # Not modified: the file is not written again
+        with open(self.dest, "wb") as fp:
+            fp.write("cached")
+        validators = qitoolchain.remote.ValidatorCache(validators_path)
+        self.download(clobber=False, validators=validators)
+        self.assertEquals(RangeHandler.not_modified, 1)
+        self.assertEquals(self.read_dest(), "cached")
+
+        # Modified on the server
+        RangeHandler.etag = '"v2"'
+        self.download(clobber=False, validators=validators)
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(len(RangeHandler.ranges), 3)
+        validators.save()
+        validators = qitoolchain.remote.ValidatorCache(validators_path)
+        self.assertEquals(validators.get_headers(self.url),
+                          {"If-None-Match" : '"v2"'})
+
+        # Without validators, clobber=False still means no request at all
+        self.download(clobber=False)
+        self.assertEquals(len(RangeHandler.ranges), 3)
+
+    def test_cached_file_checked(self):
+        # No validators: only the sha256 can tell the file is wrong
+        with open(self.dest, "wb") as fp:
+            fp.write("corrupt")
+        self.download(clobber=False, sha256=self.sha256)
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(RangeHandler.ranges, [None])
+        # A good file is not downloaded again
+        self.download(clobber=False, sha256=self.sha256, size=len(DATA))
+        self.assertEquals(len(RangeHandler.ranges), 1)
+
+    def test_connection_reused(self):
+        for i in range(3):
+            self.download(sha256=self.sha256)
+        fp = qitoolchain.remote.open_remote_location(self.url)
+        self.assertEquals(fp.readline(), DATA[:DATA.index("\n") + 1])
+        fp.read()
+        fp.close()
+        self.assertEquals(len(RangeHandler.clients), 4)
+        self.assertEquals(len(set(RangeHandler.clients)), 1)
+
+        # A connection closed by the server is not reused
+        RangeHandler.truncate = 1000
+        self.assertRaises(Exception, self.download)
+        RangeHandler.truncate = None
+        self.download(sha256=self.sha256)
+        self.assertEquals(self.read_dest(), DATA)
+        self.assertEquals(len(set(RangeHandler.clients)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
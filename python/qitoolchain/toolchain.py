@@ -7,6 +7,7 @@ A set of packages and a toolchain file
 """
 
 import os
+import shlex
 import ConfigParser
 
 import qibuild
@@ -24,9 +25,7 @@ def get_default_packages_path(tc_name):
     """
     default_root = qibuild.sh.to_native_path(SHARE_PATH)
     default_root = os.path.join(default_root, "toolchains")
-    config = ConfigParser.ConfigParser()
-    cfg_path = get_tc_config_path()
-    config.read(cfg_path)
+    config = qibuild.configcache.read_cfg(get_tc_config_path())
     root = default_root
     if config.has_section("default"):
         try:
@@ -47,8 +46,7 @@ def get_tc_names():
         linux32=
         linux64=/path/to/linux64/feed.xxml
     """
-    config = ConfigParser.ConfigParser()
-    config.read(get_tc_config_path())
+    config = qibuild.configcache.read_cfg(get_tc_config_path())
     if not config.has_section('toolchains'):
         return list()
     tc_items = config.items('toolchains')
@@ -60,8 +58,7 @@ def get_tc_feed(tc_name):
     """ Get the feed associated to a toolchain
 
     """
-    config = ConfigParser.ConfigParser()
-    config.read(get_tc_config_path())
+    config = qibuild.configcache.read_cfg(get_tc_config_path())
     if not config.has_section('toolchains'):
         return None
     return config.get('toolchains', tc_name)
@@ -84,6 +81,22 @@ def get_tc_config_path():
     return config_path
 
 
+def _set_package(config, package):
+    """ Store a package in a RawConfigParser object """
+    package_section = 'package "%s"' % package.name
+    if config.has_section(package_section):
+        # Keep the section where it is
+        for option in config.options(package_section):
+            config.remove_option(package_section, option)
+    else:
+        config.add_section(package_section)
+    config.set(package_section, "path", package.path)
+    for attr in ["toolchain_file", "url", "version", "sha256"]:
+        value = getattr(package, attr)
+        if value:
+            config.set(package_section, attr, value)
+
+
 class Package():
     """ A package simply has a name and a path.
     It may also be associated to a toolchain file, relative to its path
@@ -93,6 +106,11 @@ class Package():
         self.name = name
         self.path = path
         self.toolchain_file = toolchain_file
+        # Where the package comes from, when it was added
+        # from a feed. Used to know if it changed
+        self.url = None
+        self.version = None
+        self.sha256 = None
         # Quick hack for now
         self.depends = list()
 
@@ -160,6 +178,7 @@ class Toolchain:
             config.set("toolchains", self.name, "")
             with open(config_path, "w") as fp:
                 config.write(fp)
+            qibuild.configcache.invalidate(config_path)
 
         self.cmake_flags = list()
         self.load_config()
@@ -192,6 +211,7 @@ class Toolchain:
         config.remove_option("toolchains", self.name)
         with open(cfg_path, "w") as fp:
             config.write(fp)
+        qibuild.configcache.invalidate(cfg_path)
 
         cfg_path = self._get_config_path()
         qibuild.sh.rm(cfg_path)
@@ -211,9 +231,7 @@ class Toolchain:
         """ Returns path to self cache directory
 
         """
-        config_path = get_tc_config_path()
-        config = ConfigParser.ConfigParser()
-        config.read(config_path)
+        config = qibuild.configcache.read_cfg(get_tc_config_path())
         cache_path = qibuild.sh.to_native_path(CACHE_PATH)
         cache_path = os.path.join(cache_path, "toolchains")
         if config.has_section("default"):
@@ -247,7 +265,16 @@ class Toolchain:
                     raise Exception(mess)
                 package_tc_file = package_conf.get('toolchain_file')
                 package = Package(package_name, package_path, package_tc_file)
+                package.url = package_conf.get('url')
+                package.version = package_conf.get('version')
+                package.sha256 = package_conf.get('sha256')
                 self.packages.append(package)
+            # Keep the packages in the order of the configuration file
+            config = qibuild.configcache.read_cfg(config_path)
+            order = dict()
+            for (i, section) in enumerate(config.sections()):
+                order[shlex.split(section)[-1]] = i
+            self.packages.sort(key=lambda x: order.get(x.name))
 
         self.update_toolchain_file()
 
@@ -256,15 +283,31 @@ class Toolchain:
 
         """
         config_path = self._get_config_path()
-        qibuild.configstore.update_config(config_path,
-            'package "%s"' % package.name,
-            "path",
-            package.path)
-        if package.toolchain_file:
-            qibuild.configstore.update_config(config_path,
-            'package "%s"' % package.name,
-            "toolchain_file",
-            package.toolchain_file)
+        config = ConfigParser.RawConfigParser()
+        config.read(config_path)
+        _set_package(config, package)
+        with open(config_path, "w") as fp:
+            config.write(fp)
+        qibuild.configcache.invalidate(config_path)
+        self.load_config()
+
+    def set_packages(self, packages):
+        """ Replace all the packages of the toolchain, writing
+        the configuration only once.
+        The packages are kept in the given order
+
+        """
+        config_path = self._get_config_path()
+        config = ConfigParser.RawConfigParser()
+        config.read(config_path)
+        for section in config.sections():
+            if section.startswith("package "):
+                config.remove_section(section)
+        for package in packages:
+            _set_package(config, package)
+        with open(config_path, "w") as fp:
+            config.write(fp)
+        qibuild.configcache.invalidate(config_path)
         self.load_config()
 
     def remove_package(self, name):
@@ -283,6 +326,7 @@ class Toolchain:
 
         with open(cfg_path, "w") as fp:
             config.write(fp)
+        qibuild.configcache.invalidate(cfg_path)
 
         self.load_config()
 
@@ -316,13 +360,17 @@ class Toolchain:
         with open(self.toolchain_file, "w") as fp:
             lines = fp.writelines(lines)
 
-    def parse_feed(self, feed, dry_run=False):
+    def parse_feed(self, feed, dry_run=False, num_jobs=None):
         """ Parse an xml feed,
         adding packages to self while doing so
 
+        :param num_jobs: number of packages to download at the same
+                         time (see :py:func:`qitoolchain.feed.parse_feed`)
+
         """
         # Delegate this to qitoolchain.feed module
-        qitoolchain.feed.parse_feed(self, feed, dry_run=dry_run)
+        qitoolchain.feed.parse_feed(self, feed, dry_run=dry_run,
+                                    num_jobs=num_jobs)
 
         # Update configuration so we keep which was
         # the last used feed
@@ -333,6 +381,7 @@ class Toolchain:
         config.set("toolchains", self.name, self.feed)
         with open(config_path, "w") as fp:
             config.write(fp)
+        qibuild.configcache.invalidate(config_path)
 
     def get(self, package_name):
         """ Get the path to a package